@@ -0,0 +1,99 @@
+"""
+Concurrent read/write throughput of the database helpers: a fresh connection
+per call with rollback journaling (the old get_db_connection) against pooled
+WAL connections.
+
+    python benchmarks/bench_db.py [seconds] [readers] [writers]
+
+Readers mimic a page view (get_username, then the public packet list); writers
+add packets and flip their visibility. Each run uses its own scratch database.
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import database  # noqa: E402
+
+
+# The connection handling database.py used before pooling
+def unpooled_connection():
+    conn = sqlite3.connect(database.database_path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def setup(path, pooled):
+    database.close_pool()
+    database.forget_username()
+    database.database_path = path
+    database.get_db_connection = pooled_connection if pooled else unpooled_connection
+    database.create_db()
+    if not pooled:
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+    database.add_user("bench@example.com", "bench", "pw")
+    for i in range(200):
+        database.add_learning_packet(1, f"Topic {i}", ["a", "b"], "high school", 5, f"static/pdfs/{i}.pdf")
+        database.update_packet_visibility(i + 1, i % 2)
+
+
+def run(seconds, readers, writers):
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def count(what):
+        with lock:
+            counts[what] += 1
+
+    def reader():
+        while time.perf_counter() < deadline:
+            try:
+                database.get_username(1)
+                database.get_all_public_learning_packets()
+                count("reads")
+            except sqlite3.OperationalError:
+                count("errors")
+
+    def writer(n):
+        i = 0
+        while time.perf_counter() < deadline:
+            i += 1
+            try:
+                database.add_learning_packet(1, f"W{n}-{i}", ["x"], "college", 3, f"static/pdfs/w{n}-{i}.pdf")
+                database.update_packet_visibility(1 + i % 200, i % 2)
+                count("writes")
+            except sqlite3.OperationalError:
+                count("errors")
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {k: v / seconds for k, v in counts.items()}
+
+
+pooled_connection = database.get_db_connection
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+    scratch = tempfile.mkdtemp(prefix="bench-db-")
+    for label, pooled in (("before", False), ("after", True)):
+        setup(os.path.join(scratch, f"{label}.db"), pooled)
+        result = run(seconds, readers, writers)
+        print(
+            f"{label:>6}: {result['reads']:8.0f} page reads/s  {result['writes']:6.0f} writes/s  "
+            f"{result['errors']:.1f} lock errors/s  ({readers} readers, {writers} writers)"
+        )
+    database.close_pool()
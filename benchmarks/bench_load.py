@@ -0,0 +1,305 @@
+"""
+End-to-end load test of the web app with the upstream LLMs replaced by
+mock_upstream: /create jobs (submitted, then polled to completion) while other
+clients page through /list_public and /list_user.
+
+    python benchmarks/bench_load.py [--packets 20] [--concurrency 4] [--list-concurrency 4]
+                                    [--latency KIND=SPEC ...] [--latency-scale 1] [--recordings llm_cache.db]
+
+Reports p50/p95/p99 latency per endpoint and finished packets per minute. A
+packet counts as finished when its job is done, i.e. once its preview is
+ready in the default PDF_RENDER_MODE. The app runs in this process on a scratch
+database, LLM cache and packet store, with its usual settings otherwise
+(JOB_WORKERS, PERPLEXITY_RATE_PER_MINUTE, ... from the environment; set the
+rate limits to 0 to measure without quota). Without pandoc, or with
+--render stub, HTML previews and PDFs are stubbed too, timed by the
+render_html / render_pdf latency kinds.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import pathlib
+import argparse
+import tempfile
+import threading
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, HERE)
+
+import mock_upstream  # noqa: E402
+
+RENDER_LATENCY = {
+    "render_html": "lognormal:0.4:0.3",
+    "render_pdf": "lognormal:6:0.3",
+}
+
+TOPICS = [
+    "Newton's laws", "projectile motion", "circular motion", "momentum", "work and energy",
+    "thermodynamics", "waves", "optics", "electric fields", "magnetism", "cell biology",
+    "genetics", "evolution", "photosynthesis", "the French Revolution", "the Cold War",
+    "linear equations", "quadratics", "trigonometry", "derivatives", "integrals",
+    "probability", "vectors", "matrices", "stoichiometry", "chemical bonding",
+]
+GRADES = ["middle school", "high school", "college"]
+
+
+# Prompts the local topic parser handles, and (a `llm_share` of them) ones it hands to the LLM
+def make_prompt(rng, i, llm_share):
+    if rng.random() < llm_share:
+        return f"Help me get ready for my test on {rng.choice(TOPICS)} next week (#{i})"
+    a, b, c = rng.sample(TOPICS, 3)
+    return f"I want to learn about {a}, {b}, and {c}"
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, name, seconds, ok=True):
+        with self._lock:
+            if ok:
+                self.samples.setdefault(name, []).append(seconds)
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def rows(self):
+        with self._lock:
+            names = sorted(set(self.samples) | set(self.errors))
+            for name in names:
+                values = sorted(self.samples.get(name, []))
+                yield name, len(values), self.errors.get(name, 0), [percentile(values, p) for p in (50, 95, 99)]
+
+
+class Client:
+    """One browser: its own cookie jar, so its own login."""
+
+    def __init__(self, base):
+        self.base = base
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def call(self, method, path, form=None):
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        req = urllib.request.Request(self.base + path, data=data, method=method)
+        try:
+            with self.opener.open(req, timeout=600) as r:
+                return r.status, json.loads(r.read() or b"null")
+        except urllib.error.HTTPError as e:
+            body = e.read()
+            try:
+                return e.code, json.loads(body)
+            except ValueError:
+                return e.code, None
+
+    def login(self, n):
+        user = {"username": f"bench{n}", "email": f"bench{n}@example.com", "password": "pw"}
+        self.call("POST", "/register", user)
+        status, _ = self.call("POST", "/login", user)
+        if status != 200:
+            raise RuntimeError(f"could not log in as {user['username']}")
+
+
+def start_app(scratch, mock, stub_render):
+    os.environ["PERPLEXITY_API_URL"] = mock.url
+    os.environ.setdefault("PERPLEXITY_API_KEY", "bench")
+    os.environ.setdefault("PDF_GC_INTERVAL", "0")
+    os.environ["LLM_CACHE_PATH"] = os.path.join(scratch, "llm_cache.db")
+
+    import database
+    database.database_path = os.path.join(scratch, "bench.db")
+    import pdf_store
+    for kind, name in (("pdf", "pdfs"), ("md", "packet_sources"), ("html", "previews")):
+        pdf_store.STORE_DIRS[kind] = pathlib.Path(scratch) / name
+    pdf_store.PDFS_DIR, pdf_store.SOURCES_DIR, pdf_store.PREVIEWS_DIR = (
+        pdf_store.STORE_DIRS["pdf"], pdf_store.STORE_DIRS["md"], pdf_store.STORE_DIRS["html"]
+    )
+    import http_client
+    http_client._gemini_client = mock.gemini
+    if stub_render:
+        stub_renderer(mock)
+
+    import main
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# Swaps pandoc for file writes that take the render_html / render_pdf latencies
+def stub_renderer(mock):
+    import render
+
+    def render_html(md_text, output_path, pdf_url=None, trusted_html=None):
+        time.sleep(mock.delay("render_html")[0])
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(f"<html><body><pre>{len(md_text)} characters</pre></body></html>")
+
+    def render_pdf(md_text, output_path, extra_args=()):
+        time.sleep(mock.delay("render_pdf")[0])
+        with open(output_path, "wb") as f:
+            f.write(b"%PDF-1.4\n% benchmark stub\n")
+
+    render.render_html = render_html
+    render.render_pdf = render_pdf
+    render.warm_up = lambda: None
+
+
+def run(base, args, recorder):
+    rng = random.Random(args.seed)
+    prompts = [make_prompt(rng, i, args.llm_breakdown) for i in range(args.packets)]
+    results = {"done": 0, "error": 0, "rejected": 0}
+    lock = threading.Lock()
+    creating = threading.Event()
+    creating.set()
+
+    def creator(n):
+        client = Client(base)
+        client.login(n)
+        while True:
+            with lock:
+                if not prompts:
+                    return
+                prompt = prompts.pop()
+            form = {
+                "guide-prompt": prompt,
+                "grade-level": rng.choice(GRADES),
+                "exercise-count": str(args.exercises),
+                "regenerate": "0" if args.reuse else "1",
+            }
+            while True:
+                started = time.perf_counter()
+                status, body = client.call("POST", "/create", form)
+                recorder.add("POST /create", time.perf_counter() - started, status == 202)
+                if status != 503:
+                    break
+                with lock:
+                    results["rejected"] += 1
+                time.sleep(1)
+            if status != 202:
+                with lock:
+                    results["error"] += 1
+                continue
+            while True:
+                time.sleep(args.poll)
+                _, job = client.call("GET", body["status_url"])
+                if job and job.get("status") in ("done", "error"):
+                    break
+            recorder.add("packet (end to end)", time.perf_counter() - started, job["status"] == "done")
+            with lock:
+                results[job["status"]] += 1
+
+    def lister(n):
+        client = Client(base)
+        client.login(n % args.concurrency)
+        cursors = {"/list_public": None, "/list_user": None}
+        while creating.is_set():
+            path = rng.choice(list(cursors))
+            query = {"limit": "20"}
+            if cursors[path]:
+                query["cursor"] = cursors[path]
+            started = time.perf_counter()
+            status, body = client.call("GET", f"{path}?{urllib.parse.urlencode(query)}")
+            recorder.add(f"GET {path}", time.perf_counter() - started, status == 200)
+            # Follow "load more" now and then, back to the first page at the end
+            cursors[path] = body.get("next_cursor") if status == 200 and body and rng.random() < 0.5 else None
+            time.sleep(args.list_think)
+
+    creators = [threading.Thread(target=creator, args=(n,)) for n in range(args.concurrency)]
+    listers = [threading.Thread(target=lister, args=(n,)) for n in range(args.list_concurrency)]
+    started = time.perf_counter()
+    for t in creators + listers:
+        t.start()
+    for t in creators:
+        t.join()
+    elapsed = time.perf_counter() - started
+    creating.clear()
+    for t in listers:
+        t.join()
+    return results, elapsed
+
+
+def report(args, results, elapsed, recorder, mock, stub_render):
+    print(
+        f"{args.packets} packets, {args.concurrency} creating clients, {args.list_concurrency} listing clients, "
+        f"latency scale {args.latency_scale}, render {'stubbed' if stub_render else 'pandoc'}"
+    )
+    print(f"{'endpoint':<22}{'ok':>7}{'errors':>8}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}")
+    for name, ok, errors, (p50, p95, p99) in recorder.rows():
+        print(f"{name:<22}{ok:>7}{errors:>8}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}")
+    print(
+        f"packets: {results['done']} done, {results['error']} failed, {results['rejected']} queue-full retries "
+        f"in {elapsed:.1f}s = {results['done'] / elapsed * 60:.1f} packets/min"
+    )
+    upstream = ", ".join(
+        f"{kind} {c['requests']}" + (f" ({c['errors']} 429s)" if c["errors"] else "")
+        for kind, c in sorted(mock.counts().items())
+    )
+    print(f"upstream requests: {upstream or 'none'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--packets", type=int, default=20, help="/create jobs to run")
+    parser.add_argument("--concurrency", type=int, default=4, help="clients creating packets")
+    parser.add_argument("--list-concurrency", type=int, default=4, help="clients paging through the lists")
+    parser.add_argument("--list-think", type=float, default=0.05, help="seconds between a lister's requests")
+    parser.add_argument("--exercises", type=int, default=5, help="exercise-count per packet")
+    parser.add_argument("--llm-breakdown", type=float, default=0.25,
+                        help="share of prompts the local topic parser can't handle")
+    parser.add_argument("--reuse", action="store_true", help="let /create reuse equivalent packets")
+    parser.add_argument("--poll", type=float, default=0.25, help="seconds between job status polls")
+    parser.add_argument("--render", choices=("auto", "pandoc", "stub"), default="auto")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    mock_upstream.add_arguments(parser)
+    args = parser.parse_args()
+
+    stub_render = args.render == "stub" or (args.render == "auto" and shutil.which("pandoc") is None)
+    defaults = dict(mock_upstream.DEFAULT_LATENCY, **RENDER_LATENCY)
+    mock = mock_upstream.MockUpstream(
+        latencies=mock_upstream.parse_latencies(args.latency, args.latency_scale, defaults),
+        recordings=mock_upstream.load_recordings(args.recordings) if args.recordings else None,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    ).start()
+    scratch = tempfile.mkdtemp(prefix="bench-load-")
+    server = None
+    # The app's log lines go to a file so they don't bury the report
+    log = open(os.path.join(scratch, "app.log"), "w", encoding="utf-8")
+    stdout, sys.stdout = sys.stdout, log
+    try:
+        server, base = start_app(scratch, mock, stub_render)
+        recorder = Recorder()
+        results, elapsed = run(base, args, recorder)
+        sys.stdout = stdout
+        report(args, results, elapsed, recorder, mock, stub_render)
+    finally:
+        sys.stdout = stdout
+        if server is not None:
+            server.shutdown()
+        mock.stop()
+        log.close()
+        if args.keep:
+            print(f"scratch files kept in {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
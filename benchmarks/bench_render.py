@@ -0,0 +1,74 @@
+"""
+Compares PDF compile times with and without the precompiled preamble format.
+
+    python benchmarks/bench_render.py [runs]
+
+Needs pandoc, xelatex and the mylatexformat package (TeX Live: texlive-latex-extra).
+"""
+import os
+import sys
+import time
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import render  # noqa: E402
+
+SAMPLE_MD = r"""
+# Kinematics
+
+**Estimated reading time:** 10 minutes
+
+## Motion in one dimension
+
+Velocity is the rate of change of position, $v = \dv{x}{t}$, and acceleration
+is $a = \dv{v}{t}$. With constant acceleration:
+
+$$x(t) = x_0 + v_0 t + \frac{1}{2} a t^2$$
+
+- Units: $\SI{9.81}{\metre\per\second\squared}$
+- `v^2 = v_0^2 + 2 a \Delta x`
+
+\newpage
+
+# Practice Problems
+
+## Problem 1
+
+A ball is dropped from $h = \SI{20}{\metre}$. How long does it fall?
+"""
+
+
+def timed_builds(runs, preload):
+    times = []
+    out_dir = tempfile.mkdtemp(prefix="bench-render-")
+    for i in range(runs):
+        started = time.perf_counter()
+        render._build(SAMPLE_MD, os.path.join(out_dir, f"run-{i}.pdf"), preload=preload)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def report(label, times):
+    print(
+        f"{label:>10}: median {statistics.median(times):.2f}s  "
+        f"mean {statistics.mean(times):.2f}s  min {min(times):.2f}s  (n={len(times)})"
+    )
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    render.RENDER_PRELOAD_FORMAT = True
+
+    started = time.perf_counter()
+    preload = render.preload_format()
+    if preload is None:
+        raise SystemExit(f"Could not build the preamble format: {render._format_error}")
+    print(f"format build: {time.perf_counter() - started:.2f}s ({preload[1]})")
+
+    # One untimed build each so both sides start with warm file caches
+    timed_builds(1, None)
+    timed_builds(1, preload)
+    report("cold", timed_builds(runs, None))
+    report("preloaded", timed_builds(runs, preload))
@@ -0,0 +1,95 @@
+"""
+Checks sanitize_markdown_for_latex against its golden outputs and the original
+implementation, then compares their speed.
+
+    python benchmarks/bench_sanitize.py            # verify + benchmark
+    python benchmarks/bench_sanitize.py --update   # regenerate *.expected from the reference
+
+The corpus in sanitize_corpus/ is a quantum physics packet like example.pdf
+(textbook, practice problems, sources) plus hand-written edge cases. On top of
+that, randomly generated strings over the characters the sanitizer cares about
+are compared against the reference implementation.
+"""
+import os
+import sys
+import glob
+import time
+import random
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, HERE)
+
+from search import sanitize_markdown_for_latex  # noqa: E402
+from sanitize_reference import sanitize_markdown_for_latex as reference  # noqa: E402
+
+CORPUS_DIR = os.path.join(HERE, "sanitize_corpus")
+FUZZ_ALPHABET = ["$", "$$", "`", "```", "\\", "\\(", "\\)", "\\[", "\\]", "\\frac", "\\pm", "{", "}",
+                 "_", "^", "~", "#", "%", "&", "a", "x1", " ", "\n", "\n\n", "\r\n", "\x0c", "\0"]
+
+
+def read(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+def corpus():
+    return sorted(glob.glob(os.path.join(CORPUS_DIR, "*.md")))
+
+
+def check_golden():
+    failures = 0
+    for path in corpus():
+        expected_path = path[: -len(".md")] + ".expected"
+        got = sanitize_markdown_for_latex(read(path))
+        if got != read(expected_path):
+            failures += 1
+            print(f"MISMATCH {os.path.basename(path)}")
+    return failures
+
+
+def check_fuzz(cases=20000, seed=1234):
+    rng = random.Random(seed)
+    for i in range(cases):
+        text = "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, 40)))
+        if sanitize_markdown_for_latex(text) != reference(text):
+            print(f"MISMATCH on random case {i}: {text!r}")
+            return 1
+    return 0
+
+
+def best_of(fn, text, repeat=7, number=20):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(text)
+        times.append((time.perf_counter() - started) / number)
+    return min(times), statistics.median(times)
+
+
+def benchmark():
+    packet = "\n\n\\newpage\n\n".join(read(p) for p in corpus())
+    for label, text in [("one packet", packet), ("batch of 50", packet * 50)]:
+        ref_best, ref_median = best_of(reference, text, number=20 if len(text) < 100_000 else 2)
+        new_best, new_median = best_of(sanitize_markdown_for_latex, text, number=20 if len(text) < 100_000 else 2)
+        print(
+            f"{label:>12} ({len(text) / 1024:.0f} KiB): reference {ref_best * 1000:.2f} ms, "
+            f"current {new_best * 1000:.2f} ms, {ref_best / new_best:.1f}x faster "
+            f"(medians {ref_median * 1000:.2f} / {new_median * 1000:.2f} ms)"
+        )
+
+
+if __name__ == "__main__":
+    if "--update" in sys.argv:
+        for path in corpus():
+            with open(path[: -len(".md")] + ".expected", "w", encoding="utf-8", newline="") as f:
+                f.write(reference(read(path)))
+        print(f"Regenerated {len(corpus())} golden files from the reference implementation")
+        sys.exit(0)
+
+    failures = check_golden() + check_fuzz()
+    print("output identical to reference" if not failures else f"{failures} mismatch(es)")
+    benchmark()
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,425 @@
+"""
+Local stand-in for the upstream LLMs, for load tests that shouldn't spend quota:
+an HTTP server speaking Perplexity's chat-completions API (plain and streamed)
+and an object with the slice of the Gemini client actually_fix_markdown uses.
+
+    python benchmarks/mock_upstream.py [--port 8099] [--recordings llm_cache.db] [--latency KIND=SPEC ...]
+
+Point an app at it with PERPLEXITY_API_URL=http://127.0.0.1:<port>/chat/completions.
+Requests are recognised by their prompts (topic breakdown, whole lesson, lesson
+outline, single section, practice problems, markdown fix). Answers come from
+the recordings when there are some for that kind, otherwise they are made up
+from the prompt; markdown fixes echo the markdown back. Recordings are the
+responses an llm_cache.db from a real deployment holds.
+
+Latency specs (seconds, drawn per request, times --latency-scale):
+    fixed:S   uniform:LO:HI   lognormal:MEDIAN:SIGMA   normal:MEAN:SD
+"""
+import re
+import json
+import math
+import time
+import random
+import sqlite3
+import argparse
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+KINDS = ("breakdown", "lesson", "outline", "section", "problems", "fix_markdown", "gemini")
+
+# Rough medians of the real services for a packet-sized request
+DEFAULT_LATENCY = {
+    "breakdown": "lognormal:1.5:0.3",
+    "lesson": "lognormal:25:0.3",
+    "outline": "lognormal:4:0.3",
+    "section": "lognormal:8:0.3",
+    "problems": "lognormal:12:0.4",
+    "fix_markdown": "lognormal:6:0.3",
+    "gemini": "lognormal:8:0.3",
+}
+
+
+class Latency:
+    def __init__(self, spec, scale=1.0):
+        name, *args = spec.split(":")
+        try:
+            args = [float(a) for a in args]
+        except ValueError:
+            raise ValueError(f"bad latency spec: {spec}")
+        arity = {"fixed": 1, "uniform": 2, "lognormal": 2, "normal": 2}
+        if arity.get(name) != len(args):
+            raise ValueError(f"bad latency spec: {spec}")
+        self.spec = spec
+        self.name = name
+        self.args = args
+        self.scale = scale
+
+    def sample(self, rng=random):
+        if self.name == "fixed":
+            value = self.args[0]
+        elif self.name == "uniform":
+            value = rng.uniform(*self.args)
+        elif self.name == "lognormal":
+            value = rng.lognormvariate(math.log(self.args[0]), self.args[1])
+        else:
+            value = rng.gauss(*self.args)
+        return max(0.0, value) * self.scale
+
+
+# KIND=SPEC overrides on top of `defaults`
+def parse_latencies(overrides=(), scale=1.0, defaults=DEFAULT_LATENCY):
+    specs = dict(defaults)
+    for item in overrides:
+        kind, sep, spec = item.partition("=")
+        if not sep:
+            raise ValueError(f"expected KIND=SPEC, got: {item}")
+        specs[kind] = spec
+    return {kind: Latency(spec, scale) for kind, spec in specs.items()}
+
+
+# Recorded responses by kind, from an llm_cache.db
+def load_recordings(path):
+    recordings = {}
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT kind, value FROM llm_cache").fetchall()
+    finally:
+        conn.close()
+    for cache_kind, value in rows:
+        kind = _recording_kind(cache_kind, value)
+        if kind is not None:
+            recordings.setdefault(kind, []).append(value)
+    return recordings
+
+
+def _recording_kind(cache_kind, value):
+    if cache_kind == "breakdown_topics":
+        return "breakdown"
+    if cache_kind == "practice_problems":
+        return "problems"
+    if cache_kind != "lesson":
+        return None
+    # Whole lessons, outlines and single sections all share the "lesson" kind
+    try:
+        parsed = json.loads(value)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(parsed, dict):
+        return None
+    sections = parsed.get("sections")
+    if isinstance(sections, list) and sections:
+        return "lesson" if isinstance(sections[0], dict) and "overview" in sections[0] else "outline"
+    return "section" if "overview" in parsed else None
+
+
+########################################################################################
+# ----------------- Made-up responses -----------------
+########################################################################################
+
+def _section(title, topic, quiz=3):
+    return {
+        "title": title,
+        "overview": (
+            f"{title} is a core part of {topic}. This section defines the main terms, shows how "
+            f"they connect, and works through a typical example. " * 6
+        ).strip(),
+        "key_points": [f"{title}: key idea {i}" for i in range(1, 5)],
+        "formulas": ["$F = ma$", "$E = \\frac{1}{2} m v^2$"],
+        "derivations": "Start from $F = ma$ and integrate over the distance travelled.",
+        "diagram": {"caption": f"{title} at a glance", "instructions": "Draw two labelled boxes joined by an arrow."},
+        "worked_example": {
+            "prompt": f"Apply {title} to a block of mass $m = 2$ kg pushed with $F = 10$ N.",
+            "steps": ["Write $a = F / m$.", "Substitute: $a = 10 / 2$."],
+            "answer": "$a = 5 \\, \\text{m/s}^2$",
+        },
+        "common_pitfalls": ["Mixing up units.", "Dropping the sign of the force."],
+        "mini_quiz": [{"q": f"Question {i} on {title}?", "a": f"Answer {i}."} for i in range(1, quiz + 1)],
+    }
+
+
+def _subtopic_list(text):
+    return [s.strip() for s in text.split(",") if s.strip() and s.strip() != "—"]
+
+
+def _made_up(kind, system, user, rng):
+    topic = (re.search(r'(?:Primary|Packet) topic: "(.*?)"', user) or re.search(r"- Topic: (.*)", user))
+    topic = topic.group(1).strip() if topic else "General topic"
+    subtopics = re.search(r"Focus subtopics \(include and integrate\): (.*)", user)
+    subtopics = _subtopic_list(subtopics.group(1)) if subtopics else []
+    quiz = re.search(r"and (\d+) mini-quiz", user)
+    quiz = int(quiz.group(1)) if quiz else 3
+    limit = re.search(r"(?:≤|At most) (\d+)", user)
+    limit = int(limit.group(1)) if limit else 6
+    titles = (subtopics or [f"{topic} basics", f"{topic} in practice"])[:limit]
+
+    if kind == "breakdown":
+        sentence = re.search(r'Break this down: "(.*)"', user, re.S)
+        sentence = sentence.group(1) if sentence else user
+        main = " ".join(sentence.split()[-4:]).strip(" .?!") or "General topic"
+        return json.dumps({"main_topic": main, "subtopics": [f"{main} basics", f"{main} applications"]})
+    if kind == "lesson":
+        return json.dumps({
+            "title": f"{topic} — Learning Packet",
+            "learning_path": titles,
+            "sections": [_section(t, topic, quiz) for t in titles],
+            "summary": f"A short tour of {topic}.",
+            "estimated_total_read_time_minutes": 4 * len(titles),
+        })
+    if kind == "outline":
+        return json.dumps({
+            "title": f"{topic} — Learning Packet",
+            "learning_path": titles,
+            "sections": [{"title": t, "focus": f"What {t} means and how to use it."} for t in titles],
+            "summary": f"A short tour of {topic}.",
+            "estimated_total_read_time_minutes": 4 * len(titles),
+        })
+    if kind == "section":
+        title = re.search(r'This section: "(.*?)"', user)
+        return json.dumps(dict(_section(title.group(1) if title else topic, topic, quiz), citations=[]))
+    if kind == "problems":
+        count = re.search(r"Find exactly (\d+)", user)
+        return json.dumps([_problem(topic, rng.getrandbits(32)) for _ in range(int(count.group(1)) if count else 5)])
+    raise ValueError(kind)
+
+
+def _problem(topic, tag):
+    return {
+        "question": f"({tag:08x}) A cart of mass 3 kg on {topic} accelerates at 2 m/s^2.\n(a) Find the net force.\n(b) Find the work done over 4 m.",
+        "solution": "(a) F = ma = 3 * 2 = 6 N.\n(b) W = F d = 6 * 4 = 24 J.",
+        "source_title": "Practice set (benchmark)",
+        "source_url": f"https://example.edu/practice/{tag:08x}.pdf",
+        "license": "CC BY 4.0",
+    }
+
+
+# A recorded problem batch stretched or cut to the requested size
+def _resize_problems(recorded, user):
+    count = re.search(r"Find exactly (\d+)", user)
+    count = int(count.group(1)) if count else 5
+    items = json.loads(recorded)
+    if not isinstance(items, list) or not items:
+        return recorded
+    out = []
+    for i in range(count):
+        item = dict(items[i % len(items)])
+        if i >= len(items):
+            item["question"] = f"{item.get('question', '')} (variant {i // len(items)})"
+        out.append(item)
+    return json.dumps(out)
+
+
+########################################################################################
+# ----------------- Server -----------------
+########################################################################################
+
+def classify(messages):
+    system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+    user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    if system.startswith("Extract a student's learning intent"):
+        return "breakdown"
+    if system.startswith("Reformat the user text"):
+        return "fix_markdown"
+    if "verbatim practice problems" in system:
+        return "problems"
+    if user.startswith("Plan a condensed"):
+        return "outline"
+    if user.startswith("Write one section of"):
+        return "section"
+    if user.startswith("Create a condensed"):
+        return "lesson"
+    return None
+
+
+class MockUpstream:
+    """
+    The Perplexity server runs on its own threads from start() until stop();
+    `gemini` is a drop-in for http_client's Gemini client.
+    """
+
+    def __init__(self, latencies=None, recordings=None, error_rate=0.0, seed=None, port=0):
+        self.latencies = latencies or parse_latencies()
+        self.recordings = recordings or {}
+        self.error_rate = error_rate
+        self.port = port
+        self.rng = random.Random(seed)
+        self.gemini = GeminiStandIn(self)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/chat/completions"
+
+    def start(self):
+        upstream = self
+
+        class Handler(_Handler):
+            mock = upstream
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="mock-upstream", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def count(self, kind, what="requests"):
+        with self._lock:
+            counts = self._counts.setdefault(kind, {"requests": 0, "errors": 0})
+            counts[what] += 1
+
+    # Requests (and injected errors) per kind so far
+    def counts(self):
+        with self._lock:
+            return {kind: dict(c) for kind, c in self._counts.items()}
+
+    def delay(self, kind):
+        with self._lock:
+            latency = self.latencies[kind].sample(self.rng)
+            fail = self.rng.random() < self.error_rate
+        return latency, fail
+
+    def answer(self, kind, messages):
+        system = next((m["content"] for m in messages if m.get("role") == "system"), "")
+        user = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+        if kind == "fix_markdown":
+            return user.split("Only return the Markdown:\n\n", 1)[-1]
+        with self._lock:
+            recorded = self.recordings.get(kind)
+            if recorded:
+                content = self.rng.choice(recorded)
+                return _resize_problems(content, user) if kind == "problems" else content
+            return _made_up(kind, system, user, self.rng)
+
+
+def _usage(messages, content):
+    prompt = sum(len(m.get("content", "")) for m in messages)
+    return {"prompt_tokens": prompt // 4 + 1, "completion_tokens": len(content) // 4 + 1}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            messages = payload["messages"]
+        except (ValueError, KeyError, TypeError):
+            return self._json(400, {"error": {"message": "expected a chat-completions payload"}})
+        kind = classify(messages)
+        if kind is None:
+            return self._json(400, {"error": {"message": "request not recognised by the mock"}})
+
+        self.mock.count(kind)
+        latency, fail = self.mock.delay(kind)
+        if fail:
+            self.mock.count(kind, "errors")
+            time.sleep(min(latency, 0.5))
+            return self._json(429, {"error": {"message": "rate limited (injected)"}}, [("retry-after", "1")])
+
+        content = self.mock.answer(kind, messages)
+        usage = _usage(messages, content)
+        if payload.get("stream"):
+            return self._stream(content, usage, latency)
+        time.sleep(latency)
+        self._json(200, {
+            "id": f"mock-{kind}",
+            "model": payload.get("model"),
+            "object": "chat.completion",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        })
+
+    # Server-sent events: first token after a fifth of the latency, the rest spread evenly
+    def _stream(self, content, usage, latency):
+        pieces = [content[i : i + 200] for i in range(0, len(content), 200)] or [""]
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(latency / 5)
+        gap = latency * 4 / 5 / len(pieces)
+        for i, piece in enumerate(pieces):
+            chunk = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+            if i == len(pieces) - 1:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(gap)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class GeminiStandIn:
+    """client.models.generate_content(model=..., contents=...) answering with the markdown it was sent."""
+
+    def __init__(self, mock):
+        self.models = self
+        self._mock = mock
+
+    def generate_content(self, model, contents):
+        self._mock.count("gemini")
+        latency, _ = self._mock.delay("gemini")
+        time.sleep(latency)
+        markdown = contents.split(": \n\n", 1)[-1]
+        return SimpleNamespace(
+            text=f"```markdown\n{markdown}\n```",
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=len(contents) // 4 + 1,
+                candidates_token_count=len(markdown) // 4 + 1,
+            ),
+        )
+
+
+def add_arguments(parser):
+    parser.add_argument("--recordings", help="llm_cache.db whose responses are replayed")
+    parser.add_argument("--latency", action="append", default=[], metavar="KIND=SPEC",
+                        help=f"per-request latency; kinds: {', '.join(KINDS)}")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies every latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 429")
+    parser.add_argument("--seed", type=int)
+
+
+def from_arguments(args, port=0):
+    return MockUpstream(
+        latencies=parse_latencies(args.latency, args.latency_scale),
+        recordings=load_recordings(args.recordings) if args.recordings else None,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        port=port,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock Perplexity chat-completions API.")
+    parser.add_argument("--port", type=int, default=8099)
+    add_arguments(parser)
+    args = parser.parse_args()
+    mock = from_arguments(args, args.port).start()
+    print(f"mock Perplexity API at {mock.url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,98 @@
+"""
+Reference copy of sanitize_markdown_for_latex as it was before the single-pass
+rewrite in src/search.py. bench_sanitize.py uses it to regenerate the golden
+outputs and to check the new implementation produces identical output.
+"""
+
+MATH_CMDS = r"(vec|frac|cdot|times|ldots|nabla|partial|sqrt|sum|prod|int|lim|log|ln|sin|cos|tan|alpha|beta|gamma|Delta|leq|geq|pm)"
+
+# The original multi-pass sanitizer, kept to check the single-pass one against
+def sanitize_markdown_for_latex(md: str) -> str:
+    """
+    Preflight sanitizer to reduce LaTeX build errors from Pandoc.
+    - Normalizes math delimiters to $...$ (inline) and $$...$$ (display)
+    - Ensures math commands are in math mode
+    - Escapes LaTeX special chars in non-math, non-code
+    """
+    import re
+
+    # Split into code fences so we don't touch code blocks
+    fence_pat = re.compile(r"(?s)(```.*?```)")
+    parts = fence_pat.split(md)
+
+    def _normalize_math_delims(text: str) -> str:
+        # Convert \(...\) -> $...$ and \[...\] -> $$...$$
+        text = re.sub(r"\\\((.*?)\\\)", r"$\1$", text, flags=re.S)
+        text = re.sub(r"\\\[(.*?)\\\]", r"$$\1$$", text, flags=re.S)
+
+        # Ensure there is no mix of $$ inside inline runs; leave $$...$$ alone
+        return text
+
+    def _force_math_for_cmds(text: str) -> str:
+        # If a line contains a math command but no $ or $$, wrap the minimal span in $...$
+        out_lines = []
+        for ln in text.splitlines():
+            if "$" in ln or "$$" in ln:
+                out_lines.append(ln)
+                continue
+            if re.search(rf"\\{MATH_CMDS}\b", ln):
+                out_lines.append(f"${ln}$")
+            else:
+                out_lines.append(ln)
+        return "\n".join(out_lines)
+
+    def _escape_latex_specials(text: str) -> str:
+        # Do not escape inside math ($...$ or $$...$$). Split by math spans first.
+        # Order: $$...$$ first (display), then $...$ (inline)
+        def esc(s: str) -> str:
+            # Escape: \, {, }, $, &, #, _, %, ~, ^
+            s = s.replace("\\", r"\\")
+            s = s.replace("{", r"\{").replace("}", r"\}")
+            s = s.replace("&", r"\&").replace("#", r"\#").replace("%", r"\%")
+            s = s.replace("_", r"\_").replace("$", r"\$")
+            s = s.replace("~", r"\textasciitilde{}").replace("^", r"\textasciicircum{}")
+            return s
+
+        # Split on $$...$$
+        disp_split = re.split(r"(\$\$.*?\$\$)", text, flags=re.S)
+        disp_out = []
+        for chunk in disp_split:
+            if chunk.startswith("$$") and chunk.endswith("$$"):
+                disp_out.append(chunk)  # leave math unchanged
+            else:
+                # Now split this chunk on inline $...$
+                inl_split = re.split(r"(\$.*?\$)", chunk, flags=re.S)
+                for sub in inl_split:
+                    if sub.startswith("$") and sub.endswith("$"):
+                        disp_out.append(sub)  # inline math unchanged
+                    else:
+                        disp_out.append(esc(sub))
+        return "".join(disp_out)
+
+    def _balance_dollars(text: str) -> str:
+        # Very conservative: if a line has an odd number of $ (and not $$),
+        # append one $ at the end to balance. Skip lines already containing $$.
+        fixed = []
+        for ln in text.splitlines():
+            if "$$" in ln:
+                fixed.append(ln)
+                continue
+            if ln.count("$") % 2 == 1:
+                fixed.append(ln + "$")
+            else:
+                fixed.append(ln)
+        return "\n".join(fixed)
+
+    out = []
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            # code fence: leave exactly as-is
+            out.append(part)
+        else:
+            t = part
+            t = _normalize_math_delims(t)
+            t = _force_math_for_cmds(t)
+            t = _escape_latex_specials(t)
+            t = _balance_dollars(t)
+            out.append(t)
+    return "".join(out)
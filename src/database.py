@@ -1,21 +1,82 @@
 import os
 import json
+import queue
+import re
+import base64
+import time
+import threading
 import requests
 import sqlite3
+from collections import OrderedDict
+from hashlib import sha256
 from werkzeug.security import generate_password_hash, check_password_hash
+import metrics
+import tracing
 
 database_path = os.path.join(os.path.dirname(__file__), 'wonder_bot_database.db')
 
-# Get a database connection
-def get_db_connection():
-    conn = sqlite3.connect(database_path)
+# Idle connections kept open for reuse, and how long a query waits on a locked database
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+# Page cache per connection
+DB_CACHE_MB = int(os.getenv("DB_CACHE_MB", "16"))
+
+# user ID -> username lookups kept in memory, and for how long
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", "4096"))
+USERNAME_CACHE_TTL = float(os.getenv("USERNAME_CACHE_TTL", "300"))
+
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+
+# A connection whose close() hands it back to the pool instead of closing it
+class PooledConnection(sqlite3.Connection):
+    def close(self):
+        try:
+            # Never hand on a half-finished transaction (e.g. after a failed insert)
+            if self.in_transaction:
+                self.rollback()
+            _pool.put_nowait(self)
+        except (queue.Full, sqlite3.Error):
+            super().close()
+
+
+def _connect():
+    conn = sqlite3.connect(
+        database_path, timeout=DB_BUSY_TIMEOUT, factory=PooledConnection, check_same_thread=False
+    )
     conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside a writer; NORMAL sync is safe with WAL
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_MB * 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
-# Initialize database
-def create_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# Get a database connection (from the pool when one is idle); close() returns it
+def get_db_connection():
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+# Closes the idle pooled connections (e.g. before replacing the database file)
+def close_pool():
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            return
+        sqlite3.Connection.close(conn)
+
+# Records a helper's duration (connection checkout included) under its name
+def _timed(fn):
+    return metrics.DB_QUERY_SECONDS.time(query=fn.__name__)(fn)
+
+########################################################################################
+# ----------------- Schema migrations -----------------
+########################################################################################
+
+def _create_base_tables(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -37,37 +98,246 @@ def create_db():
             public BOOLEAN DEFAULT 0
         )
     ''')
-    conn.commit()
-    conn.close()
+
+# Older databases predate packet_key: add it and backfill existing packets
+def _add_packet_key(cursor):
+    columns = [row['name'] for row in cursor.execute("PRAGMA table_info(learning_packets)")]
+    if 'packet_key' not in columns:
+        cursor.execute("ALTER TABLE learning_packets ADD COLUMN packet_key TEXT")
+    rows = cursor.execute('''
+        SELECT id, topic, subtopics, grade_level, num_problems
+        FROM learning_packets WHERE packet_key IS NULL
+    ''').fetchall()
+    for row in rows:
+        key = make_packet_key(row['topic'], json.loads(row['subtopics']), row['grade_level'], row['num_problems'])
+        cursor.execute("UPDATE learning_packets SET packet_key = ? WHERE id = ?", (key, row['id']))
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_learning_packets_packet_key ON learning_packets (packet_key)")
+
+# Indexes for the per-user list, the public list and login
+def _add_lookup_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_learning_packets_user_id ON learning_packets (user_id, id)")
+    # Partial index: only public packets, used by queries that say "public = 1"
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_learning_packets_public ON learning_packets (id) WHERE public = 1")
+    duplicates = cursor.execute(
+        "SELECT COUNT(*) FROM (SELECT username FROM users GROUP BY username HAVING COUNT(*) > 1)"
+    ).fetchone()[0]
+    if duplicates:
+        # Registration never checked usernames; _unique_usernames renames the
+        # duplicates and makes this index UNIQUE
+        tracing.log("duplicate_usernames", level="warning", count=duplicates,
+                    message="username index created without UNIQUE")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+    else:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+
+# Indexes for the library lists sorted by topic (newest/oldest use the ones above)
+def _add_listing_indexes(cursor):
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_learning_packets_public_topic
+        ON learning_packets (topic COLLATE NOCASE, id) WHERE public = 1
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_learning_packets_user_topic
+        ON learning_packets (user_id, topic COLLATE NOCASE, id)
+    ''')
+
+# Full-text index over public packets. Triggers keep it in step with every
+# insert, visibility change and delete, whichever code path makes them.
+def _add_packet_search(cursor):
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS packet_search
+        USING fts5(topic, subtopics, grade_level, tokenize = 'porter unicode61')
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS packet_search_insert AFTER INSERT ON learning_packets
+        WHEN NEW.public = 1
+        BEGIN
+            INSERT INTO packet_search (rowid, topic, subtopics, grade_level)
+            VALUES (NEW.id, NEW.topic, NEW.subtopics, NEW.grade_level);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS packet_search_update
+        AFTER UPDATE OF public, topic, subtopics, grade_level ON learning_packets
+        BEGIN
+            DELETE FROM packet_search WHERE rowid = OLD.id;
+            INSERT INTO packet_search (rowid, topic, subtopics, grade_level)
+            SELECT NEW.id, NEW.topic, NEW.subtopics, NEW.grade_level WHERE NEW.public = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS packet_search_delete AFTER DELETE ON learning_packets
+        BEGIN
+            DELETE FROM packet_search WHERE rowid = OLD.id;
+        END
+    ''')
+    cursor.execute("DELETE FROM packet_search")
+    cursor.execute('''
+        INSERT INTO packet_search (rowid, topic, subtopics, grade_level)
+        SELECT id, topic, subtopics, grade_level FROM learning_packets WHERE public = 1
+    ''')
+
+# Change counters for the list endpoints' ETags: "public" for the library and
+# "user:<id>" per user, bumped by triggers on any packet write that shows in a list
+def _add_list_versions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS list_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated INTEGER NOT NULL
+        )
+    ''')
+    bump = '''
+        INSERT INTO list_versions (scope, version, updated)
+        SELECT {scope}, 1, CAST(strftime('%s', 'now') AS INTEGER) WHERE {when}
+        ON CONFLICT (scope) DO UPDATE SET version = version + 1, updated = excluded.updated;
+    '''
+    user = bump.format(scope="'user:' || {row}.user_id", when="{when}")
+    public = bump.format(scope="'public'", when="{when}")
+    triggers = [
+        ("insert", "AFTER INSERT",
+         user.format(row="NEW", when="1") + public.format(when="NEW.public = 1")),
+        # A packet moved to another user changes both users' lists
+        ("update", "AFTER UPDATE OF user_id, topic, grade_level, pdf_path, public",
+         user.format(row="NEW", when="1")
+         + user.format(row="OLD", when="OLD.user_id != NEW.user_id")
+         + public.format(when="OLD.public = 1 OR NEW.public = 1")),
+        ("delete", "AFTER DELETE",
+         user.format(row="OLD", when="1") + public.format(when="OLD.public = 1")),
+    ]
+    for name, event, body in triggers:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS list_versions_{name} {event} ON learning_packets
+            BEGIN {body} END
+        ''')
+    cursor.execute(bump.format(scope="'public'", when="1"))
+
+# _add_lookup_indexes left idx_users_username non-unique where usernames were
+# duplicated. Every duplicate after the first registered is renamed to
+# "<username>-<id>" (logged, so those users can be told), then the index is made UNIQUE.
+def _unique_usernames(cursor):
+    indexes = {row['name']: row['unique'] for row in cursor.execute("PRAGMA index_list(users)")}
+    if indexes.get('idx_users_username'):
+        return
+    taken = {row['username'] for row in cursor.execute("SELECT username FROM users")}
+    rows = cursor.execute('''
+        SELECT id, username FROM users u
+        WHERE id > (SELECT MIN(id) FROM users WHERE username = u.username)
+        ORDER BY id
+    ''').fetchall()
+    for row in rows:
+        new_name, n = f"{row['username']}-{row['id']}", 1
+        while new_name in taken:
+            n += 1
+            new_name = f"{row['username']}-{row['id']}-{n}"
+        taken.add(new_name)
+        cursor.execute("UPDATE users SET username = ? WHERE id = ?", (new_name, row['id']))
+        forget_username(row['id'])
+        tracing.log("username_renamed", level="warning", user_id=row['id'],
+                    old_username=row['username'], new_username=new_name)
+    cursor.execute("DROP INDEX IF EXISTS idx_users_username")
+    cursor.execute("CREATE UNIQUE INDEX idx_users_username ON users (username)")
+
+# Applied in order; PRAGMA user_version holds how many have run. Only ever append
+# new steps: editing or reordering one that has shipped would skip or repeat it.
+MIGRATIONS = [
+    _create_base_tables,
+    _add_packet_key,
+    _add_lookup_indexes,
+    _add_listing_indexes,
+    _add_packet_search,
+    _add_list_versions,
+    _unique_usernames,
+]
+
+# Brings the database schema up to date, one transaction per migration
+def migrate(conn):
+    for version, step in enumerate(MIGRATIONS, 1):
+        # IMMEDIATE takes the write lock first, so processes starting together
+        # wait for each other and then see the version the other one left
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.commit()
+                continue
+            step(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        tracing.log("migration_applied", version=version, step=step.__name__)
+    conn.execute("PRAGMA optimize")
+
+# Initialize database
+def create_db():
+    conn = get_db_connection()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+
+def _normalize_text(text):
+    return " ".join(str(text).lower().split())
+
+# Key identifying equivalent packet requests (same topic, subtopics, level and size)
+def make_packet_key(topic, subtopics, grade_level, num_problems):
+    normalized = {
+        "topic": _normalize_text(topic),
+        "subtopics": sorted({_normalize_text(s) for s in subtopics if str(s).strip()}),
+        "grade_level": _normalize_text(grade_level),
+        "num_problems": int(num_problems),
+    }
+    return sha256(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
 
 # Add a new user
 def add_user(email, username, password):
+    password_hash = generate_password_hash(password)
+    conn = get_db_connection()
     try:
-        password_hash = generate_password_hash(password)
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO users (email, username, password_hash)
-            VALUES (?, ?, ?)
-        ''', (email, username, password_hash))
-        conn.commit()
-        conn.close()
+        with metrics.DB_QUERY_SECONDS.time(query="add_user"):
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO users (email, username, password_hash)
+                VALUES (?, ?, ?)
+            ''', (email, username, password_hash))
+            conn.commit()
         return True
     except sqlite3.IntegrityError:
         return False
+    finally:
+        conn.close()
 
 # Add a new learning packet
+@_timed
 def add_learning_packet(user_id, topic, subtopics, grade_level, num_problems, pdf_path):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO learning_packets (user_id, topic, subtopics, grade_level, num_problems, pdf_path)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, topic, json.dumps(subtopics), grade_level, num_problems, pdf_path))
+        INSERT INTO learning_packets (user_id, topic, subtopics, grade_level, num_problems, pdf_path, packet_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, topic, json.dumps(subtopics), grade_level, num_problems, pdf_path,
+          make_packet_key(topic, subtopics, grade_level, num_problems)))
     conn.commit()
     conn.close()
 
+# Finds packets built for an equivalent request that the user may see
+# (public ones, or their own), the user's own and then newest first
+@_timed
+def find_learning_packets(topic, subtopics, grade_level, num_problems, user_id=None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT * FROM learning_packets
+        WHERE packet_key = ? AND (public = 1 OR user_id = ?)
+        ORDER BY (user_id = ?) DESC, id DESC
+    ''', (make_packet_key(topic, subtopics, grade_level, num_problems), user_id, user_id))
+    packets = cursor.fetchall()
+    conn.close()
+    return packets
+
 # Retrieve learning packets for a user
+@_timed
 def get_user_learning_packets(user_id):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -79,6 +349,7 @@ def get_user_learning_packets(user_id):
     return packets
 
 # Retrieve all public learning packets
+@_timed
 def get_all_public_learning_packets():
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -89,7 +360,184 @@ def get_all_public_learning_packets():
     conn.close()
     return packets
 
+########################################################################################
+# ----------------- Paginated listing -----------------
+########################################################################################
+
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 200
+
+# Sort name -> (ORDER BY, keyset condition that continues after the cursor)
+LIST_SORTS = {
+    "newest": ("p.id DESC", "p.id < ?"),
+    "oldest": ("p.id ASC", "p.id > ?"),
+    "topic": (
+        "p.topic COLLATE NOCASE ASC, p.id ASC",
+        # The leading >= lets SQLite seek the (topic, id) index instead of scanning it
+        "p.topic COLLATE NOCASE >= ? AND (p.topic COLLATE NOCASE > ? OR p.id > ?)",
+    ),
+}
+
+
+class InvalidListQuery(ValueError):
+    pass
+
+
+# Cursors are opaque to the client: the sort they belong to and where to continue
+def _encode_cursor(sort, *key):
+    raw = json.dumps([sort, *key], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(sort, cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, *key = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidListQuery("Invalid cursor.")
+    if cursor_sort != sort:
+        raise InvalidListQuery("Cursor belongs to a different sort order.")
+    if sort == "topic":
+        if len(key) != 2 or not isinstance(key[0], str) or not isinstance(key[1], int):
+            raise InvalidListQuery("Invalid cursor.")
+        return (key[0], key[0], key[1])
+    if len(key) != 1 or not isinstance(key[0], int):
+        raise InvalidListQuery("Invalid cursor.")
+    return (key[0],)
+
+# Checks sort and limit from a request, falling back to the defaults
+def normalize_list_query(sort=None, limit=None):
+    sort = (sort or "newest").lower()
+    if sort not in LIST_SORTS:
+        raise InvalidListQuery(f"Unknown sort '{sort}'; use one of: {', '.join(LIST_SORTS)}.")
+    try:
+        limit = int(limit) if limit not in (None, "") else LIST_DEFAULT_LIMIT
+    except (TypeError, ValueError):
+        raise InvalidListQuery("limit must be a number.")
+    return sort, max(1, min(limit, LIST_MAX_LIMIT))
+
+# One page of packets matching `where`; returns (rows, cursor for the next page or None)
+def _list_page(columns, joins, where, params, sort, limit, cursor):
+    sort, limit = normalize_list_query(sort, limit)
+    order_by, after = LIST_SORTS[sort]
+    params = list(params)
+    if cursor:
+        where = f"{where} AND {after}"
+        params.extend(_decode_cursor(sort, cursor))
+    conn = get_db_connection()
+    try:
+        # One extra row tells whether another page follows
+        rows = conn.execute(f'''
+            SELECT {columns} FROM learning_packets p {joins}
+            WHERE {where}
+            ORDER BY {order_by}
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+    finally:
+        conn.close()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        key = (last['topic'], last['id']) if sort == "topic" else (last['id'],)
+        return rows, _encode_cursor(sort, *key)
+    return rows, None
+
+# A page of a user's packets with only the columns the list view shows
+@_timed
+def list_user_learning_packets(user_id, sort=None, limit=None, cursor=None):
+    return _list_page(
+        "p.id, p.topic, p.grade_level, p.pdf_path, p.public",
+        "",
+        "p.user_id = ?",
+        (user_id,),
+        sort, limit, cursor,
+    )
+
+# A page of public packets with their authors' usernames
+@_timed
+def list_public_learning_packets(sort=None, limit=None, cursor=None):
+    return _list_page(
+        "p.id, p.topic, p.grade_level, p.pdf_path, u.username",
+        "LEFT JOIN users u ON u.id = p.user_id",
+        "p.public = 1",
+        (),
+        sort, limit, cursor,
+    )
+
+# Words in a search box; everything else (quotes, operators, column filters) is dropped
+SEARCH_TERM_RE = re.compile(r"\w+", re.UNICODE)
+# bm25 column weights: a match in the topic counts most, grade level least
+SEARCH_WEIGHTS = (10.0, 4.0, 1.0)
+
+# Turns free text into an FTS5 query: every word must match, the last one as a prefix
+def _search_expression(text):
+    terms = SEARCH_TERM_RE.findall(text or "")[:16]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+# A page of public packets matching `text`, best match first; returns (rows, next cursor)
+@_timed
+def search_public_learning_packets(text, limit=None, cursor=None):
+    _, limit = normalize_list_query(None, limit)
+    expression = _search_expression(text)
+    if expression is None:
+        return [], None
+    # Ranked results can't be keyset-paginated, so the cursor carries an offset
+    offset = _decode_cursor("relevance", cursor)[0] if cursor else 0
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT p.id, p.topic, p.grade_level, p.pdf_path, u.username
+            FROM packet_search s
+            JOIN learning_packets p ON p.id = s.rowid
+            LEFT JOIN users u ON u.id = p.user_id
+            WHERE packet_search MATCH ?
+            ORDER BY bm25(packet_search, {", ".join(map(str, SEARCH_WEIGHTS))}), p.id DESC
+            LIMIT ? OFFSET ?
+        ''', (expression, limit + 1, offset)).fetchall()
+    finally:
+        conn.close()
+    if len(rows) > limit:
+        return rows[:limit], _encode_cursor("relevance", offset + limit)
+    return rows, None
+
+# (version, unix time of last change) of a list scope ("public" or "user:<id>")
+@_timed
+def get_list_version(scope):
+    conn = get_db_connection()
+    row = conn.execute("SELECT version, updated FROM list_versions WHERE scope = ?", (scope,)).fetchone()
+    conn.close()
+    if row:
+        return row['version'], row['updated']
+    return 0, None
+
+# pdf_path -> number of learning_packets rows pointing at it
+@_timed
+def packet_reference_counts():
+    conn = get_db_connection()
+    rows = conn.execute("SELECT pdf_path, COUNT(*) AS refs FROM learning_packets GROUP BY pdf_path").fetchall()
+    conn.close()
+    counts = {}
+    for row in rows:
+        name = os.path.basename(row['pdf_path'])
+        counts[name] = counts.get(name, 0) + row['refs']
+    return counts
+
+# Number of learning_packets rows pointing at the packet file `name`
+@_timed
+def packet_reference_count(name):
+    conn = get_db_connection()
+    row = conn.execute(
+        "SELECT COUNT(*) FROM learning_packets WHERE pdf_path = ? OR pdf_path LIKE ?",
+        (name, "%/" + name),
+    ).fetchone()
+    conn.close()
+    return row[0]
+
 # Updates packet visibility
+@_timed
 def update_packet_visibility(packet_id, is_public):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -101,27 +549,62 @@ def update_packet_visibility(packet_id, is_public):
 
 # Validate user credentials
 def validate_user(username, password):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Retrieve hashed password for the given username
-    cur.execute("SELECT password_hash, id FROM users WHERE username = ?", (username,))
-    user_row = cur.fetchone()
-    conn.close()
+    # Timed without the password check, which is deliberately slow
+    with metrics.DB_QUERY_SECONDS.time(query="validate_user"):
+        conn = get_db_connection()
+        cur = conn.cursor()
+        # Retrieve hashed password for the given username
+        cur.execute("SELECT password_hash, id FROM users WHERE username = ?", (username,))
+        user_row = cur.fetchone()
+        conn.close()
 
     # Checks hashed user password against database
     if user_row and check_password_hash(user_row['password_hash'], password):
         return user_row['id']
     return None
 
-# Gets username
+_usernames = OrderedDict()  # user_id -> (username, expires)
+_usernames_lock = threading.Lock()
+_username_stats = {"hits": 0, "misses": 0}
+
+# Gets username, from the in-process cache when it was looked up recently
 def get_username(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT username FROM users WHERE id = ?
-    ''', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    if user:
-        return user['username']
-    return None
\ No newline at end of file
+    now = time.monotonic()
+    with _usernames_lock:
+        cached = _usernames.get(user_id)
+        if cached and cached[1] > now:
+            _usernames.move_to_end(user_id)
+            _username_stats["hits"] += 1
+            return cached[0]
+        _username_stats["misses"] += 1
+
+    with metrics.DB_QUERY_SECONDS.time(query="get_username"):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT username FROM users WHERE id = ?
+        ''', (user_id,))
+        user = cursor.fetchone()
+        conn.close()
+    if not user:
+        return None
+
+    with _usernames_lock:
+        _usernames[user_id] = (user['username'], now + USERNAME_CACHE_TTL)
+        _usernames.move_to_end(user_id)
+        while len(_usernames) > USERNAME_CACHE_SIZE:
+            _usernames.popitem(last=False)
+    return user['username']
+
+# Drops a cached username (call after changing or deleting a user, as
+# _unique_usernames does), or all of them
+def forget_username(user_id=None):
+    with _usernames_lock:
+        if user_id is None:
+            _usernames.clear()
+        else:
+            _usernames.pop(user_id, None)
+
+def username_cache_stats():
+    with _usernames_lock:
+        return dict(_username_stats, size=len(_usernames))
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import random
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from google import genai
+from google.genai import errors as genai_errors
+import metrics
+import tracing
+
+load_dotenv()
+
+PERPLEXITY_API_URL = os.getenv("PERPLEXITY_API_URL", "https://api.perplexity.ai/chat/completions")
+PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
+
+# Upstream calls allowed in flight at once (per process)
+PERPLEXITY_MAX_CONCURRENCY = int(os.getenv("PERPLEXITY_MAX_CONCURRENCY", "8"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+# Request quota, enforced with a token bucket (burst = one second's worth, at least 1)
+PERPLEXITY_RATE_PER_MINUTE = float(os.getenv("PERPLEXITY_RATE_PER_MINUTE", "50"))
+GEMINI_RATE_PER_MINUTE = float(os.getenv("GEMINI_RATE_PER_MINUTE", "60"))
+# Retries on 429 / 5xx / connection errors, with jittered exponential backoff
+MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+BACKOFF_BASE_SECONDS = float(os.getenv("UPSTREAM_BACKOFF_BASE", "1.0"))
+BACKOFF_MAX_SECONDS = float(os.getenv("UPSTREAM_BACKOFF_MAX", "30"))
+
+RETRY_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _bucket(per_minute):
+    rate = per_minute / 60.0
+    return TokenBucket(rate, max(1.0, rate))
+
+
+_perplexity_bucket = _bucket(PERPLEXITY_RATE_PER_MINUTE)
+_perplexity_slots = threading.BoundedSemaphore(PERPLEXITY_MAX_CONCURRENCY)
+_gemini_bucket = _bucket(GEMINI_RATE_PER_MINUTE)
+_gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+_session = None
+_gemini_client = None
+_init_lock = threading.Lock()
+
+
+# Full-jitter exponential backoff, honouring Retry-After when the server sends one
+def backoff_delay(attempt, retry_after=None):
+    if retry_after:
+        try:
+            return min(BACKOFF_MAX_SECONDS, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+# Process-wide keep-alive session for Perplexity, headers built once
+def get_session():
+    global _session
+    if _session is None:
+        with _init_lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=PERPLEXITY_MAX_CONCURRENCY,
+                )
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                s.headers.update({
+                    "accept": "application/json",
+                    "authorization": f"Bearer {PERPLEXITY_API_KEY}",
+                    "content-type": "application/json",
+                })
+                _session = s
+    return _session
+
+
+# POST a chat-completions payload to Perplexity through the shared pool
+@tracing.traced("perplexity.post")
+def perplexity_post(payload, *, timeout=90):
+    """
+    Returns the final requests.Response (which may still be an error status once
+    retries run out). Raises requests.exceptions.RequestException if the last
+    attempt could not connect at all.
+    """
+    session = get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        _perplexity_bucket.acquire()
+        try:
+            with _perplexity_slots, metrics.UPSTREAM_SECONDS.time(service="perplexity"):
+                r = session.post(PERPLEXITY_API_URL, json=payload, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.UPSTREAM_RESPONSES.inc(service="perplexity", status="error")
+            if attempt == MAX_RETRIES:
+                raise
+            metrics.UPSTREAM_RETRIES.inc(service="perplexity")
+            tracing.log("upstream_retry", level="warning", service="perplexity", error=type(e).__name__,
+                        attempt=attempt + 1, max_retries=MAX_RETRIES)
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        metrics.UPSTREAM_RESPONSES.inc(service="perplexity", status=r.status_code)
+        if r.status_code not in RETRY_STATUS or attempt == MAX_RETRIES:
+            tracing.annotate(status=r.status_code, attempts=attempt + 1)
+            return r
+        metrics.UPSTREAM_RETRIES.inc(service="perplexity")
+        tracing.log("upstream_retry", level="warning", service="perplexity", status=r.status_code,
+                    attempt=attempt + 1, max_retries=MAX_RETRIES)
+        time.sleep(backoff_delay(attempt, r.headers.get("retry-after")))
+
+
+# Shared Gemini client (reads GEMINI_API_KEY from the environment)
+def get_gemini_client():
+    global _gemini_client
+    if _gemini_client is None:
+        with _init_lock:
+            if _gemini_client is None:
+                _gemini_client = genai.Client()
+    return _gemini_client
+
+
+# generate_content with the same rate limiting / backoff as Perplexity calls
+@tracing.traced("gemini.generate")
+def gemini_generate(model, contents):
+    client = get_gemini_client()
+    for attempt in range(MAX_RETRIES + 1):
+        _gemini_bucket.acquire()
+        try:
+            with _gemini_slots, metrics.UPSTREAM_SECONDS.time(service="gemini"):
+                response = client.models.generate_content(model=model, contents=contents)
+        except genai_errors.APIError as e:
+            metrics.UPSTREAM_RESPONSES.inc(service="gemini", status=e.code)
+            if e.code not in RETRY_STATUS or attempt == MAX_RETRIES:
+                raise
+            metrics.UPSTREAM_RETRIES.inc(service="gemini")
+            tracing.log("upstream_retry", level="warning", service="gemini", status=e.code,
+                        attempt=attempt + 1, max_retries=MAX_RETRIES)
+            time.sleep(backoff_delay(attempt))
+            continue
+        except httpx.TransportError as e:
+            # Connection resets and timeouts in the SDK's HTTP transport
+            metrics.UPSTREAM_RESPONSES.inc(service="gemini", status="error")
+            if attempt == MAX_RETRIES:
+                raise
+            metrics.UPSTREAM_RETRIES.inc(service="gemini")
+            tracing.log("upstream_retry", level="warning", service="gemini", error=type(e).__name__,
+                        attempt=attempt + 1, max_retries=MAX_RETRIES)
+            time.sleep(backoff_delay(attempt))
+            continue
+        metrics.UPSTREAM_RESPONSES.inc(service="gemini", status=200)
+        tracing.annotate(status=200, attempts=attempt + 1)
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            metrics.record_usage("gemini", {
+                "prompt_tokens": usage.prompt_token_count,
+                "completion_tokens": usage.candidates_token_count,
+            })
+        return response
+
+
+# Streams a chat completion from Perplexity, yielding content deltas as they arrive
+def perplexity_stream(payload, *, timeout=90):
+    """
+    Same pooling, rate limiting and retries as perplexity_post; retries only
+    happen before any content has been yielded. The concurrency slot is held
+    until the stream is fully read or the generator is closed. Raises
+    requests.HTTPError for a non-retryable error status.
+    """
+    session = get_session()
+    payload = dict(payload, stream=True)
+    for attempt in range(MAX_RETRIES + 1):
+        _perplexity_bucket.acquire()
+        _perplexity_slots.acquire()
+        started = time.perf_counter()
+        try:
+            r = session.post(PERPLEXITY_API_URL, json=payload, timeout=timeout, stream=True)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            _perplexity_slots.release()
+            metrics.UPSTREAM_RESPONSES.inc(service="perplexity", status="error")
+            if attempt == MAX_RETRIES:
+                raise
+            metrics.UPSTREAM_RETRIES.inc(service="perplexity")
+            tracing.log("upstream_retry", level="warning", service="perplexity", error=type(e).__name__,
+                        attempt=attempt + 1, max_retries=MAX_RETRIES)
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        metrics.UPSTREAM_RESPONSES.inc(service="perplexity", status=r.status_code)
+        if r.status_code in RETRY_STATUS and attempt < MAX_RETRIES:
+            r.close()
+            _perplexity_slots.release()
+            metrics.UPSTREAM_RETRIES.inc(service="perplexity")
+            tracing.log("upstream_retry", level="warning", service="perplexity", status=r.status_code,
+                        attempt=attempt + 1, max_retries=MAX_RETRIES)
+            time.sleep(backoff_delay(attempt, r.headers.get("retry-after")))
+            continue
+        break
+
+    usage = None
+    try:
+        r.raise_for_status()
+        r.encoding = "utf-8"
+        for line in r.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            # Usage is cumulative; the last chunk that carries it has the totals
+            usage = chunk.get("usage") or usage
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield delta
+    finally:
+        r.close()
+        _perplexity_slots.release()
+        metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, service="perplexity")
+        metrics.record_usage("perplexity", usage)
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+
+# Number of packets generated at once, and how many may wait behind them
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "200"))
+# Finished jobs are forgotten after this many seconds
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+
+# Pipeline stages reported to the client, in the order they run
+STAGES = [
+    "topic_breakdown",
+    "textbook",
+    "practice_problems",
+    "markdown_repair",
+    "preview",
+    "pdf_render",
+]
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"  # queued -> running -> done | error
+        self.stages = {name: "pending" for name in STAGES}
+        self.result = None
+        self.message = None
+        # Measurements reported while running, e.g. time_to_first_section
+        self.metrics = {}
+        self.created = time.time()
+        self.updated = self.created
+        # Bumped on every change so SSE listeners know when to send an update
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def _touch(self):
+        self.version += 1
+        self.updated = time.time()
+        self._cond.notify_all()
+
+    # Marks a stage as running / done / error (used as the pipeline's progress callback)
+    def stage(self, name, state="running"):
+        with self._cond:
+            self.stages[name] = state
+            if self.status == "queued":
+                self.status = "running"
+            self._touch()
+
+    # Records a measurement (used as the pipeline's on_metric callback)
+    def note(self, name, value):
+        with self._cond:
+            self.metrics[name] = value
+            self._touch()
+
+    def finish(self, result):
+        with self._cond:
+            self.status = "done"
+            self.result = result
+            self._touch()
+
+    def fail(self, message):
+        with self._cond:
+            for name, state in self.stages.items():
+                if state == "running":
+                    self.stages[name] = "error"
+            self.status = "error"
+            self.message = message
+            self._touch()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "stages": dict(self.stages),
+                "metrics": dict(self.metrics),
+                "result": self.result,
+                "message": self.message,
+                "created": self.created,
+                "updated": self.updated,
+            }
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error")
+
+    # Blocks until the job changes past `version` or `timeout` elapses
+    def wait(self, version, timeout=15):
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout=timeout)
+            return self.version
+
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="packet-job")
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def _prune_jobs():
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for job_id in [j.id for j in _jobs.values() if j.finished and j.updated < cutoff]:
+        del _jobs[job_id]
+
+
+def _pending_count():
+    return sum(1 for j in _jobs.values() if not j.finished)
+
+
+def _run(job, fn, args, kwargs):
+    try:
+        result = fn(job, *args, **kwargs)
+    except Exception as e:
+        tracing.log("job_failed", level="error", job_id=job.id, error=str(e))
+        job.fail(str(e))
+        return
+    if not job.finished:
+        job.finish(result)
+
+
+# Queues fn(job, *args, **kwargs) on the background executor and returns the job
+def submit(fn, *args, **kwargs):
+    with _jobs_lock:
+        _prune_jobs()
+        if _pending_count() >= JOB_MAX_PENDING:
+            raise QueueFull("Too many packets are being generated right now, please try again shortly.")
+        job = Job()
+        _jobs[job.id] = job
+    _executor.submit(_run, job, fn, args, kwargs)
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+# Yields Server-Sent Events for a job until it finishes
+def stream_events(job, heartbeat=15):
+    version = -1
+    while True:
+        current = job.wait(version, timeout=heartbeat)
+        if current == version:
+            # Comment line keeps proxies from closing an idle stream
+            yield ": keep-alive\n\n"
+            continue
+        version = current
+        snap = job.snapshot()
+        yield f"event: {snap['status']}\ndata: {json.dumps(snap)}\n\n"
+        if job.finished:
+            return
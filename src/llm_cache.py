@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from hashlib import sha256
+import tracing
+
+cache_path = os.getenv(
+    "LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "llm_cache.db")
+)
+CACHE_ENABLED = os.getenv("LLM_CACHE_DISABLED", "").lower() not in ("1", "true", "yes")
+# Least recently used entries are evicted once the stored responses exceed this size
+CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+# How long each kind of response stays fresh, overridable with LLM_CACHE_TTL_<KIND>
+DEFAULT_TTL_SECONDS = {
+    "breakdown_topics": 30 * 24 * 3600,
+    "lesson": 7 * 24 * 3600,
+    "practice_problems": 24 * 3600,  # prompt carries today's date anyway
+    "fix_markdown": 30 * 24 * 3600,
+    "actually_fix_markdown": 30 * 24 * 3600,
+}
+
+_conn = None
+_lock = threading.Lock()
+_stats = {}
+
+
+def _ttl(kind):
+    env = os.getenv(f"LLM_CACHE_TTL_{kind.upper()}")
+    if env:
+        return int(env)
+    return DEFAULT_TTL_SECONDS.get(kind, 24 * 3600)
+
+
+def _count(kind, what):
+    counts = _stats.setdefault(kind, {"hits": 0, "misses": 0, "stores": 0, "evictions": 0})
+    counts[what] += 1
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(cache_path, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                expires REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)")
+        _conn.commit()
+    return _conn
+
+
+# Content address of a request: hash of the model, messages and sampling parameters
+def cache_key(kind, request):
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return sha256(f"{kind}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+def get(kind, key):
+    now = time.time()
+    with _lock:
+        conn = _get_conn()
+        row = conn.execute(
+            "SELECT value, expires FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < now:
+            if row is not None:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                conn.commit()
+            _count(kind, "misses")
+            return None
+        conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+        conn.commit()
+        _count(kind, "hits")
+        return row[0]
+
+
+def put(kind, key, value):
+    now = time.time()
+    size = len(value.encode("utf-8"))
+    with _lock:
+        conn = _get_conn()
+        conn.execute('''
+            INSERT OR REPLACE INTO llm_cache (key, kind, value, size, created, expires, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (key, kind, value, size, now, now + _ttl(kind), now))
+        _count(kind, "stores")
+        _evict(conn)
+        conn.commit()
+
+
+# Drops expired entries, then least recently used ones until under CACHE_MAX_BYTES
+def _evict(conn):
+    conn.execute("DELETE FROM llm_cache WHERE expires < ?", (time.time(),))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    rows = conn.execute("SELECT key, kind, size FROM llm_cache ORDER BY last_used").fetchall()
+    for key, kind, size in rows:
+        if total <= CACHE_MAX_BYTES:
+            break
+        conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+        _count(kind, "evictions")
+        total -= size
+
+
+def _passes(validate, value):
+    if validate is None:
+        return bool(value)
+    try:
+        return bool(validate(value))
+    except Exception:
+        return False
+
+
+# Returns the cached response for `request`, or calls fetch() and caches its result
+def cached_call(kind, request, fetch, validate=None):
+    """
+    `request` is everything that determines the response (model, messages,
+    sampling parameters). fetch() must return a string. The result is only
+    stored when validate(result) is truthy and doesn't raise, so responses that
+    fail the caller's own checks are never served from the cache.
+    """
+    if not CACHE_ENABLED:
+        return fetch()
+
+    with tracing.span(f"llm.{kind}"):
+        key = cache_key(kind, request)
+        try:
+            hit = get(kind, key)
+        except sqlite3.Error as e:
+            tracing.log("llm_cache_read_failed", level="warning", kind=kind, error=str(e))
+            hit = None
+        tracing.annotate(cached=hit is not None)
+        if hit is not None:
+            return hit
+
+        value = fetch()
+        if _passes(validate, value):
+            try:
+                put(kind, key, value)
+            except sqlite3.Error as e:
+                tracing.log("llm_cache_write_failed", level="warning", kind=kind, error=str(e))
+        return value
+
+
+# Hit / miss / store / eviction counters per call type since process start
+def stats():
+    with _lock:
+        return {kind: dict(counts) for kind, counts in _stats.items()}
@@ -1,18 +1,32 @@
 import os
 import json
 import pathlib
+from hashlib import sha256
+from email.utils import formatdate
 from flask import (
     Flask,
     render_template,
     request,
     jsonify,
     session,
-    flash
+    flash,
+    Response,
+    url_for,
+    abort,
+    send_from_directory,
 )
 from dotenv import load_dotenv
-from perplexity import Perplexity
-from search import search_topic
+from search import search_topic, PDF_RENDER_MODE
+from topics import breakdown_topics
 from database import *
+import jobs
+import llm_cache
+import markdown_repair
+import metrics
+import pdf_store
+import render
+import topics
+import tracing
 
 # Loads environment variables from a .env file
 load_dotenv()
@@ -24,46 +38,10 @@ app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(32)
 create_db()
 
 BASE_PATH = pathlib.Path(__file__).parent
-pdfs_dir = BASE_PATH / "static/pdfs"
-
-# Breaks down a sentence into main topic and subtopics
-def breakdown_topics(sentence):
-    """
-    Uses Perplexity's Sonar-Pro model to extract a main topic and subtopics
-    from a sentence describing what a student wants to learn.
-    Example:
-        breakdown_topics("I want to learn about vector spaces, gram schmidt, and matrix operations")
-    """
-    client = Perplexity()
-
-    response = client.chat.completions.create(
-        model="sonar-pro",
-        messages=[
-            {
-                "role": "system",
-                "content": "Extract a student's learning intent into a main topic and subtopics. Respond ONLY in JSON.",
-            },
-            {"role": "user", "content": f'Break this down: "{sentence}"'},
-        ],
-        response_format={
-            "type": "json_schema",
-            "json_schema": {
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "main_topic": {"type": "string"},
-                        "subtopics": {"type": "array", "items": {"type": "string"}},
-                    },
-                    "required": ["main_topic", "subtopics"],
-                }
-            },
-        },
-        temperature=0.2,
-        max_tokens=1000,
-    )
+pdf_store.ensure_dirs()
 
-    content = response.choices[0].message.content
-    return json.loads(content)
+render.warm_up()
+pdf_store.start_gc()
 
 @app.context_processor
 def inject_user():
@@ -73,6 +51,20 @@ def inject_user():
         "username": (get_username(uid) if uid else None),
     }
 
+# Packet previews hold LLM/web-derived content: no scripts, no outside resources,
+# and sandboxed even when opened outside the viewer
+PREVIEW_CSP = (
+    "default-src 'none'; style-src 'unsafe-inline'; img-src data:; "
+    "frame-ancestors 'self'; sandbox allow-top-navigation-by-user-activation"
+)
+
+@app.after_request
+def preview_headers(response):
+    if request.path.startswith("/static/previews/"):
+        response.headers["Content-Security-Policy"] = PREVIEW_CSP
+        response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
+
 # Home page
 @app.route("/", methods=["GET", "POST"])
 def home():
@@ -106,7 +98,7 @@ def register():
         if add_user(email, username, password):
             return jsonify({"status": "success", "message": "Registration successful."})
         else:
-            return jsonify({"status": "error", "message": "Registration failed. Email may already be in use."}), 400
+            return jsonify({"status": "error", "message": "Registration failed. Email or username may already be in use."}), 400
     return render_template("register.html")
 
 # Logout
@@ -116,23 +108,70 @@ def logout():
     flash("Logged out successfully", "success")
     return jsonify({"status": "success", "message": "Logged out successfully."})
 
-# Create a learning packet
-@app.route("/create", methods=["POST"])
-def create():
-    guide_prompt = request.form.get("guide-prompt")
-    exercise_count = int(request.form.get("exercise-count", 5))
-    grade_level = request.form.get("grade-level")
+# Returns the pdf_path of a packet already built for an equivalent request, saving
+# it to the user's list if they don't have it yet
+def find_existing_packet(main_topic, subtopics, grade_level, exercise_count, user_id):
+    for packet in find_learning_packets(main_topic, subtopics, grade_level, exercise_count, user_id):
+        # A packet is usable if its PDF exists or can still be built from its markdown;
+        # claiming it also keeps the collector off it while the row is added
+        if not pdf_store.claim(packet['pdf_path']):
+            continue
+        if user_id is not None and packet['user_id'] != user_id:
+            add_learning_packet(
+                user_id,
+                main_topic,
+                subtopics,
+                grade_level,
+                exercise_count,
+                packet['pdf_path']
+            )
+        return packet['pdf_path']
+    return None
 
-    topics = breakdown_topics(guide_prompt)
-    main_topic = topics["main_topic"]
-    subtopics = topics["subtopics"]
+# Runs the packet pipeline for a queued /create job, as one trace
+def build_packet(job, guide_prompt, grade_level, exercise_count, user_id, regenerate=False, trace_id=None):
+    with tracing.trace("create", trace_id, job_id=job.id, user_id=user_id):
+        return _build_packet(job, guide_prompt, grade_level, exercise_count, user_id, regenerate)
+
+def _build_packet(job, guide_prompt, grade_level, exercise_count, user_id, regenerate):
+    job.stage("topic_breakdown")
+    breakdown = breakdown_topics(guide_prompt)
+    main_topic = breakdown["main_topic"]
+    subtopics = breakdown["subtopics"]
+    job.stage("topic_breakdown", "done")
+
+    # Serve an already-built packet for an equivalent request
+    if not regenerate:
+        existing = find_existing_packet(main_topic, subtopics, grade_level, exercise_count, user_id)
+        if existing is not None:
+            for stage in jobs.STAGES[1:]:
+                job.stage(stage, "skipped")
+            return {
+                "pdf_path": existing,
+                "preview_url": pdf_store.preview_url(existing),
+                "main_topic": main_topic,
+                "subtopics": subtopics,
+                "name": f"{main_topic} ({grade_level})",
+                "reused": True,
+            }
 
     # Generate the learning packet
-    pdf_path = search_topic(main_topic, subtopics, grade_level, exercise_count)
+    pdf_path, timings = search_topic(
+        main_topic,
+        subtopics,
+        grade_level,
+        exercise_count,
+        progress=job.stage,
+        on_metric=job.note,
+    )
+    if pdf_path is None:
+        raise RuntimeError("Learning packet generation failed.")
+    if PDF_RENDER_MODE != "eager" and not pdf_store.pdf_file(pdf_path).is_file():
+        # Built in the background or on first download
+        job.stage("pdf_render", "deferred")
 
-    try:
-        if 'user_id' in session:
-            user_id = session['user_id']
+    if user_id is not None:
+        try:
             add_learning_packet(
                 user_id,
                 main_topic,
@@ -141,31 +180,158 @@ def create():
                 exercise_count,
                 pdf_path
             )
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Error saving learning packet: {str(e)}"}), 500
-    
-    packet_name = f"{main_topic} ({grade_level})"
+        except Exception as e:
+            raise RuntimeError(f"Error saving learning packet: {str(e)}") from e
+
+    return {
+        "pdf_path": pdf_path,
+        "preview_url": pdf_store.preview_url(pdf_path),
+        "main_topic": main_topic,
+        "subtopics": subtopics,
+        "name": f"{main_topic} ({grade_level})",
+        "timings": timings,
+        "reused": False,
+    }
+
+# Create a learning packet (queued, returns a job ID straight away)
+@app.route("/create", methods=["POST"])
+def create():
+    guide_prompt = request.form.get("guide-prompt")
+    exercise_count = int(request.form.get("exercise-count", 5))
+    grade_level = request.form.get("grade-level")
+    # Skip the lookup for an equivalent existing packet and build a fresh one
+    regenerate = request.form.get("regenerate", "").lower() in ("1", "true", "on", "yes")
+
+    if not guide_prompt or not guide_prompt.strip():
+        return jsonify({"status": "error", "message": "Prompt cannot be empty."}), 400
+
+    # Ties the job's log lines and spans together
+    trace_id = tracing.new_trace_id()
+    try:
+        job = jobs.submit(
+            build_packet,
+            guide_prompt,
+            grade_level,
+            exercise_count,
+            session.get('user_id'),
+            regenerate,
+            trace_id,
+        )
+    except jobs.QueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
 
-    # Return JSON so the frontend can handle it directly
     return jsonify(
         {
-            "status": "success",
-            "message": "Learning packet created successfully.",
-            "pdf_path": pdf_path,
-            "main_topic": main_topic,
-            "subtopics": subtopics,
-            "name": packet_name,
+            "status": "queued",
+            "job_id": job.id,
+            "trace_id": trace_id,
+            "status_url": url_for("job_status", job_id=job.id),
+            "events_url": url_for("job_events", job_id=job.id),
         }
+    ), 202
+
+# Serves a packet PDF, building it from the saved markdown first if it doesn't exist yet
+@app.route("/static/pdfs/<path:filename>", methods=["GET"])
+def packet_pdf(filename):
+    if filename != pathlib.Path(filename).name or not filename.endswith(".pdf"):
+        abort(404)
+    if not pdf_store.pdf_file(filename).is_file():
+        source = pdf_store.source_file(filename)
+        if not source.is_file():
+            abort(404)
+        try:
+            with tracing.trace("pdf_on_demand", filename=filename):
+                render.ensure_pdf(source, pdf_store.pdf_file(filename, create=True))
+        except render.RenderQueueFull as e:
+            return jsonify({"status": "error", "message": str(e)}), 503, {"Retry-After": "30"}
+        except Exception as e:
+            tracing.log("pdf_on_demand_failed", level="error", filename=filename, error=str(e))
+            return jsonify({"status": "error", "message": "Could not build this PDF."}), 500
+    # Conditional and Range requests are answered by send_file; names are unique per
+    # packet and the file is never rewritten, so it can be cached as immutable
+    pdf = pdf_store.pdf_file(filename)
+    response = send_from_directory(
+        pdf.parent, pdf.name, mimetype="application/pdf", conditional=True, max_age=PDF_MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# Poll a packet job
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found."}), 404
+    return jsonify(job.snapshot())
+
+# Stream a packet job's progress as Server-Sent Events
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found."}), 404
+    return Response(
+        jobs.stream_events(job),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-# List user's generated PDFs in the list view
-@app.route("/list_user", methods=["POST"])
+# Packet PDFs never change once written, so browsers may keep them for a year
+PDF_MAX_AGE = 365 * 24 * 3600
+
+# Validators for a list response: the scope's change counter and the request's
+# arguments go into the ETag, so a packet add or visibility change invalidates it
+def list_validators(scope, *args):
+    version, updated = get_list_version(scope)
+    digest = sha256(json.dumps([scope, version, *args]).encode("utf-8")).hexdigest()[:32]
+    return f'"{digest}"', updated
+
+# True when the client's copy (If-None-Match, else If-Modified-Since) is still current
+def client_has_current(etag, updated):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag.strip('"'))
+    if request.if_modified_since and updated is not None:
+        return request.if_modified_since.timestamp() >= updated
+    return False
+
+# Sends `body` (a 304 when None) with the validators and a revalidate-every-time policy
+def conditional_json(etag, updated, body, private=False):
+    if body is None:
+        response = Response(status=304)
+    else:
+        response = jsonify(body)
+    response.headers["ETag"] = etag
+    if updated is not None:
+        response.headers["Last-Modified"] = formatdate(updated, usegmt=True)
+    response.headers["Cache-Control"] = ("private" if private else "public") + ", no-cache"
+    if private:
+        response.vary.add("Cookie")
+    return response
+
+# Sort, limit and cursor for the list endpoints, from the query string or form
+def list_query_args():
+    return {
+        "sort": request.values.get("sort"),
+        "limit": request.values.get("limit"),
+        "cursor": request.values.get("cursor") or None,
+    }
+
+# List user's generated PDFs in the list view, one page at a time
+@app.route("/list_user", methods=["GET", "POST"])
 def list_pdfs():
     if 'user_id' not in session:
         return jsonify({"status": "error", "message": "Login to view your files"}), 401
 
     user_id = session['user_id']
-    packets = get_user_learning_packets(user_id)  
+    args = list_query_args()
+    etag, updated = list_validators(f"user:{user_id}", args)
+    if client_has_current(etag, updated):
+        return conditional_json(etag, updated, None, private=True)
+    try:
+        packets, next_cursor = list_user_learning_packets(user_id, **args)
+    except InvalidListQuery as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     items = []
     for packet in packets:
         fname = pathlib.Path(packet['pdf_path']).name
@@ -175,21 +341,48 @@ def list_pdfs():
             "name": f"{packet['topic']} ({packet['grade_level']})",
             "is_public": bool(packet["public"]),
         })
-    return jsonify({"status": "success", "items": items})
+    return conditional_json(
+        etag, updated, {"status": "success", "items": items, "next_cursor": next_cursor}, private=True
+    )
 
-# Lists public PDFs
+# A public packet as the library list shows it
+def public_list_item(packet):
+    return {
+        "id": packet["id"],
+        "filename": pathlib.Path(packet['pdf_path']).name,
+        "name": f"{packet['topic']} by {packet['username']} ({packet['grade_level']})"
+    }
+
+# Lists public PDFs, one page at a time
 @app.route("/list_public", methods=["GET"])
 def list_public_pdfs():
-    packets = get_all_public_learning_packets()
-    items = []
-    for packet in packets:
-        fname = pathlib.Path(packet['pdf_path']).name
-        items.append({
-            "id": packet["id"],
-            "filename": fname,
-            "name": f"{packet['topic']} by {get_username(packet['user_id'])} ({packet['grade_level']})"
-        })
-    return jsonify({"status": "success", "items": items})
+    args = list_query_args()
+    etag, updated = list_validators("public", args)
+    if client_has_current(etag, updated):
+        return conditional_json(etag, updated, None)
+    try:
+        packets, next_cursor = list_public_learning_packets(**args)
+    except InvalidListQuery as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    items = [public_list_item(packet) for packet in packets]
+    return conditional_json(etag, updated, {"status": "success", "items": items, "next_cursor": next_cursor})
+
+# Searches the public library by topic, subtopics and grade level, best match first
+@app.route("/search", methods=["GET"])
+def search_public_pdfs():
+    query = request.args.get("q", "")
+    if not query.strip():
+        return jsonify({"status": "error", "message": "Search text cannot be empty."}), 400
+    limit, cursor = request.args.get("limit"), request.args.get("cursor") or None
+    etag, updated = list_validators("public", "search", query, limit, cursor)
+    if client_has_current(etag, updated):
+        return conditional_json(etag, updated, None)
+    try:
+        packets, next_cursor = search_public_learning_packets(query, limit, cursor)
+    except InvalidListQuery as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    items = [public_list_item(packet) for packet in packets]
+    return conditional_json(etag, updated, {"status": "success", "items": items, "next_cursor": next_cursor})
 
 # Update packet visibility
 @app.route("/update_visibility", methods=["GET", "POST"])
@@ -221,6 +414,24 @@ def update_visibility():
     update_packet_visibility(packet_id, is_public)  # <- your DB helper
     return jsonify({"status": "success", "message": "Packet visibility updated."})
 
+# Stage latencies, upstream statuses and retries, token usage, PDF sizes and DB
+# timings in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Process-level counters for operators
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "llm_cache": llm_cache.stats(),
+        "topic_breakdown": topics.stats(),
+        "markdown_repair": markdown_repair.stats(),
+        "render": render.stats(),
+        "username_cache": username_cache_stats(),
+        "pdf_store": pdf_store.stats(),
+    })
+
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", debug=True)
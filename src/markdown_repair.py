@@ -0,0 +1,361 @@
+import re
+import json
+import threading
+import pypandoc
+import tracing
+
+# Same reader markdown_to_pdf uses, so the check sees what the PDF build will see
+PANDOC_FORMAT = "markdown+tex_math_dollars+raw_tex"
+
+FENCE_RE = re.compile(r"^\s{0,3}(```|~~~)")
+HEADING_NO_SPACE_RE = re.compile(r"^( {0,3})(#{1,6})(?=[^\s#])")
+# sanitize_markdown_for_latex escapes '#', which turns headings into text
+ESCAPED_HEADING_RE = re.compile(r"^( {0,3})((?:\\#){1,6})(?=\s)")
+HEADING_RE = re.compile(r"^ {0,3}#{1,6}\s")
+CODE_SPAN_RE = re.compile(r"(`+)(.+?)(?<!`)\1(?!`)")
+# A '$' / '$$' preceded by an even number of backslashes (i.e. not escaped)
+DISPLAY_MATH_RE = re.compile(r"(?<!\\)(?:\\\\)*\$\$")
+INLINE_DOLLAR_RE = re.compile(r"(?<!\\)(?<!\$)(?:\\\\)*\$(?!\$)")
+ESCAPED_DOLLAR_RE = re.compile(r"(?<!\\)\\(?:\\\\)*\$")
+# A '$' right before a digit can't open math in pandoc's reading of a price
+PRICE_DOLLAR_RE = re.compile(r"\$(?=\d)")
+LITERAL_STAR_RE = re.compile(r"(?<=[\w)\]])\*(?=[\w(\[])|(?<!\S)\*(?!\S)|\*(?=\.\w)|(?<=/)\*")
+
+# Delimiter kinds each pandoc_issues finding calls for
+ISSUE_KINDS = {
+    "unpaired $": {"$", "$$"},
+    "unpaired backtick": {"`"},
+    "unpaired **": {"**"},
+    "unpaired *": {"*"},
+    "heading not recognised": {"#"},
+}
+ALL_KINDS = frozenset().union(*ISSUE_KINDS.values())
+
+_lock = threading.Lock()
+_stats = {"documents": 0, "unchecked": 0, "passed_locally": 0, "fragments_to_llm": 0, "llm_errors": 0}
+
+
+def _count(what, n=1):
+    with _lock:
+        _stats[what] += n
+
+
+########################################################################################
+# ----------------- Deterministic fixes -----------------
+########################################################################################
+
+# Splits markdown into (is_code, text) runs on fenced code blocks, closing an unterminated fence
+def _split_fences(md):
+    runs, buf, in_fence = [], [], False
+    for line in md.splitlines(keepends=True):
+        if FENCE_RE.match(line):
+            if not in_fence:
+                if buf:
+                    runs.append((False, "".join(buf)))
+                buf, in_fence = [line], True
+            else:
+                buf.append(line)
+                runs.append((True, "".join(buf)))
+                buf, in_fence = [], False
+            continue
+        buf.append(line)
+    if in_fence:
+        if not buf[-1].endswith("\n"):
+            buf[-1] += "\n"
+        buf.append("```\n")
+    if buf:
+        runs.append((in_fence, "".join(buf)))
+    return runs
+
+
+def _normalize_math_delims(text):
+    # \(...\) -> $...$ and \[...\] -> $$...$$
+    text = re.sub(r"(?<!\\)\\\((.*?)\\\)", lambda m: f"${m.group(1).strip()}$", text, flags=re.S)
+    text = re.sub(r"(?<!\\)\\\[(.*?)\\\]", lambda m: f"$${m.group(1)}$$", text, flags=re.S)
+    return text
+
+
+def _fix_headings(text):
+    out = []
+    for line in text.splitlines(keepends=True):
+        line = ESCAPED_HEADING_RE.sub(lambda m: m.group(1) + "#" * (len(m.group(2)) // 2), line)
+        line = HEADING_NO_SPACE_RE.sub(r"\1\2 ", line)
+        # Pandoc only sees a heading after a blank line
+        if HEADING_RE.match(line) and out and out[-1].strip():
+            out.append("\n")
+        out.append(line)
+    return "".join(out)
+
+
+def _blank(text, spans):
+    # Replaces the given (start, end) spans with spaces so counts skip them
+    chars = list(text)
+    for start, end in spans:
+        chars[start:end] = " " * (end - start)
+    return "".join(chars)
+
+
+def _append(line, marker):
+    body = line.rstrip()
+    return body + marker + line[len(body):]
+
+
+def _dollar_end(m):
+    # Position of the '$' itself (the match may start with escaped backslashes)
+    return m.end() - 1
+
+
+# Pairs '$' positions the way pandoc does: an opener has a non-space right after
+# it, a closer a non-space right before it and no digit right after it
+def _math_pairs(text, dollars):
+    pairs, loose, i = [], [], 0
+    while i < len(dollars):
+        start = dollars[i]
+        if text[start + 1 : start + 2].strip():
+            for j in range(i + 1, len(dollars)):
+                end = dollars[j]
+                if text[end - 1].strip() and not text[end + 1 : end + 2].isdigit():
+                    pairs.append((start, end))
+                    i = j + 1
+                    break
+            else:
+                loose.append(start)
+                i += 1
+        else:
+            loose.append(start)
+            i += 1
+    return pairs, loose
+
+
+# Balances inline $, backticks and ** / * on one line that is outside display math.
+# `kinds` limits it to the delimiters pandoc reported (all of them if None).
+def _fix_line(line, kinds=None):
+    if kinds is None:
+        kinds = ALL_KINDS
+    # Inline code: an unmatched backtick run is closed at the end of the line
+    code_spans = [m.span() for m in CODE_SPAN_RE.finditer(line)]
+    if "`" in kinds and _blank(line, code_spans).count("`") % 2 == 1:
+        line = _append(line, "`")
+        code_spans = [m.span() for m in CODE_SPAN_RE.finditer(line)]
+
+    # Inline math: a '$' pandoc can't pair is closed or trimmed ('$ x $' to '$x$');
+    # one followed by a digit is a price and stays literal, as in pandoc
+    masked = _blank(line, code_spans)
+    if "$" in kinds:
+        _, loose = _math_pairs(masked, [_dollar_end(m) for m in INLINE_DOLLAR_RE.finditer(masked)])
+        loose = [d for d in loose if not masked[d + 1 : d + 2].isdigit()]
+        if len(loose) % 2 == 1:
+            line = _append(line, "$")
+            loose.append(len(line.rstrip()) - 1)
+        for start, end in reversed(list(zip(loose[::2], loose[1::2]))):
+            inner = line[start + 1 : end]
+            if inner.strip() and inner != inner.strip():
+                line = line[: start + 1] + inner.strip() + line[end:]
+
+    # Emphasis: close an unmatched ** or * outside code and math
+    if "**" not in kinds and "*" not in kinds:
+        return line
+    code_spans = [m.span() for m in CODE_SPAN_RE.finditer(line)]
+    masked = _blank(line, code_spans)
+    pairs, _ = _math_pairs(masked, [_dollar_end(m) for m in INLINE_DOLLAR_RE.finditer(masked)])
+    masked = _blank(masked, [(a, b + 1) for a, b in pairs])
+    masked = masked.replace("\\*", "  ")
+    if "**" in kinds and masked.count("**") % 2 == 1:
+        line = _append(line, "**")
+    if "*" in kinds and _single_stars(masked) % 2 == 1:
+        line = _append(line, "*")
+    return line
+
+
+# '*' that can't be emphasis: list bullets, ones between spaces or operands
+# (2*y), and glob wildcards (*.py, src/*)
+def _single_stars(text):
+    text = re.sub(r"^\s*\*\s+", "", text.replace("**", "  "))
+    return LITERAL_STAR_RE.sub(" ", text).count("*")
+
+
+def _fix_block(block, kinds=None):
+    # Display math can't span a blank line: close it at the end of the block
+    if (kinds is None or "$$" in kinds) and len(DISPLAY_MATH_RE.findall(block)) % 2 == 1:
+        body = block.rstrip()
+        block = body + "\n$$" + block[len(body):]
+
+    pieces = re.split(r"((?<!\\)(?:\\\\)*\$\$)", block)
+    out, in_display = [], False
+    for piece in pieces:
+        if DISPLAY_MATH_RE.fullmatch(piece):
+            in_display = not in_display
+            out.append(piece)
+        elif in_display:
+            out.append(piece)
+        else:
+            out.append("".join(_fix_line(ln, kinds) for ln in piece.splitlines(keepends=True)))
+    return "".join(out)
+
+
+# Unwraps a ```markdown reply, closes unterminated fences and converts \(...\) / \[...\]
+def _normalize(md):
+    text = md.strip("\n")
+    if text.startswith("```markdown") and text.endswith("```"):
+        md = text[len("```markdown") : -len("```")].strip("\n") + "\n"
+    return "".join(run if is_code else _normalize_math_delims(run) for is_code, run in _split_fences(md))
+
+
+# Heading and delimiter fixes outside code blocks, limited to `kinds` if given
+def _balance(md, kinds=None):
+    out = []
+    for is_code, run in _split_fences(md):
+        if is_code:
+            out.append(run)
+            continue
+        if kinds is None or "#" in kinds:
+            run = _fix_headings(run)
+        blocks = re.split(r"(\n[ \t]*\n)", run)
+        out.append("".join(b if i % 2 else _fix_block(b, kinds) for i, b in enumerate(blocks)))
+    return "".join(out)
+
+
+# Applies the deterministic repairs to a markdown document
+def local_fix(md):
+    """
+    Strips a ```markdown wrapper, closes unterminated code fences, converts
+    \\(...\\) / \\[...\\] to $...$ / $$...$$, fixes heading markers, and balances
+    $ / $$ / backticks / ** / * per paragraph. Code blocks are left untouched.
+    This is the unchecked fallback; repair_markdown only applies the fixes for
+    what pandoc reports.
+    """
+    return _balance(_normalize(md))
+
+
+########################################################################################
+# ----------------- Pandoc parse check -----------------
+########################################################################################
+
+def _strings(node, found):
+    if isinstance(node, dict):
+        if node.get("t") == "Str":
+            found.append(node["c"])
+            return
+        for value in node.values():
+            _strings(value, found)
+    elif isinstance(node, list):
+        for value in node:
+            _strings(value, found)
+
+
+# Parses with pandoc and lists delimiters that ended up as literal text
+def pandoc_issues(md):
+    """
+    Returns a list of problems (empty if the markdown parses cleanly), or None
+    if pandoc is not available. Valid math and code become Math / Code nodes,
+    so a '$' (other than a price), '`', '**' or '*' (other than a literal one,
+    see LITERAL_STAR_RE) left in plain text beyond escaped ones means a
+    delimiter pandoc could not pair up.
+    """
+    try:
+        ast = json.loads(pypandoc.convert_text(md, "json", format=PANDOC_FORMAT))
+    except OSError:
+        return None
+    except RuntimeError as e:
+        return [f"pandoc failed: {e}"]
+
+    found = []
+    _strings(ast.get("blocks", []), found)
+    text = "".join(found)
+    issues = []
+    # Prices ($5) stay literal in pandoc and aren't a problem
+    escaped = [m for m in ESCAPED_DOLLAR_RE.finditer(md) if not md[m.end() : m.end() + 1].isdigit()]
+    if text.count("$") - len(PRICE_DOLLAR_RE.findall(text)) > len(escaped):
+        issues.append("unpaired $")
+    if text.count("`") > md.count("\\`"):
+        issues.append("unpaired backtick")
+    if "**" in text:
+        issues.append("unpaired **")
+    stars = sum(LITERAL_STAR_RE.sub(" ", s.replace("**", "  ")).count("*") for s in found)
+    if stars > md.count("\\*"):
+        issues.append("unpaired *")
+    for block in ast.get("blocks", []):
+        first = (block.get("c") or [None])[0] if block.get("t") in ("Para", "Plain") else None
+        if isinstance(first, dict) and first.get("t") == "Str" and first["c"].startswith("#"):
+            issues.append("heading not recognised")
+            break
+    return issues
+
+
+# Splits markdown before each heading (outside code fences), keeping every character
+def split_fragments(md):
+    fragments, buf, in_fence = [], [], False
+    for line in md.splitlines(keepends=True):
+        if FENCE_RE.match(line):
+            in_fence = not in_fence
+        elif not in_fence and HEADING_RE.match(line) and any(l.strip() for l in buf):
+            fragments.append("".join(buf))
+            buf = []
+        buf.append(line)
+    if buf:
+        fragments.append("".join(buf))
+    return fragments
+
+
+def _kinds(issues):
+    # A failed parse doesn't say what is wrong, so it gets every fix
+    return set().union(*(ISSUE_KINDS.get(issue, ALL_KINDS) for issue in issues))
+
+
+# Applies only the fixes for what pandoc reports; returns (markdown, remaining issues)
+def _checked_fix(md):
+    issues = pandoc_issues(md)
+    if issues:
+        md = _balance(md, _kinds(issues))
+        issues = pandoc_issues(md)
+    return md, issues
+
+
+# Local repair with a pandoc check; only fragments that still fail go to the LLM
+@tracing.traced("markdown_repair")
+def repair_markdown(md, llm_fix=None):
+    """
+    Text that already parses is returned as is, apart from the ```markdown
+    wrapper, unterminated fences and \\(...\\) / \\[...\\] delimiters. Balancing
+    fixes only go into heading-delimited fragments pandoc_issues flags, and
+    only for the delimiters it flags. `llm_fix(markdown) -> markdown` is called
+    once per fragment that still fails after that. Without pandoc, local_fix
+    is applied unchecked.
+    """
+    _count("documents")
+    normalized = _normalize(md)
+    issues = pandoc_issues(normalized)
+    if issues is None:
+        _count("unchecked")
+        return local_fix(md)
+    if not issues:
+        _count("passed_locally")
+        return normalized
+
+    out, sent = [], 0
+    for fragment in split_fragments(normalized):
+        if not fragment.strip():
+            out.append(fragment)
+            continue
+        fragment, issues = _checked_fix(fragment)
+        if not issues or llm_fix is None:
+            out.append(fragment)
+            continue
+        _count("fragments_to_llm")
+        sent += 1
+        body = fragment.rstrip()
+        try:
+            out.append(_checked_fix(_normalize(llm_fix(body)))[0].rstrip() + fragment[len(body):])
+        except Exception as e:
+            tracing.log("markdown_repair_llm_failed", level="warning", error=str(e))
+            _count("llm_errors")
+            out.append(fragment)
+    if not sent:
+        _count("passed_locally")
+    return "".join(out)
+
+
+# Counters for how often documents pass without any LLM help
+def stats():
+    with _lock:
+        return dict(_stats)
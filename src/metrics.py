@@ -0,0 +1,150 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Process-wide metrics, served by /metrics in the Prometheus text format
+
+SECONDS_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, float("inf"))
+BYTES_BUCKETS = tuple(2 ** n * 1024 for n in range(5, 15)) + (float("inf"),)  # 32 KB .. 16 MB
+
+_lock = threading.Lock()
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, key)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts, sum, count]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    # Times a block, or a whole function when used as a decorator
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f"{self.name}_bucket{_labels(self.labels, key, [('le', _number(bound))])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, key)} {round(total, 6)}"
+            yield f"{self.name}_count{_labels(self.labels, key)} {count}"
+
+
+STAGE_SECONDS = Histogram(
+    "wonderbot_stage_seconds",
+    "Time spent in each packet pipeline step, including cache hits.",
+    labels=("stage",),
+)
+PIPELINE_STAGE_SECONDS = Histogram(
+    "wonderbot_pipeline_stage_seconds",
+    "Duration of each stage of search_topic's stage graph, and of the whole graph (stage=total).",
+    labels=("stage",),
+)
+UPSTREAM_SECONDS = Histogram(
+    "wonderbot_upstream_request_seconds",
+    "Duration of single upstream LLM requests (one per attempt).",
+    labels=("service",),
+)
+UPSTREAM_RESPONSES = Counter(
+    "wonderbot_upstream_responses_total",
+    "Upstream LLM responses by HTTP status; status=\"error\" for connection failures and timeouts.",
+    labels=("service", "status"),
+)
+UPSTREAM_RETRIES = Counter(
+    "wonderbot_upstream_retries_total",
+    "Upstream LLM requests retried after a retryable status or connection error.",
+    labels=("service",),
+)
+LLM_TOKENS = Counter(
+    "wonderbot_llm_tokens_total",
+    "Tokens reported in upstream responses' usage fields.",
+    labels=("service", "kind"),
+)
+PDF_BYTES = Histogram(
+    "wonderbot_pdf_bytes",
+    "Size of rendered packet PDFs.",
+    buckets=BYTES_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    "wonderbot_db_query_seconds",
+    "Duration of the database helpers, connection checkout included.",
+    labels=("query",),
+)
+
+
+# Adds a chat-completions style usage block ({"prompt_tokens", "completion_tokens"}) to LLM_TOKENS
+def record_usage(service, usage):
+    if not isinstance(usage, dict):
+        return
+    for kind in ("prompt", "completion"):
+        value = usage.get(f"{kind}_tokens")
+        if isinstance(value, int) and value > 0:
+            LLM_TOKENS.inc(value, service=service, kind=kind)
+
+
+# All metrics in the Prometheus text exposition format
+def render():
+    with _lock:
+        lines = [line for metric in _registry for line in metric._lines()]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,273 @@
+import os
+import re
+import sys
+import time
+import pathlib
+import threading
+from hashlib import sha256
+import database
+import tracing
+
+BASE_PATH = pathlib.Path(__file__).parent
+PDFS_DIR = BASE_PATH / "static/pdfs"
+PREVIEWS_DIR = BASE_PATH / "static/previews"
+# Assembled packet markdown, kept so PDFs can be built later on demand
+SOURCES_DIR = BASE_PATH / "packet_sources"
+
+# Files of packets no learning_packets row points at (anonymous users' packets,
+# or ones whose rows were deleted) are removed once untouched for this long
+PDF_GC_TTL = float(os.getenv("PDF_GC_TTL", str(7 * 24 * 3600)))
+# Seconds between background collections; 0 turns the collector off
+PDF_GC_INTERVAL = float(os.getenv("PDF_GC_INTERVAL", "3600"))
+
+# A packet's files share its name: <sha256 of the markdown>.pdf / .md / .html
+NAME_RE = re.compile(r"^(?P<digest>[0-9a-f]{64})\.(?:pdf|md|html)$")
+STORE_DIRS = {"pdf": PDFS_DIR, "md": SOURCES_DIR, "html": PREVIEWS_DIR}
+
+_lock = threading.Lock()
+# Held while packet files are reused (touched) or deleted, so the collector can't
+# remove a packet between a reuse and the learning_packets row that follows it
+_store_lock = threading.RLock()
+_gc_thread = None
+_last_gc = None
+
+
+# Packets are named by their content, so byte-identical packets share one set of files
+def packet_name(markdown):
+    return sha256(markdown.encode("utf-8")).hexdigest() + ".pdf"
+
+
+def _digest(name):
+    return pathlib.Path(name).stem
+
+
+# <dir>/<first two hex digits>/<digest>.<ext>; packets from before sharding stay
+# readable where they are
+def _path(kind, name, create=False):
+    digest = _digest(name)
+    directory = STORE_DIRS[kind]
+    sharded = directory / digest[:2] / f"{digest}.{kind}"
+    if create:
+        sharded.parent.mkdir(parents=True, exist_ok=True)
+        return sharded
+    flat = directory / f"{digest}.{kind}"
+    if not sharded.exists() and flat.exists():
+        return flat
+    return sharded
+
+
+def pdf_file(name, create=False):
+    return _path("pdf", name, create)
+
+
+def source_file(name, create=False):
+    return _path("md", name, create)
+
+
+def preview_file(name, create=False):
+    return _path("html", name, create)
+
+
+# URL of a packet's HTML preview, if one was rendered
+def preview_url(name):
+    path = preview_file(name)
+    if path.is_file():
+        return "/static/previews/" + path.relative_to(PREVIEWS_DIR).as_posix()
+    return None
+
+
+# Saves the packet markdown unless an identical packet already did; returns True if
+# it was already stored. Reuse refreshes the files' age so the collector keeps them.
+def save_source(name, markdown):
+    with _store_lock:
+        path = source_file(name)
+        if path.is_file():
+            touch(name)
+            return True
+        path = source_file(name, create=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.part")
+        tmp.write_text(markdown, encoding="utf-8")
+        os.replace(tmp, path)
+        return False
+
+
+def touch(name):
+    with _store_lock:
+        for kind in STORE_DIRS:
+            try:
+                os.utime(_path(kind, name))
+            except FileNotFoundError:
+                pass
+
+
+# Marks a stored packet as reused before a row is added for it; returns False if
+# its PDF can no longer be served (neither the PDF nor its markdown is left)
+def claim(name):
+    with _store_lock:
+        touch(name)
+        return pdf_file(name).is_file() or source_file(name).is_file()
+
+
+def ensure_dirs():
+    for directory in STORE_DIRS.values():
+        directory.mkdir(parents=True, exist_ok=True)
+
+
+########################################################################################
+# ----------------- Garbage collection -----------------
+########################################################################################
+
+# digest -> [(path, size, mtime)] for every packet file in the store
+def _scan():
+    packets = {}
+    for directory in STORE_DIRS.values():
+        if not directory.is_dir():
+            continue
+        for path in directory.rglob("*"):
+            match = NAME_RE.match(path.name)
+            if not match or not path.is_file():
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            packets.setdefault(match["digest"], []).append((path, st.st_size, st.st_mtime))
+    return packets
+
+
+# [(path, size, mtime)] of one packet's files as they are now
+def _files(digest):
+    files = []
+    for kind, directory in STORE_DIRS.items():
+        for path in (directory / digest[:2] / f"{digest}.{kind}", directory / f"{digest}.{kind}"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((path, st.st_size, st.st_mtime))
+    return files
+
+
+def collect(ttl=None, dry_run=False):
+    """
+    Removes the files of packets that no learning_packets row references and that
+    haven't been written or reused for `ttl` seconds. Returns a report of the store;
+    with dry_run=True nothing is deleted and "reclaimable_bytes" says what would be.
+    """
+    global _last_gc
+    ttl = PDF_GC_TTL if ttl is None else ttl
+    refs = {_digest(name): count for name, count in database.packet_reference_counts().items()}
+    now = time.time()
+    report = {
+        "packets": 0,
+        "files": 0,
+        "bytes": 0,
+        "referenced_packets": 0,
+        "references": sum(refs.values()),
+        "unreferenced_packets": 0,
+        "reclaimable_packets": 0,
+        "reclaimable_bytes": 0,
+        "removed_files": 0,
+        "ttl_seconds": ttl,
+    }
+    for digest, files in _scan().items():
+        size = sum(f[1] for f in files)
+        report["packets"] += 1
+        report["files"] += len(files)
+        report["bytes"] += size
+        if refs.get(digest):
+            report["referenced_packets"] += 1
+            continue
+        report["unreferenced_packets"] += 1
+        if now - max(f[2] for f in files) < ttl:
+            continue
+        if dry_run:
+            report["reclaimable_packets"] += 1
+            report["reclaimable_bytes"] += size
+            continue
+        with _store_lock:
+            # Re-checked under the lock: the packet may have been reused (touched)
+            # or given a row since the scan
+            files = _files(digest)
+            if not files or time.time() - max(f[2] for f in files) < ttl:
+                continue
+            if database.packet_reference_count(f"{digest}.pdf"):
+                continue
+            report["reclaimable_packets"] += 1
+            report["reclaimable_bytes"] += sum(f[1] for f in files)
+            for path, _, _ in files:
+                try:
+                    path.unlink()
+                    report["removed_files"] += 1
+                except FileNotFoundError:
+                    pass
+    if not dry_run:
+        with _lock:
+            _last_gc = dict(report, finished=now)
+    return report
+
+
+def _gc_loop():
+    while True:
+        time.sleep(PDF_GC_INTERVAL)
+        try:
+            report = collect()
+            if report["removed_files"]:
+                tracing.log("pdf_gc", packets=report["reclaimable_packets"], bytes=report["reclaimable_bytes"])
+        except Exception as e:
+            tracing.log("pdf_gc_failed", level="error", error=str(e))
+
+
+# Starts the background collector once per process (no-op when PDF_GC_INTERVAL is 0)
+def start_gc():
+    global _gc_thread
+    with _lock:
+        if _gc_thread is not None or PDF_GC_INTERVAL <= 0:
+            return
+        _gc_thread = threading.Thread(target=_gc_loop, name="pdf-gc", daemon=True)
+        _gc_thread.start()
+
+
+# Result of the last collection in this process
+def stats():
+    with _lock:
+        return {
+            "gc_interval": PDF_GC_INTERVAL,
+            "gc_ttl": PDF_GC_TTL,
+            "last_gc": dict(_last_gc) if _last_gc else None,
+        }
+
+
+# Moves packet files written before sharding into their shard directories
+def shard_existing():
+    moved = 0
+    for kind, directory in STORE_DIRS.items():
+        if not directory.is_dir():
+            continue
+        for path in directory.iterdir():
+            if NAME_RE.match(path.name) and path.suffix == f".{kind}" and path.is_file():
+                os.replace(path, _path(kind, path.name, create=True))
+                moved += 1
+    return moved
+
+
+def _megabytes(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+# python pdf_store.py [report|gc|shard]
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "report"
+    if command not in ("report", "gc", "shard"):
+        raise SystemExit("usage: python pdf_store.py [report|gc|shard]")
+    database.create_db()
+    if command == "shard":
+        print(f"moved {shard_existing()} file(s) into shard directories")
+        raise SystemExit(0)
+    report = collect(dry_run=(command == "report"))
+    print(f"store:        {report['packets']} packets, {report['files']} files, {_megabytes(report['bytes'])}")
+    print(f"referenced:   {report['referenced_packets']} packets ({report['references']} learning_packets rows)")
+    print(f"unreferenced: {report['unreferenced_packets']} packets, "
+          f"{report['reclaimable_packets']} older than {report['ttl_seconds']:.0f}s")
+    verb = "reclaimed:" if command == "gc" else "reclaimable:"
+    print(f"{verb:<14}{_megabytes(report['reclaimable_bytes'])}")
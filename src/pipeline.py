@@ -0,0 +1,76 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import tracing
+
+
+class StageError(RuntimeError):
+    """
+    Raised when a pipeline stage fails; `stage` names the stage that raised and
+    `timings` holds the timings of the stages that had finished by then.
+    """
+
+    def __init__(self, stage, error, timings=None):
+        super().__init__(f"stage '{stage}' failed: {error}")
+        self.stage = stage
+        self.error = error
+        self.timings = timings or {}
+
+
+# Runs a small dependency graph of stages on a thread pool
+def run_stages(stages, max_workers=4, on_start=None, on_done=None):
+    """
+    `stages` maps a stage name to (deps, fn). Each fn is called with a dict of
+    its dependencies' results once they have all finished, so stages with no
+    path between them run at the same time.
+
+    Returns (results, timings): results maps stage name -> return value and
+    timings maps stage name -> {"start": offset, "seconds": duration}, plus a
+    "total" entry, all in seconds relative to the start of the run.
+    """
+    for name, (deps, _) in stages.items():
+        for dep in deps:
+            if dep not in stages:
+                raise ValueError(f"stage '{name}' depends on unknown stage '{dep}'")
+
+    results, timings = {}, {}
+    t0 = time.perf_counter()
+
+    def _call(name):
+        deps, fn = stages[name]
+        if on_start:
+            on_start(name)
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"stage.{name}"):
+                return fn({d: results[d] for d in deps})
+        finally:
+            end = time.perf_counter()
+            timings[name] = {"start": round(start - t0, 3), "seconds": round(end - start, 3)}
+
+    remaining = dict(stages)
+    running = {}
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage")
+    try:
+        while remaining or running:
+            ready = [n for n, (deps, _) in remaining.items() if all(d in results for d in deps)]
+            for name in ready:
+                del remaining[name]
+                running[pool.submit(tracing.bind(_call), name)] = name
+            if not running:
+                raise ValueError(f"dependency cycle between stages: {sorted(remaining)}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                try:
+                    results[name] = fut.result()
+                except Exception as e:
+                    raise StageError(name, e, dict(timings)) from e
+                if on_done:
+                    on_done(name)
+    finally:
+        # Don't hold the caller up on stages whose results are no longer needed
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    timings["total"] = {"start": 0.0, "seconds": round(time.perf_counter() - t0, 3)}
+    return results, timings
@@ -0,0 +1,487 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+import pypandoc
+import metrics
+import tracing
+
+# XeLaTeX builds running at once (each one is a pandoc + xelatex process tree)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Renders allowed to wait or run at once; past this render_pdf waits up to
+# RENDER_QUEUE_TIMEOUT seconds for room, then raises RenderQueueFull
+RENDER_MAX_QUEUE = int(os.getenv("RENDER_MAX_QUEUE", "16"))
+RENDER_QUEUE_TIMEOUT = float(os.getenv("RENDER_QUEUE_TIMEOUT", "30"))
+# A single build is killed after this many seconds
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "180"))
+# Builds run at lower CPU priority so they can't starve the web workers
+RENDER_NICE = int(os.getenv("RENDER_NICE", "10"))
+# Per-job working directories. A failed build's is renamed failed-* and kept so
+# build.log can be inspected, up to the RENDER_KEEP_FAILED newest ones.
+RENDER_WORK_DIR = os.getenv(
+    "RENDER_WORK_DIR", os.path.join(tempfile.gettempdir(), "wonderbot-render")
+)
+RENDER_KEEP_FAILED = int(os.getenv("RENDER_KEEP_FAILED", "20"))
+
+PANDOC_FORMAT = "markdown+tex_math_dollars+raw_tex"
+# Previews are served from our own origin, so HTML in the (LLM/web-derived) markdown
+# is escaped as text, and the extensions that put arbitrary attributes (onclick=...)
+# on elements are off. Previews are rendered before the LaTeX sanitizer runs, so
+# \(...\) / \[...\] math is read here too.
+PREVIEW_FORMAT = (
+    "markdown+tex_math_dollars+tex_math_single_backslash"
+    "-raw_html-raw_attribute-native_divs-native_spans-fenced_divs-bracketed_spans"
+    "-link_attributes-header_attributes-inline_code_attributes-fenced_code_attributes"
+)
+HEADER_TEX = r"""
+\usepackage{amsmath,amssymb,mathtools}
+\usepackage{unicode-math}
+\usepackage{physics}
+\usepackage{siunitx}
+"""
+
+# Optional: compile against a precompiled format holding the static part of the
+# preamble (documentclass + math packages), built once and reused by every render
+RENDER_PRELOAD_FORMAT = os.getenv("RENDER_PRELOAD_FORMAT", "0").lower() in ("1", "true", "yes")
+# Dumped into the format right after \documentclass. unicode-math stays in the
+# per-document header: XeTeX cannot dump OpenType fonts into a format.
+PRELOADED_PACKAGES = r"""
+\usepackage{amsmath,amssymb,mathtools}
+\usepackage{physics}
+\usepackage{siunitx}
+\endofdump
+"""
+DOCUMENTCLASS_MARKER = "{$documentclass$}"
+
+# Upper bounds (seconds) of the render-time histogram buckets
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, float("inf"))
+
+
+class RenderQueueFull(RuntimeError):
+    pass
+
+
+class RenderError(RuntimeError):
+    def __init__(self, message, job_dir=None, timed_out=False):
+        super().__init__(message)
+        self.job_dir = job_dir
+        self.timed_out = timed_out
+
+
+_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+# Waits on render_pdf for builds nobody is blocking on (background / on-demand PDFs)
+_background = ThreadPoolExecutor(max_workers=RENDER_MAX_QUEUE, thread_name_prefix="render-bg")
+# output_path -> Future of a build in progress, so concurrent requests share one build
+_pending = {}
+_slots = threading.BoundedSemaphore(RENDER_MAX_QUEUE)
+_lock = threading.Lock()
+_format_lock = threading.Lock()
+_pandoc = None
+_header_path = None
+_format = None  # (formats_dir, format_name, template_path) once built
+_format_error = None
+_stats = {
+    "queued": 0,
+    "running": 0,
+    "rendered": 0,
+    "failed": 0,
+    "rejected": 0,
+    "html_rendered": 0,
+    "on_demand": 0,
+}
+_histograms = {
+    name: {"buckets": [0] * len(HISTOGRAM_BUCKETS), "sum": 0.0, "count": 0}
+    for name in ("queue_wait_seconds", "render_seconds")
+}
+
+
+def _observe(name, seconds):
+    hist = _histograms[name]
+    for i, bound in enumerate(HISTOGRAM_BUCKETS):
+        if seconds <= bound:
+            hist["buckets"][i] += 1
+            break
+    hist["sum"] += seconds
+    hist["count"] += 1
+
+
+# Finds pandoc and checks its version once per process instead of on every render
+def pandoc_info():
+    global _pandoc
+    if _pandoc is None:
+        with _lock:
+            if _pandoc is None:
+                _pandoc = (pypandoc.get_pandoc_path(), pypandoc.get_pandoc_version())
+    return _pandoc
+
+
+# Writes the LaTeX header once (again if a tmp cleaner removed it); the file name
+# carries its hash so edits get a new file
+def header_path():
+    global _header_path
+    if _header_path is None or not os.path.exists(_header_path):
+        with _lock:
+            if _header_path is None or not os.path.exists(_header_path):
+                os.makedirs(RENDER_WORK_DIR, exist_ok=True)
+                digest = sha256(HEADER_TEX.encode("utf-8")).hexdigest()[:16]
+                path = os.path.join(RENDER_WORK_DIR, f"header-{digest}.tex")
+                if not os.path.exists(path):
+                    tmp = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(HEADER_TEX)
+                    os.replace(tmp, path)
+                _header_path = path
+    return _header_path
+
+
+# Pandoc options shared by PDF builds and the format build
+def _pandoc_args():
+    return [
+        "--standalone",
+        "--include-in-header", header_path(),
+        "-V", "geometry:margin=1in",
+    ]
+
+
+def _pandoc_command(pandoc, extra_args=(), preload=None):
+    cmd = [
+        pandoc,
+        "input.md",
+        "--from", PANDOC_FORMAT,
+        "--output", "output.pdf",
+        "--pdf-engine=xelatex",
+        *_pandoc_args(),
+        "--log=build.log",
+        *extra_args,
+    ]
+    if preload:
+        _, name, template = preload
+        cmd += ["--template", template, f"--pdf-engine-opt=-fmt={name}"]
+    nice = shutil.which("nice")
+    if RENDER_NICE and nice:
+        cmd = [nice, "-n", str(RENDER_NICE)] + cmd
+    return cmd
+
+
+########################################################################################
+# ----------------- Precompiled preamble (mylatexformat) -----------------
+########################################################################################
+
+def _tool_version(cmd):
+    return subprocess.run([cmd, "--version"], capture_output=True, text=True, check=True).stdout.splitlines()[0]
+
+
+# Pandoc's LaTeX template with the preloaded packages and \endofdump after \documentclass
+def _preload_template(pandoc):
+    default = subprocess.run(
+        [pandoc, "--print-default-template", "latex"], capture_output=True, text=True, check=True
+    ).stdout
+    at = default.find(DOCUMENTCLASS_MARKER)
+    if at == -1:
+        raise RenderError("pandoc's LaTeX template has no \\documentclass line to preload after")
+    at += len(DOCUMENTCLASS_MARKER)
+    return default[:at] + PRELOADED_PACKAGES + default[at:]
+
+
+# Builds (or reuses) the format; its name hashes everything that would make it stale
+def _build_format():
+    pandoc, pandoc_version = pandoc_info()
+    xelatex = shutil.which("xelatex")
+    if not xelatex:
+        raise RenderError("xelatex not found")
+    template = _preload_template(pandoc)
+    key = sha256("\n".join([
+        template, HEADER_TEX, pandoc_version, _tool_version(xelatex), " ".join(_pandoc_args()),
+    ]).encode("utf-8")).hexdigest()[:16]
+
+    formats_dir = os.path.join(RENDER_WORK_DIR, "formats")
+    os.makedirs(formats_dir, exist_ok=True)
+    name = f"packet-{key}"
+    template_path = os.path.join(formats_dir, f"{name}.latex")
+    if os.path.exists(os.path.join(formats_dir, f"{name}.fmt")):
+        return formats_dir, name, template_path
+
+    with open(template_path, "w", encoding="utf-8") as f:
+        f.write(template)
+    # The preamble pandoc would emit for a packet, cut off after \endofdump
+    preamble = subprocess.run(
+        [pandoc, "--from", PANDOC_FORMAT, "--to", "latex", "--template", template_path, *_pandoc_args()],
+        input="x", capture_output=True, text=True, check=True,
+    ).stdout
+    with open(os.path.join(formats_dir, f"{name}.tex"), "w", encoding="utf-8") as f:
+        f.write(preamble)
+    proc = subprocess.run(
+        [xelatex, "-ini", "-interaction=nonstopmode", f"-jobname={name}",
+         "&xelatex", "mylatexformat.ltx", f"{name}.tex"],
+        cwd=formats_dir, capture_output=True, text=True, timeout=RENDER_TIMEOUT,
+    )
+    if proc.returncode != 0 or not os.path.exists(os.path.join(formats_dir, f"{name}.fmt")):
+        raise RenderError(f"Format build failed (log: {formats_dir}/{name}.log):\n{proc.stdout[-2000:]}")
+
+    # Formats for older headers / TeX installs are dead weight
+    for entry in os.listdir(formats_dir):
+        if entry.startswith("packet-") and not entry.startswith(name):
+            os.remove(os.path.join(formats_dir, entry))
+    tracing.log("render_format_built", format=name)
+    return formats_dir, name, template_path
+
+
+# The precompiled format to render with, or None when disabled / unavailable
+def preload_format():
+    global _format, _format_error
+    if not RENDER_PRELOAD_FORMAT or _format_error is not None:
+        return None
+    if _format is None:
+        with _format_lock:
+            if _format is None and _format_error is None:
+                try:
+                    _format = _build_format()
+                except (OSError, subprocess.SubprocessError, RenderError) as e:
+                    _format_error = str(e)
+                    tracing.log("render_preload_disabled", level="warning", reason=str(e))
+    return _format
+
+
+# Whether a failed preloaded build's error points at the format file itself
+def _format_fault(error, preload):
+    text = str(error).lower()
+    return preload[1].lower() in text or ".fmt" in text or "format file" in text
+
+
+def _disable_preload(reason):
+    global _format, _format_error
+    _format, _format_error = None, reason
+    tracing.log("render_preload_disabled", level="warning", reason=reason)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+# Moves a failed build's directory aside for its build.log and drops the oldest
+# ones past RENDER_KEEP_FAILED; returns where the log is
+def _keep_failed(job_dir):
+    failed_dir = os.path.join(RENDER_WORK_DIR, "failed-" + os.path.basename(job_dir)[len("job-"):])
+    try:
+        os.rename(job_dir, failed_dir)
+    except OSError:
+        return job_dir
+    kept = sorted(
+        (os.path.join(RENDER_WORK_DIR, e) for e in os.listdir(RENDER_WORK_DIR) if e.startswith("failed-")),
+        key=_mtime,
+        reverse=True,
+    )
+    for path in kept[RENDER_KEEP_FAILED:]:
+        shutil.rmtree(path, ignore_errors=True)
+    return failed_dir
+
+
+# Runs one pandoc build in its own working directory and moves the PDF into place
+def _build(md_text, output_path, extra_args=(), preload=None):
+    pandoc, _ = pandoc_info()
+    # Created here too: warm_up may have failed, or a tmp cleaner removed it
+    os.makedirs(RENDER_WORK_DIR, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix="job-", dir=RENDER_WORK_DIR)
+    try:
+        with open(os.path.join(job_dir, "input.md"), "w", encoding="utf-8") as f:
+            f.write(md_text)
+
+        env = None
+        if preload:
+            # Empty trailing entry keeps kpathsea's default search path after ours
+            env = dict(os.environ, TEXFORMATS=preload[0] + os.pathsep)
+        try:
+            proc = subprocess.run(
+                _pandoc_command(pandoc, extra_args, preload),
+                cwd=job_dir,
+                env=env,
+                capture_output=True,
+                text=True,
+                timeout=RENDER_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            log_dir = _keep_failed(job_dir)
+            raise RenderError(
+                f"Render timed out after {RENDER_TIMEOUT:.0f}s (log: {log_dir}/build.log)", log_dir, timed_out=True
+            )
+        if proc.returncode != 0:
+            log_dir = _keep_failed(job_dir)
+            raise RenderError(
+                f"Pandoc exited with {proc.returncode} (log: {log_dir}/build.log):\n{proc.stderr[-2000:]}",
+                log_dir,
+            )
+
+        # Copy next to the destination first so readers never see a partial PDF
+        partial = f"{output_path}.{os.getpid()}.{threading.get_ident()}.part"
+        shutil.move(os.path.join(job_dir, "output.pdf"), partial)
+        os.replace(partial, output_path)
+    finally:
+        # Gone already if it was kept as failed-*
+        shutil.rmtree(job_dir, ignore_errors=True)
+    metrics.PDF_BYTES.observe(os.path.getsize(output_path))
+
+
+def _run(md_text, output_path, extra_args, submitted):
+    started = time.perf_counter()
+    with _lock:
+        _stats["queued"] -= 1
+        _stats["running"] += 1
+        _observe("queue_wait_seconds", started - submitted)
+    try:
+        preload = preload_format()
+        try:
+            _build(md_text, output_path, extra_args, preload)
+        except RenderError as e:
+            if not preload or e.timed_out:
+                raise
+            # A stale or broken format must not cost the packet: retry cold. Only
+            # blame the format when it is named in the error or the cold build
+            # works; a LaTeX error in the packet itself fails both ways.
+            if _format_fault(e, preload):
+                _disable_preload(str(e).splitlines()[0])
+                _build(md_text, output_path, extra_args)
+            else:
+                try:
+                    _build(md_text, output_path, extra_args)
+                except RenderError:
+                    raise e from None
+                _disable_preload(str(e).splitlines()[0])
+    except Exception:
+        with _lock:
+            _stats["failed"] += 1
+        raise
+    else:
+        with _lock:
+            _stats["rendered"] += 1
+            _observe("render_seconds", time.perf_counter() - started)
+    finally:
+        with _lock:
+            _stats["running"] -= 1
+
+
+# Renders markdown to a PDF at output_path on the shared render workers. Timed as
+# the markdown_to_pdf stage: background and on-demand builds come here directly.
+@metrics.STAGE_SECONDS.time(stage="markdown_to_pdf")
+@tracing.traced("render.pdf")
+def render_pdf(md_text, output_path, extra_args=()):
+    """
+    Blocks until the PDF is written. Raises RenderQueueFull if the queue stays
+    full for RENDER_QUEUE_TIMEOUT seconds, and RenderError if the build fails.
+    """
+    if not _slots.acquire(timeout=RENDER_QUEUE_TIMEOUT):
+        with _lock:
+            _stats["rejected"] += 1
+        raise RenderQueueFull("Too many PDFs are being rendered right now, please try again shortly.")
+    try:
+        with _lock:
+            _stats["queued"] += 1
+        future = _executor.submit(_run, md_text, output_path, tuple(extra_args), time.perf_counter())
+        return future.result()
+    finally:
+        _slots.release()
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# Renders markdown to a standalone HTML page, math as MathML (no scripts, no CDN)
+@tracing.traced("render.html")
+# `trusted_html` (HTML we wrote and escaped ourselves, e.g. textbook_to_html) goes in
+# as is before the markdown; the markdown itself is read with PREVIEW_FORMAT
+def render_html(md_text, output_path, pdf_url=None, trusted_html=None):
+    extra_args = ["--standalone", "--mathml", "--metadata", "pagetitle=Learning Packet"]
+    if pdf_url:
+        extra_args += ["-V", f'include-before=<p><a href="{pdf_url}" target="_top">Download PDF</a></p>']
+    include = None
+    try:
+        if trusted_html:
+            # A file rather than -V, which would hit the argument length limit
+            with tempfile.NamedTemporaryFile("w", suffix=".html", encoding="utf-8", delete=False) as include:
+                include.write(trusted_html)
+            extra_args.append(f"--include-before-body={include.name}")
+        html = pypandoc.convert_text(md_text, "html5", format=PREVIEW_FORMAT, extra_args=extra_args)
+    finally:
+        if include is not None:
+            os.unlink(include.name)
+    _write_atomic(str(output_path), html)
+    with _lock:
+        _stats["html_rendered"] += 1
+
+
+def _build_from_source(source_path, output_path):
+    with open(source_path, encoding="utf-8") as f:
+        render_pdf(f.read(), output_path)
+
+
+# Builds output_path from the markdown saved at source_path unless it already exists
+def ensure_pdf(source_path, output_path, wait=True):
+    """
+    Concurrent callers for the same output share a single build. With wait=False
+    the build runs in the background and its Future is returned; otherwise this
+    blocks and re-raises the build's error.
+    """
+    output_path = str(output_path)
+    if os.path.exists(output_path):
+        return None
+    with _lock:
+        future = _pending.get(output_path)
+        if future is None:
+            future = _background.submit(_build_from_source, str(source_path), output_path)
+            _pending[output_path] = future
+            if wait:
+                _stats["on_demand"] += 1
+    future.add_done_callback(lambda f: _pending.pop(output_path, None))
+    if wait:
+        future.result()
+    return future
+
+
+# Runs the one-time setup (pandoc lookup, header file) before the first packet needs it
+def warm_up():
+    try:
+        _, version = pandoc_info()
+        header_path()
+        tracing.log("render_ready", pandoc=version, workers=RENDER_WORKERS)
+        preload_format()
+    except OSError as e:
+        tracing.log("render_unavailable", level="warning", error=str(e))
+
+
+# Queue depth, outcomes and render-time histograms since process start
+def stats():
+    with _lock:
+        histograms = {}
+        for name, hist in _histograms.items():
+            cumulative, buckets = 0, {}
+            for bound, count in zip(HISTOGRAM_BUCKETS, hist["buckets"]):
+                cumulative += count
+                buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+            histograms[name] = {"buckets": buckets, "sum": round(hist["sum"], 3), "count": hist["count"]}
+        return dict(
+            _stats,
+            pending_builds=len(_pending),
+            workers=RENDER_WORKERS,
+            max_queue=RENDER_MAX_QUEUE,
+            preloaded_format=_format[1] if _format else None,
+            **histograms,
+        )
+
+
+# Build the preamble format at deploy time: RENDER_PRELOAD_FORMAT=1 python render.py
+if __name__ == "__main__":
+    if not RENDER_PRELOAD_FORMAT:
+        raise SystemExit("Set RENDER_PRELOAD_FORMAT=1 to build the preamble format")
+    warm_up()
+    if _format is None:
+        raise SystemExit(_format_error or "format not built")
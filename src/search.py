@@ -1,20 +1,26 @@
 import os
 import json
 import requests
-from hashlib import sha256
 import pathlib
 from dotenv import load_dotenv
 from datetime import datetime
 import re
-import pypandoc
-from google import genai
-from flask import session
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import run_stages, StageError
+from http_client import perplexity_post, perplexity_stream, gemini_generate
+import llm_cache
+import markdown_repair
+import metrics
+import tracing
+import render
+import pdf_store
+import textbook_render
 
 load_dotenv()
 
 BASE_PATH = pathlib.Path(__file__).parent
 
-PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
 PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
@@ -30,13 +36,12 @@ def assert_api_key():
 
 
 # Temperature 0.2 for focused, less random output
-def create_lesson(messages, *, temperature=0.2, max_tokens=12000, debug=True):
+def create_lesson(messages, *, temperature=0.2, max_tokens=12000, debug=True, validate=None):
+    """
+    Returns the model's text content. Responses are cached by request; a response
+    is only cached if validate(content) passes (see llm_cache.cached_call).
+    """
     assert_api_key()
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "content-type": "application/json",
-    }
     payload = {
         "model": "sonar-pro",
         "messages": messages,
@@ -47,15 +52,21 @@ def create_lesson(messages, *, temperature=0.2, max_tokens=12000, debug=True):
         "enable_search_classifier": True,
         "return_search_results": False,
     }
+    return llm_cache.cached_call(
+        "lesson", payload, lambda: _post_for_content(payload, debug), validate
+    )
+
+
+# Sends a chat-completions payload and returns the first choice's content
+def _post_for_content(payload, debug):
     try:
-        r = requests.post(PERPLEXITY_API_URL, json=payload, headers=headers, timeout=90)
+        r = perplexity_post(payload, timeout=90)
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"HTTP request failed: {e}")
 
     if debug:
-        print(f"[perplexity] status={r.status_code}")
-        # print only first 800 chars to avoid flooding logs
-        print(f"[perplexity] body head: {r.text[:800]}")
+        # only the first 800 chars to avoid flooding logs
+        tracing.log("perplexity_response", level="debug", status=r.status_code, body_head=r.text[:800])
 
     # Explicitly raise HTTP errors
     try:
@@ -64,6 +75,7 @@ def create_lesson(messages, *, temperature=0.2, max_tokens=12000, debug=True):
         raise RuntimeError(f"API error {r.status_code}: {r.text}") from he
 
     data = r.json()
+    metrics.record_usage("perplexity", data.get("usage") if isinstance(data, dict) else None)
     # Defensive: ensure choices exist
     if not isinstance(data, dict) or "choices" not in data or not data["choices"]:
         raise RuntimeError(f"Unexpected response structure: {json.dumps(data)[:800]}")
@@ -73,6 +85,103 @@ def create_lesson(messages, *, temperature=0.2, max_tokens=12000, debug=True):
     return content
 
 
+# Incrementally scans streamed JSON and picks out each element of the
+# top-level "sections" array as soon as its closing brace arrives
+class SectionStreamParser:
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        self.last_key = None  # most recent string seen directly inside the top-level object
+        self.sections_depth = None  # depth inside the "sections" array, once it opens
+        self.section_start = None
+
+    def feed(self, chunk):
+        """Adds streamed text and returns the list of sections completed by it."""
+        self.text += chunk
+        done = []
+        text = self.text
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = text[self.string_start + 1 : i]
+                continue
+
+            if ch == '"':
+                self.in_string = True
+                self.string_start = i
+            elif ch in "{[":
+                self.depth += 1
+                if ch == "[" and self.depth == 2 and self.last_key == "sections":
+                    self.sections_depth = 2
+                elif ch == "{" and self.sections_depth is not None and self.depth == self.sections_depth + 1:
+                    self.section_start = i
+            elif ch in "}]":
+                if ch == "}" and self.section_start is not None and self.depth == self.sections_depth + 1:
+                    try:
+                        done.append(json.loads(text[self.section_start : i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self.section_start = None
+                elif ch == "]" and self.depth == self.sections_depth:
+                    self.sections_depth = None
+                self.depth -= 1
+        self.pos = len(text)
+        return done
+
+
+# Streaming variant of create_lesson: calls on_section(section) for each textbook
+# section as soon as it has been generated, and returns the full content
+def stream_lesson(messages, on_section, *, temperature=0.2, max_tokens=12000, validate=None):
+    assert_api_key()
+    # Same request (and cache entry) as create_lesson; perplexity_stream sets stream=True
+    payload = {
+        "model": "sonar-pro",
+        "messages": messages,
+        "temperature": temperature,
+        "top_p": 0.9,
+        "max_tokens": max_tokens,
+        "stream": False,
+        "enable_search_classifier": True,
+        "return_search_results": False,
+    }
+    streamed = []
+
+    def fetch():
+        parser = SectionStreamParser()
+        parts = []
+        try:
+            with tracing.span("perplexity.stream"):
+                for delta in perplexity_stream(payload, timeout=90):
+                    parts.append(delta)
+                    for section in parser.feed(delta):
+                        on_section(section)
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"HTTP request failed: {e}")
+        streamed.append(True)
+        content = "".join(parts)
+        if not content:
+            raise RuntimeError("No content returned from stream")
+        return content
+
+    content = llm_cache.cached_call("lesson", payload, fetch, validate)
+    if not streamed:
+        # Served from the cache: replay the sections in order
+        for section in SectionStreamParser().feed(content):
+            on_section(section)
+    return content
+
+
 SCHEMA_HINT = {
     "type": "object",
     "required": [
@@ -151,6 +260,8 @@ SYSTEM_MSG = (
 )
 
 # Creates the textbook-style learning packet (textbook part only)
+@metrics.STAGE_SECONDS.time(stage="find_textbook_packet")
+@tracing.traced("find_textbook_packet")
 def find_textbook_packet(
     topic: str,
     subtopics: list[str],
@@ -158,7 +269,18 @@ def find_textbook_packet(
     max_sections: int = 6,
     quiz_per_section: int = 3,
     debug=True,
+    on_section=None,
 ) -> dict:
+    """
+    With `on_section`, the lesson is streamed and on_section(section) is called
+    for each section as soon as it is complete. TEXTBOOK_MODE=fanout switches to
+    find_textbook_packet_fanout.
+    """
+    if TEXTBOOK_MODE == "fanout":
+        return find_textbook_packet_fanout(
+            topic, subtopics, grade_level, max_sections, quiz_per_section, debug, on_section
+        )
+
     subtopics_txt = ", ".join(subtopics) if subtopics else "—"
     user_msg = f"""
 Create a condensed, concise textbook-style packet for a {grade_level} student.
@@ -183,15 +305,34 @@ Return ONLY valid JSON matching this schema (no prose outside JSON):
 
     #### EDIT ABOVE TO INCLUDE IMAGES
 
-    content = create_lesson(
-        [
-            {"role": "system", "content": SYSTEM_MSG},
-            {"role": "user", "content": user_msg},
-        ],
-        max_tokens=12000,
-        debug=debug,
-    )
+    messages = [
+        {"role": "system", "content": SYSTEM_MSG},
+        {"role": "user", "content": user_msg},
+    ]
+    streamed_sections = []
+    if on_section is not None:
+        def collect(section):
+            streamed_sections.append(section)
+            on_section(section)
+
+        content = stream_lesson(messages, collect, max_tokens=12000, validate=json_sanitize)
+    else:
+        content = create_lesson(
+            messages,
+            max_tokens=12000,
+            debug=debug,
+            validate=json_sanitize,
+        )
     parsed = json_sanitize(content)
+    if not parsed and streamed_sections:
+        # Truncated stream: keep the sections that did arrive
+        return {
+            "title": f"{topic} — Learning Packet",
+            "learning_path": subtopics or [topic],
+            "sections": streamed_sections,
+            "summary": "",
+            "estimated_total_read_time_minutes": 3 * len(streamed_sections),
+        }
     if not parsed:
         # fail-soft: small skeleton so downstream doesn’t crash
         return {
@@ -216,6 +357,196 @@ Return ONLY valid JSON matching this schema (no prose outside JSON):
     return parsed
 
 
+# "single": the whole packet in one completion; "fanout": outline first, then one
+# request per section in parallel
+TEXTBOOK_MODE = os.getenv("TEXTBOOK_MODE", "single").lower()
+TEXTBOOK_FANOUT_WORKERS = int(os.getenv("TEXTBOOK_FANOUT_WORKERS", "6"))
+SECTION_RETRIES = int(os.getenv("TEXTBOOK_SECTION_RETRIES", "2"))
+
+OUTLINE_SCHEMA_HINT = {
+    "type": "object",
+    "required": ["title", "learning_path", "sections", "summary", "estimated_total_read_time_minutes"],
+    "properties": {
+        "title": {"type": "string"},
+        "learning_path": {"type": "array", "items": {"type": "string"}},
+        "sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["title", "focus"],
+                "properties": {
+                    "title": {"type": "string"},
+                    "focus": {"type": "string"},  # one sentence on what the section covers
+                },
+            },
+        },
+        "summary": {"type": "string"},
+        "estimated_total_read_time_minutes": {"type": "integer"},
+    },
+}
+
+SECTION_SCHEMA_HINT = {
+    "type": "object",
+    "required": SCHEMA_HINT["properties"]["sections"]["items"]["required"] + ["citations"],
+    "properties": dict(
+        SCHEMA_HINT["properties"]["sections"]["items"]["properties"],
+        citations={"type": "array", "items": {"type": "string"}},
+    ),
+}
+
+
+def _valid_outline(content):
+    parsed = json_sanitize(content)
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("sections"), list) or not parsed["sections"]:
+        return False
+    # Each entry must be an object with a title ("sections": ["Intro", ...] is not an outline)
+    return all(isinstance(s, dict) and isinstance(s.get("title"), str) and s["title"].strip() for s in parsed["sections"])
+
+
+def _valid_section(content):
+    parsed = json_sanitize(content)
+    return isinstance(parsed, dict) and all(k in parsed for k in ("title", "overview"))
+
+
+def _placeholder_section(title):
+    return {
+        "title": title,
+        "overview": "Content unavailable due to JSON parse or token limit.",
+        "key_points": [],
+        "formulas": [],
+        "derivations": "",
+        "diagram": {"caption": "—", "instructions": "—"},
+        "worked_example": {"prompt": "—", "steps": [], "answer": "—"},
+        "common_pitfalls": [],
+        "mini_quiz": [],
+    }
+
+
+# Generates one outlined section, retrying it alone if the response is unusable
+def _generate_section(topic, grade_level, outline, index, quiz_per_section, debug):
+    entry = outline["sections"][index]
+    others = [s.get("title", "") for i, s in enumerate(outline["sections"]) if i != index]
+    user_msg = f"""
+Write one section of a condensed, concise textbook-style packet for a {grade_level} student.
+
+Packet topic: "{topic}"
+Packet title: "{outline.get('title', topic)}"
+This section: "{entry.get('title', 'Section')}" — {entry.get('focus', '')}
+Other sections (do not repeat their content): {", ".join(others) or "—"}
+
+Constraints and style:
+- Clarity and density. Short paragraphs (plain text), precise definitions, minimal fluff.
+- 120-400 word overview, 3-6 key points, essential formulas (LaTeX ok),
+  1 worked example with steps, 1 small diagram described by text (caption + drawing instructions),
+  2-4 common pitfalls, and {quiz_per_section} mini-quiz Q/A.
+- Keep derivations brief (5-10 lines) only when essential.
+- DO NOT include URLs, references, or markdown in any field except 'citations'.
+
+Output:
+Return ONLY valid JSON matching this schema (no prose outside JSON):
+{json.dumps(SECTION_SCHEMA_HINT)}
+""".strip()
+
+    for attempt in range(SECTION_RETRIES + 1):
+        try:
+            content = create_lesson(
+                [
+                    {"role": "system", "content": SYSTEM_MSG},
+                    {"role": "user", "content": user_msg},
+                ],
+                # A retry changes the request slightly so it isn't the same completion again
+                temperature=0.2 + 0.1 * attempt,
+                max_tokens=3000,
+                debug=debug,
+                validate=_valid_section,
+            )
+        except RuntimeError as e:
+            tracing.log("section_failed", level="warning", section=index + 1, attempt=attempt + 1, error=str(e))
+            continue
+        if _valid_section(content):
+            return json_sanitize(content)
+        tracing.log("section_invalid_json", level="warning", section=index + 1, attempt=attempt + 1)
+    return _placeholder_section(entry.get("title", "Section"))
+
+
+# Outline-then-fan-out variant of find_textbook_packet; same result shape
+def find_textbook_packet_fanout(
+    topic, subtopics, grade_level, max_sections=6, quiz_per_section=3, debug=True, on_section=None
+):
+    """
+    Asks for a short outline, then generates each section with its own request in
+    parallel, so wall-clock time follows the slowest section rather than the
+    length of the whole packet. A failed section is retried on its own.
+    """
+    subtopics_txt = ", ".join(subtopics) if subtopics else "—"
+    user_msg = f"""
+Plan a condensed, concise textbook-style packet for a {grade_level} student.
+
+Primary topic: "{topic}"
+Focus subtopics (include and integrate): {subtopics_txt}
+
+- Logical learning order (prerequisites first).
+- At most {max_sections} sections, merging closely related subtopics.
+- For each section give only its title and a one-sentence focus.
+- The summary is 2-4 sentences covering the whole packet.
+- DO NOT include citations, URLs, references, or markdown.
+
+Output:
+Return ONLY valid JSON matching this schema (no prose outside JSON):
+{json.dumps(OUTLINE_SCHEMA_HINT)}
+""".strip()
+
+    content = create_lesson(
+        [
+            {"role": "system", "content": SYSTEM_MSG},
+            {"role": "user", "content": user_msg},
+        ],
+        max_tokens=1500,
+        debug=debug,
+        validate=_valid_outline,
+    )
+    outline = json_sanitize(content)
+    if not _valid_outline(content):
+        outline = {
+            "title": f"{topic} — Learning Packet",
+            "learning_path": subtopics or [topic],
+            "sections": [{"title": s, "focus": s} for s in (subtopics or [topic])],
+            "summary": "",
+            "estimated_total_read_time_minutes": 3,
+        }
+    outline["sections"] = outline["sections"][:max_sections]
+
+    with ThreadPoolExecutor(max_workers=TEXTBOOK_FANOUT_WORKERS, thread_name_prefix="textbook") as pool:
+        futures = [
+            pool.submit(tracing.bind(_generate_section), topic, grade_level, outline, i, quiz_per_section, debug)
+            for i in range(len(outline["sections"]))
+        ]
+        # Results are handed on in outline order, each as soon as it (and those before it) are ready
+        sections = []
+        for future in futures:
+            section = future.result()
+            sections.append(section)
+            if on_section is not None:
+                on_section(section)
+
+    # Citations move from the sections to the packet, de-duplicated in order
+    citations, seen = [], set()
+    for section in sections:
+        for url in section.pop("citations", None) or []:
+            if isinstance(url, str) and url.strip() and url.strip() not in seen:
+                seen.add(url.strip())
+                citations.append(url.strip())
+
+    return {
+        "title": outline.get("title") or f"{topic} — Learning Packet",
+        "learning_path": outline.get("learning_path") or [s["title"] for s in sections],
+        "sections": sections,
+        "summary": outline.get("summary", ""),
+        "estimated_total_read_time_minutes": outline.get("estimated_total_read_time_minutes", 3 * len(sections)),
+        "citations": citations,
+    }
+
+
 ########################################################################################
 # ----------------- Generates Practice Problems via Web Search -----------------
 ########################################################################################
@@ -234,7 +565,7 @@ Avoid: paywalled sites, copyrighted textbooks without open licenses, commercial
 """
 
 # Builds the messsages to query Perplexity Sonar
-def build_messages(topic, subtopics, grade_level, num_problems):
+def build_messages(topic, subtopics, grade_level, num_problems, exclude=()):
     subtopics_txt = ", ".join(subtopics) if subtopics else "—"
     today = datetime.today().strftime("%Y-%m-%d")
 
@@ -303,6 +634,12 @@ Important format rules:
         f'"{topic}" {" ".join(subtopics or [])} practice problems solutions'
     )
 
+    # Top-up requests must not return problems we already have
+    if exclude:
+        user += "\nAlready selected (do NOT return these again):\n" + "\n".join(
+            f"- {q[:160]}" for q in exclude
+        ) + "\n"
+
     return [
         {"role": "system", "content": system},
         {"role": "user", "content": user + "\n\n" + domain_bias},
@@ -320,50 +657,77 @@ def _strict_json_load(maybe_json: str):
         raise
 
 
+_URL_RE = re.compile(r"^https?://", re.I)
+
+# Returns why a single problem item is unusable, or None if it is fine
+def _item_problem(it):
+    if not isinstance(it, dict):
+        return "not an object"
+    for k in ["question", "solution", "source_title", "source_url", "license"]:
+        if k not in it or not isinstance(it[k], str) or not it[k].strip():
+            return f"missing/empty field: {k}"
+    if not _URL_RE.match(it["source_url"]):
+        return f"invalid source_url: {it['source_url']}"
+    # Basic verbatim sanity: avoid obvious paraphrase markers
+    if (
+        "paraphrase" in it["question"].lower()
+        or "paraphrase" in it["solution"].lower()
+    ):
+        return "looks paraphrased."
+    return None
+
+
 def _validate_items(items, num_expected):
     if not isinstance(items, list) or len(items) != num_expected:
         raise ValueError(
             f"Expected exactly {num_expected} items, got {len(items) if isinstance(items, list) else 'non-list'}"
         )
-    url_re = re.compile(r"^https?://", re.I)
     for i, it in enumerate(items, 1):
-        for k in ["question", "solution", "source_title", "source_url", "license"]:
-            if k not in it or not isinstance(it[k], str) or not it[k].strip():
-                raise ValueError(f"Item {i} missing/empty field: {k}")
-        if not url_re.match(it["source_url"]):
-            raise ValueError(f"Item {i} has invalid source_url: {it['source_url']}")
-        # Basic verbatim sanity: avoid obvious paraphrase markers
-        if (
-            "paraphrase" in it["question"].lower()
-            or "paraphrase" in it["solution"].lower()
-        ):
-            raise ValueError(f"Item {i} looks paraphrased.")
+        problem = _item_problem(it)
+        if problem:
+            raise ValueError(f"Item {i} {problem}")
     return True
 
-# Creates practice problems and solutions via Perplexity Sonar web search
-def create_practice_problems(
+
+# Keeps the usable items of a batch instead of rejecting the whole batch
+def _good_items(items, debug=False):
+    if not isinstance(items, list):
+        return []
+    good = []
+    for i, it in enumerate(items, 1):
+        problem = _item_problem(it)
+        if problem:
+            if debug:
+                tracing.log("problem_dropped", level="debug", item=i, reason=problem)
+            continue
+        good.append(it)
+    return good
+
+
+def _problem_fingerprint(it):
+    return " ".join(it["question"].lower().split())[:200]
+
+
+# Split practice problem retrieval into one request per subtopic
+PRACTICE_PROBLEMS_SHARDED = os.getenv("PRACTICE_PROBLEMS_SHARDED", "1").lower() not in ("0", "false", "no")
+PROBLEM_SHARD_WORKERS = int(os.getenv("PROBLEM_SHARD_WORKERS", "4"))
+# Extra requests for just the missing problems when shards come back short
+PROBLEM_TOPUP_ROUNDS = int(os.getenv("PROBLEM_TOPUP_ROUNDS", "2"))
+
+# One Perplexity request for `num_problems` problems; returns only the usable items
+def request_problems(
     topic,
     subtopics,
     grade_level,
     num_problems,
+    exclude=(),
     max_tokens=8000,
     temperature=0.2,
     debug=True,
 ):
-    """
-    Uses Perplexity Sonar to fetch EXACTLY `num_problems` practice problems with verbatim questions & solutions
-    from credible/open sources (preferring MIT OCW, OpenStax, and .edu problem sets).
-    Returns a Python list of dicts: [{question, solution, source_title, source_url, license}, ...]
-    """
     assert_api_key()
 
-    messages = build_messages(topic, subtopics, grade_level, num_problems)
-
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "content-type": "application/json",
-    }
+    messages = build_messages(topic, subtopics, grade_level, num_problems, exclude)
     payload = {
         "model": "sonar-pro",
         "messages": messages,
@@ -375,32 +739,105 @@ def create_practice_problems(
         "return_search_results": True,
     }
 
+    # Only cache batches that pass the full checks; partial batches are still used
+    content = llm_cache.cached_call(
+        "practice_problems",
+        payload,
+        lambda: _post_for_content(payload, debug),
+        lambda c: _validate_items(_strict_json_load(c), num_problems),
+    )
+
     try:
-        r = requests.post(PERPLEXITY_API_URL, json=payload, headers=headers, timeout=90)
-    except requests.exceptions.RequestException as e:
-        raise RuntimeError(f"HTTP request failed: {e}")
+        items = _strict_json_load(content)
+    except json.JSONDecodeError as e:
+        if debug:
+            tracing.log("problem_batch_unparseable", level="warning", error=str(e))
+        return []
+    return _good_items(items, debug)
 
-    if debug:
-        print(f"[perplexity] status={r.status_code}")
-        print(f"[perplexity] body head: {r.text[:800]}")
 
-    try:
-        r.raise_for_status()
-    except requests.HTTPError as he:
-        raise RuntimeError(f"API error {r.status_code}: {r.text}") from he
+# Splits num_problems across subtopics as evenly as possible (earlier ones get the remainder)
+def _shard_counts(subtopics, num_problems):
+    shards = list(subtopics[:num_problems])
+    counts = [num_problems // len(shards)] * len(shards)
+    for i in range(num_problems % len(shards)):
+        counts[i] += 1
+    return list(zip(shards, counts))
 
-    data = r.json()
-    if not isinstance(data, dict) or "choices" not in data or not data["choices"]:
-        raise RuntimeError(f"Unexpected response structure: {json.dumps(data)[:800]}")
 
-    content = data["choices"][0].get("message", {}).get("content", "")
-    if not content:
-        raise RuntimeError(f"No content returned: {json.dumps(data)[:800]}")
+# Creates practice problems and solutions via Perplexity Sonar web search
+@metrics.STAGE_SECONDS.time(stage="create_practice_problems")
+@tracing.traced("create_practice_problems")
+def create_practice_problems(
+    topic,
+    subtopics,
+    grade_level,
+    num_problems,
+    max_tokens=8000,
+    temperature=0.2,
+    debug=True,
+):
+    """
+    Uses Perplexity Sonar to fetch `num_problems` practice problems with verbatim questions & solutions
+    from credible/open sources (preferring MIT OCW, OpenStax, and .edu problem sets).
+    Returns a Python list of dicts: [{question, solution, source_title, source_url, license}, ...]
+
+    Retrieval is sharded per subtopic and run concurrently. Bad items are dropped
+    individually, and if the shards come back short a top-up request asks only for
+    the missing count. Raises RuntimeError only if no usable problem was found.
+    """
+    if num_problems <= 0:
+        return []
+
+    kwargs = dict(max_tokens=max_tokens, temperature=temperature, debug=debug)
+    if PRACTICE_PROBLEMS_SHARDED and len(subtopics) > 1 and num_problems > 1:
+        shards = _shard_counts(subtopics, num_problems)
+        with ThreadPoolExecutor(max_workers=PROBLEM_SHARD_WORKERS, thread_name_prefix="problems") as pool:
+            futures = [
+                pool.submit(tracing.bind(request_problems), topic, [sub], grade_level, count, **kwargs)
+                for sub, count in shards
+            ]
+            batches = []
+            for (sub, count), future in zip(shards, futures):
+                try:
+                    batches.append(future.result()[:count])
+                except RuntimeError as e:
+                    tracing.log("problem_shard_failed", level="warning", subtopic=sub, error=str(e))
+                    batches.append([])
+    else:
+        try:
+            batches = [request_problems(topic, subtopics, grade_level, num_problems, **kwargs)]
+        except RuntimeError as e:
+            tracing.log("problem_request_failed", level="warning", error=str(e))
+            batches = [[]]
+
+    # Interleave shards so every subtopic keeps its share, dropping duplicates
+    items, seen = [], set()
+    for round_items in zip(*[b + [None] * (num_problems - len(b)) for b in batches]):
+        for it in round_items:
+            if it is not None and _problem_fingerprint(it) not in seen:
+                seen.add(_problem_fingerprint(it))
+                items.append(it)
+
+    for _ in range(PROBLEM_TOPUP_ROUNDS):
+        missing = num_problems - len(items)
+        if missing <= 0:
+            break
+        try:
+            extra = request_problems(
+                topic, subtopics, grade_level, missing, exclude=[it["question"] for it in items], **kwargs
+            )
+        except RuntimeError as e:
+            tracing.log("problem_topup_failed", level="warning", missing=missing, error=str(e))
+            continue
+        for it in extra:
+            if len(items) < num_problems and _problem_fingerprint(it) not in seen:
+                seen.add(_problem_fingerprint(it))
+                items.append(it)
 
-    # Parse + validate strict JSON
-    items = _strict_json_load(content)
-    _validate_items(items, num_problems)
-    return items
+    if not items:
+        raise RuntimeError("No usable practice problems were returned")
+    return items[:num_problems]
 
 
 ##########################################################################################
@@ -423,6 +860,19 @@ def json_sanitize(s: str):
 
 # Converts the textbook JSON into markdown format (very rough)
 def textbook_json_to_markdown(packet: dict) -> str:
+    return "\n".join(textbook_markdown_chunks(packet))
+
+# The textbook markdown split into header, one chunk per section, and summary;
+# joining the chunks with newlines gives textbook_json_to_markdown's output
+def textbook_markdown_chunks(packet: dict) -> list[str]:
+    chunks = [textbook_header_markdown(packet)]
+    for section in packet.get("sections", []):
+        chunks.append(section_to_markdown(section))
+    if packet.get("summary"):
+        chunks.append(textbook_summary_markdown(packet))
+    return chunks
+
+def textbook_header_markdown(packet: dict) -> str:
     md = [f"# {packet.get('title', 'Learning Packet')}\n"]
     md.append(
         f"**Estimated reading time:** {packet.get('estimated_total_read_time_minutes', '~')} minutes\n"
@@ -430,55 +880,56 @@ def textbook_json_to_markdown(packet: dict) -> str:
     lp = packet.get("learning_path") or []
     if lp:
         md.append("**Learning order:** " + " → ".join(lp) + "\n")
-    for section in packet.get("sections", []):
-        md.append(f"## {section.get('title', 'Section')}\n")
-        if section.get("overview"):
-            md.append(section["overview"] + "\n")
-        if section.get("key_points"):
-            md.append("**Key points:**")
-            for p in section["key_points"]:
-                md.append(f"- {p}")
-        if section.get("formulas"):
-            md.append("**Formulas:**")
-            for f in section["formulas"]:
-                md.append(f"- `{f}`")
-        if section.get("derivations"):
-            md.append("**Sketch derivation:**")
-            md.append(section["derivations"])
-        if section.get("worked_example"):
-            ex = section["worked_example"]
-            md.append("\n**Worked Example:**")
-            if ex.get("prompt"):
-                md.append(f"*{ex['prompt']}*")
-            for step in ex.get("steps", []):
-                md.append(f"  - {step}")
-            if ex.get("answer"):
-                md.append(f"**Answer:** {ex['answer']}\n")
-        if section.get("diagram"):
-            d = section["diagram"]
-            md.append("**Diagram:** " + d.get("caption", ""))
-            if d.get("instructions"):
-                md.append("Instructions: " + d["instructions"])
-        if section.get("common_pitfalls"):
-            md.append("**Common Pitfalls:**")
-            for p in section["common_pitfalls"]:
-                md.append(f"- {p}")
-        if section.get("mini_quiz"):
-            md.append("**Quick Quiz:**")
-            for qa in section["mini_quiz"]:
-                md.append(f"- {qa.get('q', '')}  \n  **Ans:** {qa.get('a', '')}")
-        md.append("\n\n")
-    if packet.get("summary"):
-        md.append("## Summary\n" + packet["summary"])
+    return "\n".join(md)
+
+def textbook_summary_markdown(packet: dict) -> str:
+    return "## Summary\n" + packet["summary"]
+
+def section_to_markdown(section: dict) -> str:
+    md = [f"## {section.get('title', 'Section')}\n"]
+    if section.get("overview"):
+        md.append(section["overview"] + "\n")
+    if section.get("key_points"):
+        md.append("**Key points:**")
+        for p in section["key_points"]:
+            md.append(f"- {p}")
+    if section.get("formulas"):
+        md.append("**Formulas:**")
+        for f in section["formulas"]:
+            md.append(f"- `{f}`")
+    if section.get("derivations"):
+        md.append("**Sketch derivation:**")
+        md.append(section["derivations"])
+    if section.get("worked_example"):
+        ex = section["worked_example"]
+        md.append("\n**Worked Example:**")
+        if ex.get("prompt"):
+            md.append(f"*{ex['prompt']}*")
+        for step in ex.get("steps", []):
+            md.append(f"  - {step}")
+        if ex.get("answer"):
+            md.append(f"**Answer:** {ex['answer']}\n")
+    if section.get("diagram"):
+        d = section["diagram"]
+        md.append("**Diagram:** " + d.get("caption", ""))
+        if d.get("instructions"):
+            md.append("Instructions: " + d["instructions"])
+    if section.get("common_pitfalls"):
+        md.append("**Common Pitfalls:**")
+        for p in section["common_pitfalls"]:
+            md.append(f"- {p}")
+    if section.get("mini_quiz"):
+        md.append("**Quick Quiz:**")
+        for qa in section["mini_quiz"]:
+            md.append(f"- {qa.get('q', '')}  \n  **Ans:** {qa.get('a', '')}")
+    md.append("\n\n")
     return "\n".join(md)
 
 # Use perplixity to fix markdown (attempted but didn't work well)
+@metrics.STAGE_SECONDS.time(stage="fix_markdown")
+@tracing.traced("fix_markdown")
 def fix_markdown(markdown: str) -> str:
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "content-type": "application/json",
-    }
+    assert_api_key()
     payload = {
         "model": "sonar-pro",
         "messages": [
@@ -504,11 +955,15 @@ def fix_markdown(markdown: str) -> str:
         # "web_search_options": {"search_type": "pro"},
     }
 
-    r = requests.post(PERPLEXITY_API_URL, headers=headers, json=payload, timeout=90)
-    r.raise_for_status()
-    content = r.json()["choices"][0]["message"]["content"].strip()
+    def fetch():
+        r = perplexity_post(payload, timeout=90)
+        r.raise_for_status()
+        data = r.json()
+        metrics.record_usage("perplexity", data.get("usage"))
+        content = data["choices"][0]["message"]["content"].strip()
+        return content[len("```markdown\n") : -len("```")].strip() if content.startswith("```markdown") else content
 
-    return content[len("```markdown\n") : -len("```")].strip() if content.startswith("```markdown") else content
+    return llm_cache.cached_call("fix_markdown", payload, fetch)
 
 
 # Fix numbering
@@ -534,268 +989,412 @@ def strip_leading_numbering(text: str) -> str:
 
 MATH_CMDS = r"(vec|frac|cdot|times|ldots|nabla|partial|sqrt|sum|prod|int|lim|log|ln|sin|cos|tan|alpha|beta|gamma|Delta|leq|geq|pm)"
 
+# Patterns used by sanitize_markdown_for_latex, compiled once
+CODE_FENCE_SPLIT_RE = re.compile(r"(```.*?```)", re.S)
+PAREN_MATH_RE = re.compile(r"\\\((.*?)\\\)", re.S)
+BRACKET_MATH_RE = re.compile(r"\\\[(.*?)\\\]", re.S)
+MATH_CMD_RE = re.compile(rf"\\{MATH_CMDS}\b")
+DISPLAY_MATH_SPLIT_RE = re.compile(r"(\$\$.*?\$\$)", re.S)
+INLINE_MATH_SPLIT_RE = re.compile(r"(\$.*?\$)", re.S)
+
+
+def _escape_latex(s: str) -> str:
+    # Escape: \, {, }, $, &, #, _, %, ~, ^ (backslash first so added ones aren't doubled)
+    s = s.replace("\\", r"\\")
+    s = s.replace("{", r"\{").replace("}", r"\}")
+    s = s.replace("&", r"\&").replace("#", r"\#").replace("%", r"\%")
+    s = s.replace("_", r"\_").replace("$", r"\$")
+    s = s.replace("~", r"\textasciitilde{}").replace("^", r"\textasciicircum{}")
+    return s
+
+
 # Fix markdown for LaTeX conversion
+@tracing.traced("sanitize")
 def sanitize_markdown_for_latex(md: str) -> str:
     """
     Preflight sanitizer to reduce LaTeX build errors from Pandoc.
     - Normalizes math delimiters to $...$ (inline) and $$...$$ (display)
     - Ensures math commands are in math mode
     - Escapes LaTeX special chars in non-math, non-code
+    - Balances a lone $ on a line
+
+    Code fences are copied through untouched. Output matches the original
+    multi-pass version (benchmarks/sanitize_reference.py) character for character.
     """
-    import re
-
-    # Split into code fences so we don't touch code blocks
-    fence_pat = re.compile(r"(?s)(```.*?```)")
-    parts = fence_pat.split(md)
-
-    def _normalize_math_delims(text: str) -> str:
-        # Convert \(...\) -> $...$ and \[...\] -> $$...$$
-        text = re.sub(r"\\\((.*?)\\\)", r"$\1$", text, flags=re.S)
-        text = re.sub(r"\\\[(.*?)\\\]", r"$$\1$$", text, flags=re.S)
-
-        # Ensure there is no mix of $$ inside inline runs; leave $$...$$ alone
-        return text
-
-    def _force_math_for_cmds(text: str) -> str:
-        # If a line contains a math command but no $ or $$, wrap the minimal span in $...$
-        out_lines = []
-        for ln in text.splitlines():
-            if "$" in ln or "$$" in ln:
-                out_lines.append(ln)
-                continue
-            if re.search(rf"\\{MATH_CMDS}\b", ln):
-                out_lines.append(f"${ln}$")
-            else:
-                out_lines.append(ln)
-        return "\n".join(out_lines)
-
-    def _escape_latex_specials(text: str) -> str:
-        # Do not escape inside math ($...$ or $$...$$). Split by math spans first.
-        # Order: $$...$$ first (display), then $...$ (inline)
-        def esc(s: str) -> str:
-            # Escape: \, {, }, $, &, #, _, %, ~, ^
-            s = s.replace("\\", r"\\")
-            s = s.replace("{", r"\{").replace("}", r"\}")
-            s = s.replace("&", r"\&").replace("#", r"\#").replace("%", r"\%")
-            s = s.replace("_", r"\_").replace("$", r"\$")
-            s = s.replace("~", r"\textasciitilde{}").replace("^", r"\textasciicircum{}")
-            return s
-
-        # Split on $$...$$
-        disp_split = re.split(r"(\$\$.*?\$\$)", text, flags=re.S)
-        disp_out = []
-        for chunk in disp_split:
-            if chunk.startswith("$$") and chunk.endswith("$$"):
-                disp_out.append(chunk)  # leave math unchanged
-            else:
-                # Now split this chunk on inline $...$
-                inl_split = re.split(r"(\$.*?\$)", chunk, flags=re.S)
-                for sub in inl_split:
-                    if sub.startswith("$") and sub.endswith("$"):
-                        disp_out.append(sub)  # inline math unchanged
-                    else:
-                        disp_out.append(esc(sub))
-        return "".join(disp_out)
-
-    def _balance_dollars(text: str) -> str:
-        # Very conservative: if a line has an odd number of $ (and not $$),
-        # append one $ at the end to balance. Skip lines already containing $$.
-        fixed = []
-        for ln in text.splitlines():
-            if "$$" in ln:
-                fixed.append(ln)
-                continue
-            if ln.count("$") % 2 == 1:
-                fixed.append(ln + "$")
-            else:
-                fixed.append(ln)
-        return "\n".join(fixed)
-
-    out = []
-    for i, part in enumerate(parts):
-        if i % 2 == 1:
-            # code fence: leave exactly as-is
-            out.append(part)
-        else:
-            t = part
-            t = _normalize_math_delims(t)
-            t = _force_math_for_cmds(t)
-            t = _escape_latex_specials(t)
-            t = _balance_dollars(t)
-            out.append(t)
-    return "".join(out)
-
-# Converts markdown to PDF via Pandoc + XeLaTeX
+    parts = CODE_FENCE_SPLIT_RE.split(md)
+    for i in range(0, len(parts), 2):
+        parts[i] = _sanitize_text(parts[i])
+    return "".join(parts)
+
+
+def _sanitize_text(text: str) -> str:
+    # Convert \(...\) -> $...$ and \[...\] -> $$...$$
+    if "\\" in text:
+        text = PAREN_MATH_RE.sub(r"$\1$", text)
+        text = BRACKET_MATH_RE.sub(r"$$\1$$", text)
+
+    # If a line contains a math command but no $, wrap the whole line in $...$
+    lines = text.splitlines()
+    if "\\" in text and MATH_CMD_RE.search(text):
+        for i, ln in enumerate(lines):
+            if "$" not in ln and MATH_CMD_RE.search(ln):
+                lines[i] = f"${ln}$"
+    text = "\n".join(lines)
+
+    # Escape everything outside $$...$$ and $...$ spans (one split per level)
+    if "$" not in text:
+        return "\n".join(_escape_latex(text).splitlines())
+    pieces = []
+    plain = []  # indexes into pieces of the text that needs escaping
+    for i, chunk in enumerate(DISPLAY_MATH_SPLIT_RE.split(text)):
+        if i % 2 == 1 or (chunk.startswith("$$") and chunk.endswith("$$")):
+            pieces.append(chunk)
+            continue
+        for j, sub in enumerate(INLINE_MATH_SPLIT_RE.split(chunk)):
+            # A leftover lone "$" between spans counts as math, as it always has
+            if j % 2 == 0 and not (sub.startswith("$") and sub.endswith("$")):
+                plain.append(len(pieces))
+            pieces.append(sub)
+
+    # Escape all plain pieces in one go, joined on a character the escapes never touch
+    if "\0" in text:
+        for i in plain:
+            pieces[i] = _escape_latex(pieces[i])
+    else:
+        escaped = _escape_latex("\0".join([pieces[i] for i in plain])).split("\0")
+        for i, piece in zip(plain, escaped):
+            pieces[i] = piece
+
+    # A line with an odd number of $ (and no $$) gets one appended
+    lines = "".join(pieces).splitlines()
+    for i, ln in enumerate(lines):
+        if "$" in ln and "$$" not in ln and ln.count("$") % 2 == 1:
+            lines[i] = ln + "$"
+    return "\n".join(lines)
+
+
+# Converts markdown to PDF via Pandoc + XeLaTeX on the shared render workers
 def markdown_to_pdf(md_text, output_path="output.pdf"):
-    header_tex = r"""
-\usepackage{amsmath,amssymb,mathtools}
-\usepackage{unicode-math}
-\usepackage{physics}
-\usepackage{siunitx}
-"""
-    import tempfile, os
-
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".tex", delete=False) as hf:
-        hf.write(header_tex)
-        header_path = hf.name
-
-    try:
-        pypandoc.get_pandoc_version()
-        pypandoc.convert_text(
-            md_text,
-            to="pdf",
-            # ✅ switch away from gfm
-            format="markdown+tex_math_dollars+raw_tex",
-            outputfile=output_path,
-            extra_args=[
-                "--standalone",
-                "--pdf-engine=xelatex",
-                "--include-in-header",
-                header_path,
-                "-V",
-                "geometry:margin=1in",
-                "--log=build.log",
-            ],
-        )
-    finally:
-        try:
-            os.remove(header_path)
-        except:
-            pass
+    render.render_pdf(md_text, str(output_path))
 
 # Use Gemini to really fix markdown since Perplexity didn't work well
+@metrics.STAGE_SECONDS.time(stage="actually_fix_markdown")
+@tracing.traced("actually_fix_markdown")
 def actually_fix_markdown(md):
-    client = genai.Client()
+    request = {
+        "model": "gemini-2.5-flash",
+        "contents": f"Fix the syntax errors in the following markdown code, return only the markdown code, make sure that when '$' signs are enclosing a math equation, there is no space between the '$' and the equation it encloses. For example, '$ x $' is wrong and should be '$x$'.: \n\n{md}",
+    }
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=f"Fix the syntax errors in the following markdown code, return only the markdown code, make sure that when '$' signs are enclosing a math equation, there is no space between the '$' and the equation it encloses. For example, '$ x $' is wrong and should be '$x$'.: \n\n{md}",
-    )
+    def fetch():
+        response = gemini_generate(**request)
+        return response.text[len("```markdown") : -len("```")].strip() if response.text.startswith("```markdown") else response.text.strip()
 
-    return response.text[len("```markdown") : -len("```")].strip() if response.text.startswith("```markdown") else response.text.strip()
+    return llm_cache.cached_call("actually_fix_markdown", request, fetch)
 
-# Function that ties everything together
-def search_topic(topic, subtopics, grade_level, num_problems):
-    try:
-        # Get textbook packet
-        pkt = find_textbook_packet(
-            topic=topic,
-            subtopics=subtopics,
-            grade_level=grade_level,
-            max_sections=len(subtopics) + 2,
-            quiz_per_section=3,
-            debug=False,  # prints HTTP status and body head
-        )
-        md = textbook_json_to_markdown(pkt)
+PAGEBREAK = "\n\n\\newpage\n\n"
+PREVIEW_BREAK = "\n\n---\n\n"
 
-        # Create practice problems
-        problems = create_practice_problems(
-            topic=topic,
-            subtopics=subtopics,
-            grade_level=grade_level,
-            num_problems=num_problems,
-            debug=False,
-        )
+# Cleans practice problems into markdown format
+def problems_to_markdown(problems):
+    """Returns (questions_md, solutions_md, source_lines) for a list of practice problems."""
+    problems_questions = ["# Practice Problems", ""]
+    problems_solutions = ["# Solutions", ""]
+    source_lines = []
 
-        # Cleans practice problems into markdown format
-        PAGEBREAK = "\n\n\\newpage\n\n"
+    for i, p in enumerate(problems, 1):
+        q = strip_leading_numbering(p["question"])
+        s = strip_leading_numbering(p["solution"])
 
-        problems_questions = ["# Practice Problems", ""]
-        problems_solutions = ["# Solutions", ""]
-        problems_sources = ["# Sources", ""]
+        # Use headings for stable numbering (avoids Markdown ordered-list quirks with math blocks)
+        problems_questions.append(f"## Problem {i}")
+        problems_questions.append(q)
+        problems_questions.append("")  # spacer
 
-        for i, p in enumerate(problems, 1):
-            q = strip_leading_numbering(p["question"])
-            s = strip_leading_numbering(p["solution"])
+        problems_solutions.append(f"## Problem {i}")
+        problems_solutions.append(s)
+        problems_solutions.append("")
 
-            # Use headings for stable numbering (avoids Markdown ordered-list quirks with math blocks)
-            problems_questions.append(f"## Problem {i}")
-            problems_questions.append(q)
-            problems_questions.append("")  # spacer
+        source_lines.append(
+            f"- {p['source_title']} — {p['source_url']} | {p['license']}"
+        )
+    source_lines.append("")
+    source_lines.append("")
+
+    questions_md = "\n\n\n".join(problems_questions)
+    solutions_md = "\n\n\n".join(problems_solutions)
+    return questions_md, solutions_md, source_lines
+
+# Builds the sources page from problem sources and textbook citations
+def sources_to_markdown(source_lines, citations):
+    problems_sources = list(source_lines)
+
+    # --- textbook citations ---
+    for url in citations or []:
+        if isinstance(url, str) and url.strip():
+            problems_sources.append(f"- {url.strip()}")
+
+    # De-duplicate identical lines while preserving order
+    seen = set()
+    deduped_sources = ["# Sources", ""]
+    for line in problems_sources:
+        if line not in seen:
+            deduped_sources.append(line)
+            seen.add(line)
+
+    deduped_sources.append("")  # trailing newline
+    return "\n".join(deduped_sources)
+
+# Maps pipeline stages onto the coarser progress stages reported to clients
+PROGRESS_STAGES = {
+    "textbook": "textbook",
+    "problems": "practice_problems",
+    "fix_textbook": "markdown_repair",
+    "fix_questions": "markdown_repair",
+    "fix_solutions": "markdown_repair",
+    "final_fix": "markdown_repair",
+    "preview": "preview",
+    "render": "pdf_render",
+}
 
-            problems_solutions.append(f"## Problem {i}")
-            problems_solutions.append(s)
-            problems_solutions.append("")
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "4"))
+# "local": deterministic repairs checked with pandoc, LLM only for fragments that
+# still fail; "llm": every part goes through fix_markdown / actually_fix_markdown
+REPAIR_MODE = os.getenv("REPAIR_MODE", "local").lower()
+# "eager": the job waits for the PDF; "background": the job finishes once the HTML
+# preview is ready and the PDF builds afterwards; "lazy": the PDF is only built
+# when someone first downloads it
+PDF_RENDER_MODE = os.getenv("PDF_RENDER_MODE", "background").lower()
+# Stream the textbook and repair each section as it arrives
+TEXTBOOK_STREAMING = os.getenv("TEXTBOOK_STREAMING", "0").lower() in ("1", "true", "yes")
+# How the textbook JSON becomes part of the packet: "markdown" goes through
+# repair and sanitize like the rest; "latex" writes escaped LaTeX / HTML raw
+# blocks straight from the JSON, so the textbook skips repair entirely
+TEXTBOOK_RENDERER = os.getenv("TEXTBOOK_RENDERER", "markdown").lower()
+TEXTBOOK_RENDERERS = {
+    "markdown": textbook_json_to_markdown,
+    "latex": textbook_render.textbook_to_raw_markdown,
+}
+# Renderers whose output is final and skips the repair stages
+TEXTBOOK_EMITTERS = {"latex"}
 
-            problems_sources.append(
-                f"- {p['source_title']} — {p['source_url']} | {p['license']}"
+# Function that ties everything together
+def search_topic(topic, subtopics, grade_level, num_problems, progress=None, on_metric=None):
+    """
+    Runs the whole packet pipeline and returns (pdf_filename, timings).
+    pdf_filename is None on failure; timings maps each stage to its start offset
+    and duration in seconds. Packets are named by the hash of their markdown (see
+    pdf_store), so an identical packet reuses the files already stored.
+
+    Independent stages run concurrently: the textbook and the practice problems
+    are fetched at the same time, and each part is repaired as soon as it arrives.
+    `progress(stage, state)` is called as each stage starts and finishes so callers
+    (e.g. the background job runner) can report it; `on_metric(name, value)`
+    receives measurements such as time_to_first_section.
+
+    The assembled markdown is saved and rendered to an HTML preview; whether the
+    PDF is built before returning, in the background, or on first download is
+    set by PDF_RENDER_MODE.
+    """
+    if progress is None:
+        progress = lambda stage, state="running": None
+    if on_metric is None:
+        on_metric = lambda name, value: None
+
+    # Fixing markdown formatting, then sanitize for LaTeX robustness. Returns
+    # (markdown for the PDF, markdown for the preview): the preview is rendered
+    # from the text before sanitizing, whose TeX escapes HTML can't show
+    def repair(md):
+        if REPAIR_MODE == "llm":
+            fixed = fix_markdown(md)
+        else:
+            fixed = markdown_repair.repair_markdown(md, llm_fix=fix_markdown)
+        return sanitize_markdown_for_latex(fixed), fixed
+
+    def textbook(_):
+        # Get textbook packet. When streaming (or fanning out per section), each
+        # section is repaired on its own as soon as it arrives, while later
+        # sections are still being generated. Only the local repairer does that:
+        # with REPAIR_MODE=llm it would cost one fix_markdown call per section
+        # (plus header and summary) instead of one for the whole textbook.
+        section_repairs = []
+        pool = None
+        streaming = TEXTBOOK_STREAMING or TEXTBOOK_MODE == "fanout"
+        if streaming and TEXTBOOK_RENDERER not in TEXTBOOK_EMITTERS and REPAIR_MODE != "llm":
+            pool = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="section")
+        started = time.perf_counter()
+        first = []
+
+        def on_section(section):
+            if not first:
+                first.append(section)
+                on_metric("time_to_first_section", round(time.perf_counter() - started, 3))
+            if pool is not None:
+                section_repairs.append(pool.submit(tracing.bind(repair), section_to_markdown(section)))
+
+        try:
+            pkt = find_textbook_packet(
+                topic=topic,
+                subtopics=subtopics,
+                grade_level=grade_level,
+                max_sections=len(subtopics) + 2,
+                quiz_per_section=3,
+                debug=False,  # prints HTTP status and body head
+                on_section=on_section if streaming else None,
             )
-        problems_sources.append("")
-
-        problems_sources.append("")
-
-        questions_md = "\n\n\n".join(problems_questions)
-        solutions_md = "\n\n\n".join(problems_solutions)
-        
-        # --- textbook citations ---
-        textbook_citations = pkt.get("citations") or []
-        for url in textbook_citations:
-            if isinstance(url, str) and url.strip():
-                problems_sources.append(f"- {url.strip()}")
-
-        # De-duplicate identical lines while preserving order
-        seen = set()
-        deduped_sources = ["# Sources", ""]
-        for line in problems_sources[2:]:
-            if line not in seen:
-                deduped_sources.append(line)
-                seen.add(line)
-
-        problems_sources = deduped_sources
-        problems_sources.append("")  # trailing newline
-        sources_md = "\n".join(problems_sources)
-
-        # Fixing markdown formatting
-        # fixed_main_md = fix_markdown(md)  # your textbook part
-        # # fixed_q_md    = ensure_math_mode(fix_markdown(questions_md))
-        # # fixed_s_md    = ensure_math_mode(fix_markdown(solutions_md))
-        # fixed_q_md    = fix_markdown(questions_md)
-        # fixed_s_md    = fix_markdown(solutions_md)
-        fixed_main_md = fix_markdown(md)
-        fixed_q_md = fix_markdown(questions_md)
-        fixed_s_md = fix_markdown(solutions_md)
-
-        # Sanitize for LaTeX robustness
-        fixed_main_md = sanitize_markdown_for_latex(fixed_main_md)
-        fixed_q_md = sanitize_markdown_for_latex(fixed_q_md)
-        fixed_s_md = sanitize_markdown_for_latex(fixed_s_md)
-        # no need to run on sources
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+        # Only usable if the parsed packet has exactly the sections that streamed in
+        if len(section_repairs) != len(pkt.get("sections", [])):
+            section_repairs = None
+        to_markdown = TEXTBOOK_RENDERERS.get(TEXTBOOK_RENDERER, textbook_json_to_markdown)
+        return pkt, to_markdown(pkt), section_repairs or None
 
+    def problems(_):
+        # Create practice problems
+        items = create_practice_problems(
+            topic=topic,
+            subtopics=subtopics,
+            grade_level=grade_level,
+            num_problems=num_problems,
+            debug=False,
+        )
+        return problems_to_markdown(items)
+
+    def fix_textbook(deps):
+        pkt, md, section_repairs = deps["textbook"]
+        if TEXTBOOK_RENDERER in TEXTBOOK_EMITTERS:
+            return md, None  # escaped per field already, nothing to repair
+        if section_repairs is None:
+            return repair(md)
+        chunks = [repair(textbook_header_markdown(pkt))]
+        chunks += [f.result() for f in section_repairs]
+        if pkt.get("summary"):
+            chunks.append(repair(textbook_summary_markdown(pkt)))
+        latex, preview = zip(*chunks)
+        return "\n".join(latex), "\n".join(preview)
+
+    def fix_questions(deps):
+        return repair(deps["problems"][0])
+
+    def fix_solutions(deps):
+        return repair(deps["problems"][1])
+
+    # no need to run sanitize on sources
+    def sources(deps):
+        return sources_to_markdown(deps["problems"][2], deps["textbook"][0].get("citations"))
+
+    def final_fix(deps):
         # ----- Assemble final document with explicit breaks between blocks -----
         packet_md = (
-            fixed_main_md
-            + PAGEBREAK
-            + fixed_q_md
+            deps["fix_questions"][0]
             + PAGEBREAK
-            + fixed_s_md
+            + deps["fix_solutions"][0]
             + PAGEBREAK
-            + sources_md
+            + sources(deps)
         )
-
-        # Hash for unique filename
-        if 'user_id' in session:
-            user_part = str(session['user_id'])
+        # An emitted textbook is already final, so it stays out of the last pass
+        emitted = TEXTBOOK_RENDERER in TEXTBOOK_EMITTERS
+        if not emitted:
+            packet_md = deps["fix_textbook"][0] + PAGEBREAK + packet_md
+        if REPAIR_MODE == "llm":
+            packet_md = actually_fix_markdown(packet_md)
         else:
-            user_part = "anon"
+            # Restores the heading markers sanitize escaped; Gemini only sees what still fails
+            packet_md = markdown_repair.repair_markdown(packet_md, llm_fix=actually_fix_markdown)
+        return deps["fix_textbook"][0] + PAGEBREAK + packet_md if emitted else packet_md
+
+    # The same packet from the unsanitized parts, with rules between the blocks.
+    # An emitted textbook is left out: it goes in as its own escaped HTML.
+    def preview_markdown(deps):
+        parts = [deps[name][1] for name in ("fix_textbook", "fix_questions", "fix_solutions")]
+        return PREVIEW_BREAK.join([p for p in parts if p is not None] + [sources(deps)])
+
+    def preview(deps):
+        # Keep the markdown for on-demand PDF builds, and render the HTML preview.
+        # An identical packet built before already has both.
+        emitted = TEXTBOOK_RENDERER in TEXTBOOK_EMITTERS
+        pdf_name = pdf_store.packet_name(deps["final_fix"])
+        if pdf_store.save_source(pdf_name, deps["final_fix"]) and pdf_store.preview_file(pdf_name).is_file():
+            return pdf_name
+        try:
+            render.render_html(
+                preview_markdown(deps),
+                pdf_store.preview_file(pdf_name, create=True),
+                pdf_url=f"/static/pdfs/{pdf_name}",
+                trusted_html=textbook_render.textbook_to_html(deps["textbook"][0]) if emitted else None,
+            )
+        except (OSError, RuntimeError) as e:
+            tracing.log("preview_failed", level="warning", error=str(e))
+            return None
+        return pdf_name
+
+    def render_pdf_file(md):
+        pdf_name = pdf_store.packet_name(md)
+        if not pdf_store.pdf_file(pdf_name).is_file():
+            markdown_to_pdf(md, output_path=pdf_store.pdf_file(pdf_name, create=True))
+        return pdf_name
+
+    def render_stage(deps):
+        return render_pdf_file(deps["final_fix"])
+
+    stages = {
+        "textbook": ((), textbook),
+        "problems": ((), problems),
+        "fix_textbook": (("textbook",), fix_textbook),
+        "fix_questions": (("problems",), fix_questions),
+        "fix_solutions": (("problems",), fix_solutions),
+        "final_fix": (
+            ("textbook", "problems", "fix_textbook", "fix_questions", "fix_solutions"),
+            final_fix,
+        ),
+        "preview": (("textbook", "problems", "fix_textbook", "fix_questions", "fix_solutions", "final_fix"), preview),
+    }
+    if PDF_RENDER_MODE == "eager":
+        stages["render"] = (("final_fix",), render_stage)
 
-        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
-        seed_bytes = f"{user_part}:{stamp}".encode("utf-8")
-        hashed_part = sha256(seed_bytes).hexdigest()
+    # Several pipeline stages share one progress stage; it is done once all of them are
+    pending = {}
+    for name in stages:
+        pending.setdefault(PROGRESS_STAGES[name], set()).add(name)
 
-        fixed_packet_md = actually_fix_markdown(packet_md)
+    def on_start(name):
+        progress(PROGRESS_STAGES[name])
 
-        # open("test.md", "w").write(fixed_packet_md)
+    def on_done(name):
+        stage = PROGRESS_STAGES[name]
+        pending[stage].discard(name)
+        if not pending[stage]:
+            progress(stage, "done")
 
-        markdown_to_pdf(
-            fixed_packet_md,
-            output_path=f'{BASE_PATH}/static/pdfs/{hashed_part}.pdf',
+    timings = {}
+    try:
+        results, timings = run_stages(
+            stages, max_workers=PIPELINE_WORKERS, on_start=on_start, on_done=on_done
         )
+        for name, timing in timings.items():
+            metrics.PIPELINE_STAGE_SECONDS.observe(timing["seconds"], stage=name)
+        pdf_name = pdf_store.packet_name(results["final_fix"])
+        # Without a preview there is nothing to show until the PDF exists
+        if PDF_RENDER_MODE == "eager" or results["preview"] is None:
+            if "render" not in results:
+                progress("pdf_render")
+                render_pdf_file(results["final_fix"])
+                progress("pdf_render", "done")
+        elif PDF_RENDER_MODE == "background":
+            render.ensure_pdf(
+                pdf_store.source_file(pdf_name), pdf_store.pdf_file(pdf_name, create=True), wait=False
+            )
+        return pdf_name, timings
 
-        return f'{hashed_part}.pdf'
-
+    except StageError as e:
+        tracing.log("packet_failed", level="error", stage=e.stage, error=str(e.error), timings=e.timings)
+        return None, e.timings
     except Exception as e:
-        print("\n[FATAL]", e)
-        return None
+        tracing.log("packet_failed", level="error", error=f"{type(e).__name__}: {e}", timings=timings)
+        return None, timings
 
 
 # Test usage:
@@ -21,24 +21,44 @@ window.addEventListener("load", async () => {
             formData.append('guide-prompt', input.value);
             formData.append('exercise-count', document.getElementById("exercise-count").value);
             formData.append('grade-level', document.getElementById("grade-level").value);
+            if (document.getElementById("regenerate").checked) {
+                formData.append('regenerate', '1');
+            }
 
             const response = await fetch("/create", {
                 method: "POST",
                 body: formData
             });
 
-            const data = await response.json();
-            
-            if (data["pdf_path"] === null) {  // An error occurred
+            const job = await response.json();
+
+            if (!response.ok || !job["job_id"]) {  // Could not queue the job
+                alert(job["message"] || "Something went wrong, please try again.");
+                loading.style.display = "none";
+                return;
+            }
+
+            // Follow the job's progress until the packet is ready
+            const data = await waitForJob(job);
+
+            if (data["status"] !== "done" || !data["result"] || !data["result"]["pdf_path"]) {  // An error occurred
                 alert("Something went wrong, please try again.");
                 loading.style.display = "none";
                 return;
             }
 
             loading.style.display = "none";
-            const url = data["pdf_path"];
+            const url = data["result"]["pdf_path"];
 
-            pdfViewer.src = `/static/pdfs/${url}`;
+            // Show the HTML preview straight away; it links to the PDF, which is built on demand
+            // Previews are sandboxed; browsers won't show PDFs in a sandboxed frame
+            const previewUrl = data["result"]["preview_url"];
+            if (previewUrl) {
+                pdfViewer.setAttribute("sandbox", "allow-top-navigation-by-user-activation");
+            } else {
+                pdfViewer.removeAttribute("sandbox");
+            }
+            pdfViewer.src = previewUrl || `/static/pdfs/${url}`;
             closeCreate.click();
 
             // Use timeout to give the close button on the create page enough time to fully interact
@@ -49,6 +69,46 @@ window.addEventListener("load", async () => {
         }
     });
 
+    // Resolves with the final job snapshot, using Server-Sent Events and falling back to polling
+    function waitForJob(job) {
+        return new Promise((resolve) => {
+            const poll = async () => {
+                const res = await fetch(job["status_url"]);
+                const data = await res.json();
+                if (data["status"] === "done" || data["status"] === "error" || !res.ok) {
+                    resolve(data);
+                } else {
+                    setTimeout(poll, 2000);
+                }
+            };
+
+            if (!window.EventSource) {
+                poll();
+                return;
+            }
+
+            const events = new EventSource(job["events_url"]);
+            const finish = (event) => {
+                events.close();
+                resolve(JSON.parse(event.data));
+            };
+            events.addEventListener("running", (event) => {
+                const data = JSON.parse(event.data);
+                const current = Object.keys(data["stages"]).find((name) => data["stages"][name] === "running");
+                if (current) loading.title = current.replace("_", " ");
+            });
+            events.addEventListener("done", finish);
+            events.addEventListener("error", (event) => {
+                if (event.data) {
+                    finish(event);
+                } else {  // Connection dropped, carry on by polling
+                    events.close();
+                    poll();
+                }
+            });
+        });
+    }
+
     searchInput.addEventListener('input', async function(event) {
         if (!searchInput.value.trim()) { // trim removes all whitespace
             for (const el of pdfsList.children) {
@@ -0,0 +1,365 @@
+import re
+import html
+import pypandoc
+
+# Writes the textbook JSON straight to LaTeX (for the PDF) and HTML (for the
+# preview) instead of going through markdown. Every field is escaped for the
+# target on its own, so the result needs no repair: pandoc passes the LaTeX
+# through untouched as a raw block, and the HTML goes into the preview as is.
+
+# Same commands sanitize_markdown_for_latex treats as math when a line has no '$'
+MATH_CMD_RE = re.compile(
+    r"\\(vec|frac|cdot|times|ldots|nabla|partial|sqrt|sum|prod|int|lim|log|ln|sin|cos|tan|alpha|beta|gamma|Delta|leq|geq|pm)\b"
+)
+
+# Math and the bits of markdown the model still slips into "plain text" fields
+INLINE_RE = re.compile(
+    r"(?<!\\)\$\$(?P<display>.+?)(?<!\\)\$\$"
+    r"|\\\[(?P<display2>.+?)\\\]"
+    # pandoc's rules: no space inside either '$', and no digit right after the
+    # closing one, so "costs $5 and $10" stays text
+    r"|(?<!\\)\$(?!\s)(?P<math>[^$]+?)(?<![\s\\])\$(?!\d)"
+    r"|\\\((?P<math2>.+?)\\\)"
+    r"|\*\*(?P<strong>[^*\n]+?)\*\*"
+    r"|(?<![*\w])\*(?P<em>[^*\s](?:[^*\n]*?[^*\s])?)\*(?![*\w])"
+    r"|`(?P<code>[^`\n]+)`",
+    re.S,
+)
+BLANK_LINE_RE = re.compile(r"\n[ \t]*\n")
+# %, # and & that aren't already escaped (an even run of backslashes before them)
+MATH_SPECIAL_RE = re.compile(r"(?<!\\)((?:\\\\)*)([%#&])")
+# A run of 4+ letters that isn't a \command: prose, not a formula
+WORD_RE = re.compile(r"(?<![\\A-Za-z])[A-Za-z]{4,}")
+# The math spans html_inline / section_to_html write, and what pandoc makes of them
+MATH_SPAN_RE = re.compile(r'<span class="math (inline|display)">\\[(\[](.*?)\\[)\]]</span>', re.S)
+PARAGRAPH_RE = re.compile(r"<p>(.*?)</p>", re.S)
+# Only math is read; anything else in a body stays escaped text
+MATHML_FORMAT = "markdown+tex_math_dollars-raw_html-raw_tex-raw_attribute"
+
+LATEX_ESCAPES = {
+    "\\": r"\textbackslash{}",
+    "{": r"\{",
+    "}": r"\}",
+    "$": r"\$",
+    "&": r"\&",
+    "#": r"\#",
+    "_": r"\_",
+    "%": r"\%",
+    "~": r"\textasciitilde{}",
+    "^": r"\textasciicircum{}",
+    # Keeps ``` out of the raw block so it can't end the fence early
+    "`": r"\textasciigrave{}",
+}
+LATEX_ESCAPE_RE = re.compile(r"[\\{}$&#_%~^`]")
+
+
+########################################################################################
+# ----------------- Field parsing -----------------
+########################################################################################
+
+# Whether a math body will compile on its own: braces and environments balanced
+def _math_ok(body):
+    if not body.strip() or "`" in body or "$" in body or BLANK_LINE_RE.search(body):
+        return False
+    depth = 0
+    for m in re.finditer(r"\\.|[{}]", body):
+        if m.group() == "{":
+            depth += 1
+        elif m.group() == "}":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0 and body.count("\\begin{") == body.count("\\end{")
+
+
+# Escapes the characters that mean something else to TeX inside math: a bare '%'
+# would comment out the closing delimiter. '&' is kept inside environments
+# (aligned, cases, ...), where it separates columns.
+def _math_body(body):
+    def escape(m):
+        if m.group(2) == "&" and "\\begin{" in body:
+            return m.group()
+        return f"{m.group(1)}\\{m.group(2)}"
+    return MATH_SPECIAL_RE.sub(escape, body)
+
+
+# Splits a prose field into (kind, value) spans: text, math, display, strong, em, code
+def _spans(text):
+    # A line with a math command but no delimiters is math, as in the markdown path
+    if "\\" in text and MATH_CMD_RE.search(text):
+        text = "\n".join(
+            f"${ln.strip()}$" if "$" not in ln and "\\(" not in ln and "\\[" not in ln and MATH_CMD_RE.search(ln) else ln
+            for ln in text.split("\n")
+        )
+
+    spans, pos = [], 0
+    for m in INLINE_RE.finditer(text):
+        kind = m.lastgroup.rstrip("2")
+        value = m.group(m.lastgroup)
+        if kind in ("math", "display"):
+            value = value.strip()
+            if not _math_ok(value):
+                continue  # left in the text and escaped like everything else
+            value = _math_body(value)
+        if m.start() > pos:
+            spans.append(("text", text[pos : m.start()]))
+        spans.append((kind, value))
+        pos = m.end()
+    if pos < len(text):
+        spans.append(("text", text[pos:]))
+    return spans
+
+
+# A formulas entry: ("math", body) when it reads as a formula, else ("code", text)
+def _formula(f):
+    f = f.strip()
+    for start, end in (("$$", "$$"), ("\\[", "\\]"), ("$", "$"), ("\\(", "\\)")):
+        if len(f) > len(start) + len(end) and f.startswith(start) and f.endswith(end):
+            body = f[len(start) : -len(end)].strip()
+            if _math_ok(body):
+                return "math", _math_body(body)
+    if _math_ok(f) and not WORD_RE.search(f):
+        return "math", _math_body(f)
+    return "code", f
+
+
+def _items(values):
+    return [v for v in values or [] if isinstance(v, str) and v.strip()]
+
+
+########################################################################################
+# ----------------- LaTeX -----------------
+########################################################################################
+
+def _latex_text(s):
+    return LATEX_ESCAPE_RE.sub(lambda m: LATEX_ESCAPES[m.group()], s)
+
+
+# Escapes a prose field for LaTeX, keeping its math and simple emphasis
+def latex_inline(text):
+    out = []
+    for kind, value in _spans(text.strip()):
+        if kind == "text":
+            out.append(_latex_text(value))
+        elif kind == "math":
+            out.append(f"\\({value}\\)")
+        elif kind == "display":
+            out.append(f"\\[{value}\\]")
+        elif kind == "strong":
+            out.append(f"\\textbf{{{latex_inline(value)}}}")
+        elif kind == "em":
+            out.append(f"\\emph{{{latex_inline(value)}}}")
+        else:
+            out.append(f"\\texttt{{{_latex_text(value)}}}")
+    return "".join(out)
+
+
+def _latex_list(items):
+    # \item{} so an item starting with '[' isn't read as an optional argument
+    return ["\\begin{itemize}"] + [f"\\item{{}} {item}" for item in items] + ["\\end{itemize}"]
+
+
+def textbook_header_latex(packet):
+    tex = [f"\\section{{{latex_inline(packet.get('title') or 'Learning Packet')}}}", ""]
+    minutes = _latex_text(str(packet.get("estimated_total_read_time_minutes", "~")))
+    tex.append(f"\\textbf{{Estimated reading time:}} {minutes} minutes")
+    lp = _items(packet.get("learning_path"))
+    if lp:
+        tex += ["", "\\textbf{Learning order:} " + " → ".join(latex_inline(p) for p in lp)]
+    return "\n".join(tex) + "\n"
+
+
+def section_to_latex(section):
+    tex = [f"\\subsection{{{latex_inline(section.get('title') or 'Section')}}}", ""]
+    if section.get("overview"):
+        tex += [latex_inline(section["overview"]), ""]
+    if _items(section.get("key_points")):
+        tex.append("\\textbf{Key points:}")
+        tex += _latex_list(latex_inline(p) for p in _items(section["key_points"]))
+    if _items(section.get("formulas")):
+        tex.append("\\textbf{Formulas:}")
+        formulas = []
+        for f in _items(section["formulas"]):
+            kind, value = _formula(f)
+            formulas.append(f"\\(\\displaystyle {value}\\)" if kind == "math" else f"\\texttt{{{_latex_text(value)}}}")
+        tex += _latex_list(formulas)
+    if section.get("derivations"):
+        tex += ["", "\\textbf{Sketch derivation:}", "", latex_inline(section["derivations"]), ""]
+    ex = section.get("worked_example")
+    if isinstance(ex, dict) and ex:
+        tex += ["", "\\textbf{Worked Example:}", ""]
+        if ex.get("prompt"):
+            tex += [f"\\emph{{{latex_inline(ex['prompt'])}}}", ""]
+        if _items(ex.get("steps")):
+            tex += _latex_list(latex_inline(s) for s in _items(ex["steps"]))
+        if ex.get("answer"):
+            tex += [f"\\textbf{{Answer:}} {latex_inline(ex['answer'])}", ""]
+    d = section.get("diagram")
+    if isinstance(d, dict) and (d.get("caption") or d.get("instructions")):
+        tex += ["", "\\textbf{Diagram:} " + latex_inline(d.get("caption") or ""), ""]
+        if d.get("instructions"):
+            tex += ["Instructions: " + latex_inline(d["instructions"]), ""]
+    if _items(section.get("common_pitfalls")):
+        tex.append("\\textbf{Common Pitfalls:}")
+        tex += _latex_list(latex_inline(p) for p in _items(section["common_pitfalls"]))
+    quiz = [qa for qa in section.get("mini_quiz") or [] if isinstance(qa, dict)]
+    if quiz:
+        tex.append("\\textbf{Quick Quiz:}")
+        tex += _latex_list(
+            f"{latex_inline(qa.get('q', ''))}\\par\\textbf{{Ans:}} {latex_inline(qa.get('a', ''))}" for qa in quiz
+        )
+    return "\n".join(tex) + "\n"
+
+
+def textbook_summary_latex(packet):
+    return "\\subsection{Summary}\n\n" + latex_inline(packet["summary"]) + "\n"
+
+
+# The whole textbook as a LaTeX fragment (no preamble)
+def textbook_to_latex(packet):
+    chunks = [textbook_header_latex(packet)]
+    chunks += [section_to_latex(s) for s in packet.get("sections", []) if isinstance(s, dict)]
+    if packet.get("summary"):
+        chunks.append(textbook_summary_latex(packet))
+    return "\n".join(chunks)
+
+
+########################################################################################
+# ----------------- HTML -----------------
+########################################################################################
+
+def _html_text(s):
+    return html.escape(s).replace("`", "&#96;")
+
+
+# Escapes a prose field for HTML; math is kept as TeX source in .math spans
+# (textbook_to_html turns them into MathML)
+def html_inline(text):
+    out = []
+    for kind, value in _spans(text.strip()):
+        if kind == "text":
+            out.append(_html_text(value))
+        elif kind == "math":
+            out.append(f'<span class="math inline">\\({_html_text(value)}\\)</span>')
+        elif kind == "display":
+            out.append(f'<span class="math display">\\[{_html_text(value)}\\]</span>')
+        elif kind == "strong":
+            out.append(f"<strong>{html_inline(value)}</strong>")
+        elif kind == "em":
+            out.append(f"<em>{html_inline(value)}</em>")
+        else:
+            out.append(f"<code>{_html_text(value)}</code>")
+    return "".join(out)
+
+
+def _html_paragraphs(text):
+    return [f"<p>{html_inline(p)}</p>" for p in BLANK_LINE_RE.split(text.strip()) if p.strip()]
+
+
+def _html_list(items):
+    return ["<ul>"] + [f"<li>{item}</li>" for item in items] + ["</ul>"]
+
+
+def textbook_header_html(packet):
+    out = [f"<h1>{html_inline(packet.get('title') or 'Learning Packet')}</h1>"]
+    minutes = _html_text(str(packet.get("estimated_total_read_time_minutes", "~")))
+    out.append(f"<p><strong>Estimated reading time:</strong> {minutes} minutes</p>")
+    lp = _items(packet.get("learning_path"))
+    if lp:
+        out.append("<p><strong>Learning order:</strong> " + " → ".join(html_inline(p) for p in lp) + "</p>")
+    return "\n".join(out) + "\n"
+
+
+def section_to_html(section):
+    out = [f"<h2>{html_inline(section.get('title') or 'Section')}</h2>"]
+    if section.get("overview"):
+        out += _html_paragraphs(section["overview"])
+    if _items(section.get("key_points")):
+        out.append("<p><strong>Key points:</strong></p>")
+        out += _html_list(html_inline(p) for p in _items(section["key_points"]))
+    if _items(section.get("formulas")):
+        out.append("<p><strong>Formulas:</strong></p>")
+        formulas = []
+        for f in _items(section["formulas"]):
+            kind, value = _formula(f)
+            formulas.append(
+                f'<span class="math display">\\[{_html_text(value)}\\]</span>' if kind == "math"
+                else f"<code>{_html_text(value)}</code>"
+            )
+        out += _html_list(formulas)
+    if section.get("derivations"):
+        out.append("<p><strong>Sketch derivation:</strong></p>")
+        out += _html_paragraphs(section["derivations"])
+    ex = section.get("worked_example")
+    if isinstance(ex, dict) and ex:
+        out.append("<p><strong>Worked Example:</strong></p>")
+        if ex.get("prompt"):
+            out.append(f"<p><em>{html_inline(ex['prompt'])}</em></p>")
+        if _items(ex.get("steps")):
+            out += _html_list(html_inline(s) for s in _items(ex["steps"]))
+        if ex.get("answer"):
+            out.append(f"<p><strong>Answer:</strong> {html_inline(ex['answer'])}</p>")
+    d = section.get("diagram")
+    if isinstance(d, dict) and (d.get("caption") or d.get("instructions")):
+        out.append("<p><strong>Diagram:</strong> " + html_inline(d.get("caption") or "") + "</p>")
+        if d.get("instructions"):
+            out.append("<p>Instructions: " + html_inline(d["instructions"]) + "</p>")
+    if _items(section.get("common_pitfalls")):
+        out.append("<p><strong>Common Pitfalls:</strong></p>")
+        out += _html_list(html_inline(p) for p in _items(section["common_pitfalls"]))
+    quiz = [qa for qa in section.get("mini_quiz") or [] if isinstance(qa, dict)]
+    if quiz:
+        out.append("<p><strong>Quick Quiz:</strong></p>")
+        out += _html_list(
+            f"{html_inline(qa.get('q', ''))}<br>\n<strong>Ans:</strong> {html_inline(qa.get('a', ''))}" for qa in quiz
+        )
+    return "\n".join(out) + "\n"
+
+
+def textbook_summary_html(packet):
+    return "<h2>Summary</h2>\n" + "\n".join(_html_paragraphs(packet["summary"])) + "\n"
+
+
+# Converts the TeX in the math spans to MathML, with one pandoc call for all of
+# them. A span pandoc doesn't read as math (or no pandoc at all) stays TeX source.
+def _mathml(fragment):
+    spans = list(MATH_SPAN_RE.finditer(fragment))
+    if not spans:
+        return fragment
+    md = "\n\n".join(
+        f"$${html.unescape(m.group(2))}$$" if m.group(1) == "display" else f"${html.unescape(m.group(2))}$"
+        for m in spans
+    )
+    try:
+        converted = PARAGRAPH_RE.findall(pypandoc.convert_text(md, "html5", format=MATHML_FORMAT, extra_args=["--mathml"]))
+    except (OSError, RuntimeError):
+        return fragment
+    if len(converted) != len(spans):
+        return fragment
+    out, pos = [], 0
+    for m, mathml in zip(spans, converted):
+        out.append(fragment[pos : m.start()])
+        out.append(f'<span class="math {m.group(1)}">{mathml}</span>' if mathml.startswith("<math") else m.group())
+        pos = m.end()
+    out.append(fragment[pos:])
+    return "".join(out)
+
+
+# The whole textbook as an HTML fragment, math as MathML
+def textbook_to_html(packet):
+    chunks = [textbook_header_html(packet)]
+    chunks += [section_to_html(s) for s in packet.get("sections", []) if isinstance(s, dict)]
+    if packet.get("summary"):
+        chunks.append(textbook_summary_html(packet))
+    return _mathml("\n".join(chunks))
+
+
+########################################################################################
+# ----------------- Packet markdown -----------------
+########################################################################################
+
+# The textbook as a pandoc raw LaTeX block, which the LaTeX writer keeps as is,
+# so it slots into the packet markdown next to the problems without being parsed
+# or repaired. The preview uses textbook_to_html instead.
+def textbook_to_raw_markdown(packet):
+    return "```{=latex}\n" + textbook_to_latex(packet).rstrip("\n") + "\n```\n"
@@ -0,0 +1,220 @@
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+from search import assert_api_key
+from http_client import perplexity_post
+import llm_cache
+import metrics
+import tracing
+
+# Try the local parser before spending a sonar-pro round trip
+TOPIC_FAST_PATH = os.getenv("TOPIC_FAST_PATH", "1").lower() not in ("0", "false", "no")
+# Local results below this confidence go to the LLM instead
+TOPIC_FAST_PATH_MIN_CONFIDENCE = float(os.getenv("TOPIC_FAST_PATH_MIN_CONFIDENCE", "0.75"))
+TOPIC_MEMO_SIZE = int(os.getenv("TOPIC_MEMO_SIZE", "1024"))
+
+_memo = OrderedDict()
+_lock = threading.Lock()
+_stats = {"requests": 0, "memo_hits": 0, "fast_path": 0, "llm": 0}
+
+
+########################################################################################
+# ----------------- Local parser for common phrasings -----------------
+########################################################################################
+
+# "I want to learn about", "teach me", "help me understand", ...
+INTRO_RE = re.compile(
+    r"""^(?:
+        (?:i\s+(?:want|would\s+like|'d\s+like|need|wanna)\s+to\s+(?:learn|know|study|understand|review)(?:\s+more)?)
+        | (?:i(?:'m|\s+am)\s+(?:studying|learning|interested\s+in|curious\s+about))
+        | (?:(?:please\s+)?(?:teach|show)\s+me)
+        | (?:help\s+me\s+(?:learn|understand|study|review))
+        | (?:(?:can|could)\s+you\s+(?:teach|explain)(?:\s+me)?)
+        | (?:learn(?:ing)?|study(?:ing)?|explain|review|cover)
+    )\b\s*(?:about\s+|on\s+|the\s+basics\s+of\s+)?""",
+    re.IGNORECASE | re.VERBOSE,
+)
+# "X, including A, B and C" / "X such as A and B" / "X: A, B, C"
+MAIN_WITH_SUBS_RE = re.compile(
+    r"^(?P<main>[^,:;]+?)\s*(?:,?\s+(?:including|such\s+as|especially|particularly|covering|focusing\s+on|like|with\s+(?:a\s+)?focus\s+on)\s+|:\s*)(?P<subs>.+)$",
+    re.IGNORECASE,
+)
+BULLET_RE = re.compile(r"^\s*(?:[-*•‣▪]|\d+[.)])\s+(?P<item>.+?)\s*$")
+LIST_SPLIT_RE = re.compile(r"\s*(?:,|;|\s&\s|\band\b|\bas\s+well\s+as\b)\s*", re.IGNORECASE)
+# Items that read like questions or clauses rather than topic names
+CLAUSE_RE = re.compile(
+    r"^(?:how|why|what|when|where|which|who|whether|is|are|does|do|can|should|if|because"
+    r"|for|to|so|then|i|me|my|want|need|about)\b|\?",
+    re.IGNORECASE,
+)
+MAX_ITEM_WORDS = 6
+
+
+def _tidy(text):
+    text = text.strip().strip(".!?;:,\"'").strip()
+    text = re.sub(r"^(?:the\s+)?(?:topics?\s+of\s+)", "", text, flags=re.IGNORECASE)
+    text = re.sub(r"^(?:the|a|an)\s+", "", text, flags=re.IGNORECASE)
+    text = re.sub(r"\s+", " ", text)
+    if text and text == text.lower():
+        text = text[0].upper() + text[1:]
+    return text
+
+
+def _split_list(text):
+    items = [_tidy(p) for p in LIST_SPLIT_RE.split(text)]
+    return [i for i in items if i]
+
+
+def _looks_like_topic(item):
+    return (
+        0 < len(item.split()) <= MAX_ITEM_WORDS
+        and not CLAUSE_RE.search(item)
+    )
+
+
+# Parses a prompt locally into the same shape breakdown_topics returns
+def parse_topics_locally(sentence):
+    """
+    Returns ({"main_topic": str, "subtopics": [str]}, confidence) or (None, 0.0).
+    Only handles prompts that already name their subtopics; anything needing
+    interpretation (single broad topics, questions, long prose) gets low
+    confidence so the LLM handles it.
+    """
+    text = sentence.strip()
+    if not text:
+        return None, 0.0
+
+    # Bullet lists, optionally under a heading line
+    lines = [ln for ln in text.splitlines() if ln.strip()]
+    bullets = [m.group("item") for m in map(BULLET_RE.match, lines) if m]
+    if len(bullets) >= 2:
+        heading = [ln for ln in lines if not BULLET_RE.match(ln)]
+        subtopics = [_tidy(b) for b in bullets]
+        if not all(_looks_like_topic(s) for s in subtopics):
+            return None, 0.0
+        if len(heading) == 1:
+            main = _tidy(INTRO_RE.sub("", heading[0].strip()))
+            if _looks_like_topic(main):
+                return {"main_topic": main, "subtopics": subtopics}, 0.9
+        return None, 0.0
+
+    text = " ".join(text.split())
+    body = INTRO_RE.sub("", text, count=1).strip()
+    had_intro = body != text
+
+    # Explicit main topic followed by its subtopics
+    m = MAIN_WITH_SUBS_RE.match(body)
+    if m:
+        main = _tidy(m.group("main"))
+        subtopics = _split_list(m.group("subs"))
+        if _looks_like_topic(main) and subtopics and all(_looks_like_topic(s) for s in subtopics):
+            return {"main_topic": main, "subtopics": subtopics}, 0.9
+
+    # A plain list of named topics: "X, Y, and Z"
+    items = _split_list(body)
+    if len(items) >= 2 and all(_looks_like_topic(i) for i in items):
+        # Without a stated umbrella topic a short list names itself; longer lists
+        # need the LLM to find the common theme
+        if len(items) > 3:
+            return None, 0.4
+        # "supply and demand", "rock and roll": one compound name, not a list
+        if len(items) == 2 and not re.search(r"[,;]", body) and all(len(i.split()) == 1 for i in items):
+            return None, 0.5
+        main = ", ".join(items[:-1]) + " and " + items[-1]
+        return {"main_topic": main, "subtopics": items}, 0.8 if had_intro else 0.6
+
+    # A single named topic still needs the LLM to propose subtopics
+    return None, 0.0
+
+
+########################################################################################
+# ----------------- LLM breakdown and dispatch -----------------
+########################################################################################
+
+# Checks a breakdown response has the shape /create relies on
+def _valid_topics(content):
+    topics = json.loads(content)
+    return isinstance(topics.get("main_topic"), str) and isinstance(topics.get("subtopics"), list)
+
+# Uses Perplexity's Sonar-Pro model to break down the sentence
+def llm_breakdown_topics(sentence):
+    assert_api_key()
+    payload = {
+        "model": "sonar-pro",
+        "messages": [
+            {
+                "role": "system",
+                "content": "Extract a student's learning intent into a main topic and subtopics. Respond ONLY in JSON.",
+            },
+            {"role": "user", "content": f'Break this down: "{sentence}"'},
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "main_topic": {"type": "string"},
+                        "subtopics": {"type": "array", "items": {"type": "string"}},
+                    },
+                    "required": ["main_topic", "subtopics"],
+                }
+            },
+        },
+        "temperature": 0.2,
+        "max_tokens": 1000,
+    }
+
+    def fetch():
+        r = perplexity_post(payload, timeout=90)
+        r.raise_for_status()
+        data = r.json()
+        metrics.record_usage("perplexity", data.get("usage"))
+        return data["choices"][0]["message"]["content"]
+
+    content = llm_cache.cached_call("breakdown_topics", payload, fetch, _valid_topics)
+    return json.loads(content)
+
+# Breaks down a sentence into main topic and subtopics
+@metrics.STAGE_SECONDS.time(stage="breakdown_topics")
+@tracing.traced("breakdown_topics")
+def breakdown_topics(sentence):
+    """
+    Extracts a main topic and subtopics from a sentence describing what a student
+    wants to learn. Common phrasings are parsed locally; the rest go to Sonar-Pro.
+    Example:
+        breakdown_topics("I want to learn about vector spaces, gram schmidt, and matrix operations")
+    """
+    key = " ".join(sentence.lower().split())
+    with _lock:
+        _stats["requests"] += 1
+        if key in _memo:
+            _memo.move_to_end(key)
+            _stats["memo_hits"] += 1
+            return json.loads(_memo[key])
+
+    topics = None
+    if TOPIC_FAST_PATH:
+        topics, confidence = parse_topics_locally(sentence)
+        if confidence < TOPIC_FAST_PATH_MIN_CONFIDENCE:
+            topics = None
+    source = "fast_path" if topics is not None else "llm"
+    if topics is None:
+        topics = llm_breakdown_topics(sentence)
+
+    with _lock:
+        _stats[source] += 1
+        # Stored as JSON so callers can't mutate the memoized copy
+        _memo[key] = json.dumps(topics)
+        while len(_memo) > TOPIC_MEMO_SIZE:
+            _memo.popitem(last=False)
+    return topics
+
+
+# Counters for how often the local parser saves an LLM round trip
+def stats():
+    with _lock:
+        parsed = _stats["fast_path"] + _stats["llm"]
+        return dict(_stats, fast_path_rate=(_stats["fast_path"] / parsed) if parsed else 0.0)
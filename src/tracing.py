@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import contextvars
+from contextlib import nullcontext
+
+# Record spans (and log one line per span). Off, span() is a shared no-op and
+# only the trace ID is carried into log lines.
+TRACING = os.getenv("TRACING", "0").lower() in ("1", "true", "yes")
+# Traces at least this slow are appended, with all their spans, to TRACE_EXPORT_PATH
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "60"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+
+_trace_id = contextvars.ContextVar("wonderbot_trace_id", default=None)
+_span = contextvars.ContextVar("wonderbot_span", default=None)
+_write_lock = threading.Lock()
+_NOOP = nullcontext()
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+# Writes one JSON log line, tagged with the current trace and span
+def log(event, level="info", **fields):
+    record = {"ts": round(time.time(), 3), "level": level, "event": event}
+    trace_id = _trace_id.get()
+    if trace_id is not None:
+        record["trace_id"] = trace_id
+    span = _span.get()
+    if span is not None:
+        record["span_id"] = span.id
+    record.update(fields)
+    line = json.dumps(record, default=str)
+    with _write_lock:
+        print(line, flush=True)
+
+
+class _Trace:
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span.to_dict())
+
+
+class _Span:
+    def __init__(self, trace, name, parent_id, attrs):
+        self.trace = trace
+        self.id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.error = None
+        self.seconds = None
+
+    def __enter__(self):
+        self._token = _span.set(self)
+        self._start = time.perf_counter()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _span.reset(self._token)
+        self.trace.add(self)
+        log(
+            "span",
+            level="error" if self.error else "debug",
+            span_id=self.id,
+            parent_id=self.parent_id,
+            name=self.name,
+            duration_ms=round(self.seconds * 1000, 2),
+            error=self.error,
+            **self.attrs,
+        )
+        return False
+
+    def to_dict(self):
+        return {
+            "span_id": self.id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "seconds": round(self.seconds, 6),
+            "error": self.error,
+            "attrs": self.attrs,
+        }
+
+
+class trace:
+    """
+    Makes `trace_id` (a new one if None) current for the block. With TRACING on,
+    the block is also the root span and the finished trace is exported when slow.
+    """
+
+    def __init__(self, name, trace_id=None, **attrs):
+        self.name = name
+        self.id = trace_id or new_trace_id()
+        self.attrs = attrs
+        self._root = None
+
+    def __enter__(self):
+        self._token = _trace_id.set(self.id)
+        if TRACING:
+            self._root = _Span(_Trace(self.id), self.name, None, self.attrs)
+            self._root.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._root is not None:
+                self._root.__exit__(exc_type, exc, tb)
+                if TRACE_EXPORT_PATH and self._root.seconds >= TRACE_SLOW_SECONDS:
+                    _export(self._root)
+        finally:
+            _trace_id.reset(self._token)
+        return False
+
+
+def _export(root):
+    record = {
+        "trace_id": root.trace.id,
+        "name": root.name,
+        "seconds": round(root.seconds, 3),
+        "error": root.error,
+        "spans": root.trace.spans,
+    }
+    try:
+        with _write_lock, open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+    except OSError as e:
+        log("trace_export_failed", level="warning", error=str(e))
+
+
+# A child of the current span; a no-op when tracing is off or outside a trace
+def span(name, **attrs):
+    if not TRACING:
+        return _NOOP
+    parent = _span.get()
+    if parent is None:
+        return _NOOP
+    return _Span(parent.trace, name, parent.id, attrs)
+
+
+# Adds attributes (e.g. an HTTP status) to the current span
+def annotate(**attrs):
+    if TRACING:
+        current = _span.get()
+        if current is not None:
+            current.attrs.update(attrs)
+
+
+# Decorator: runs the function inside span(name)
+def traced(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Carries the current trace into a function run on another thread (pool.submit);
+# bind once per submission, a bound function can't run on two threads at once
+def bind(fn):
+    if _trace_id.get() is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture
+def pandoc():
+    import pypandoc
+    try:
+        pypandoc.get_pandoc_version()
+    except OSError:
+        pytest.skip("pandoc is not installed")
@@ -0,0 +1,44 @@
+import pytest
+
+import markdown_repair
+
+VALID = [
+    "Set x = 2*y + 1 and solve for y.\n",
+    "Area is a*b, or (a+1)*(b+1) with a margin.\n",
+    "Delete *.pyc files and everything in build/*.\n",
+    "Price is $5 and $10 total.\n",
+    "Cost: $5\n",
+    "Set x = 2*y + 1 and solve for y.\n\nPrice is $5 and $10 total.\n",
+]
+
+
+@pytest.mark.parametrize("md", VALID)
+def test_valid_text_is_left_alone(pandoc, md):
+    assert markdown_repair.pandoc_issues(md) == []
+    assert markdown_repair.repair_markdown(md) == md
+
+
+@pytest.mark.parametrize("md", VALID)
+def test_local_fix_keeps_literal_stars_and_prices(md):
+    assert markdown_repair.local_fix(md) == md
+
+
+@pytest.mark.parametrize(
+    "md, fixed",
+    [
+        ("Area is $x^2 and more\n", "Area is $x^2 and more$\n"),
+        ("The $ x + 1 $ value\n", "The $x + 1$ value\n"),
+        ("Use `code here\n", "Use `code here`\n"),
+        ("**bold start\n", "**bold start**\n"),
+        ("*stress this\n", "*stress this*\n"),
+        ("#Heading\ntext\n", "# Heading\ntext\n"),
+    ],
+)
+def test_flagged_delimiters_are_balanced(pandoc, md, fixed):
+    assert markdown_repair.pandoc_issues(md)
+    assert markdown_repair.repair_markdown(md) == fixed
+
+
+def test_only_flagged_fragments_are_rewritten(pandoc):
+    md = "# One\n\nCosts $5 and 2*y.\n\n# Two\n\nBroken **bold\n"
+    assert markdown_repair.repair_markdown(md) == "# One\n\nCosts $5 and 2*y.\n\n# Two\n\nBroken **bold**\n"
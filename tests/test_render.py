@@ -0,0 +1,48 @@
+import textbook_render
+import render
+
+PACKET = {
+    "title": "Waves <b>& sound</b>",
+    "sections": [
+        {
+            "title": "Frequency",
+            "overview": "The period is $T = 1/f$ and <img src=x onerror=alert(1)> is text.",
+            "key_points": ["**Speed** is $v = f\\lambda$"],
+        }
+    ],
+}
+
+
+def test_latex_renderer_packet_preview(pandoc, tmp_path):
+    out = tmp_path / "preview.html"
+    render.render_html(
+        "# Practice Problems\n\n1. Is <script>alert(1)</script> run?\n",
+        out,
+        pdf_url="/static/pdfs/x.pdf",
+        trusted_html=textbook_render.textbook_to_html(PACKET),
+    )
+    html = out.read_text(encoding="utf-8")
+    body = html[html.index("<body>"):]
+    # The emitted textbook is HTML, not escaped source in a code block
+    assert "<h2>Frequency</h2>" in body
+    assert "<pre" not in body and "{=html}" not in body and "{=latex}" not in body
+    assert body.index("<h2>Frequency</h2>") < body.index("Practice Problems")
+    # Textbook math is MathML like the rest of the preview, not TeX source
+    assert body.count("<math") == 2 and "\\(" not in body
+    # Model-supplied text is escaped on both paths
+    assert "Waves &lt;b&gt;&amp; sound&lt;/b&gt;" in body
+    assert "&lt;img src=x onerror=alert(1)&gt;" in body
+    assert "&lt;script&gt;alert(1)&lt;/script&gt;" in body
+    assert "<script" not in body and "<img" not in body
+
+
+def test_raw_markdown_is_only_latex():
+    md = textbook_render.textbook_to_raw_markdown(PACKET)
+    assert md.startswith("```{=latex}\n") and md.endswith("\n```\n")
+    assert "<h2>" not in md
+
+
+def test_textbook_math_becomes_mathml(pandoc):
+    html = textbook_render.textbook_to_html({"sections": [{"title": "S", "formulas": ["$$\\frac{a}{b}$$", "x % y"]}]})
+    assert '<span class="math display"><math display="block"' in html
+    assert "<mfrac>" in html and "\\[" not in html
@@ -0,0 +1,23 @@
+import pytest
+
+from topics import parse_topics_locally
+
+
+@pytest.mark.parametrize(
+    "prompt, main",
+    [
+        ("Explainable AI, LIME and SHAP", "Explainable AI"),
+        ("Reviewer bias, anchoring and halo effects", "Reviewer bias"),
+        ("Learned helplessness, motivation and resilience", "Learned helplessness"),
+        ("Coverage testing, branches and paths", "Coverage testing"),
+    ],
+)
+def test_words_starting_with_intro_verbs_are_kept(prompt, main):
+    parsed, _ = parse_topics_locally(prompt)
+    assert parsed is None or parsed["main_topic"].lower().startswith(main.lower())
+
+
+def test_intro_verbs_are_stripped():
+    parsed, confidence = parse_topics_locally("Explain photosynthesis, including light reactions and the Calvin cycle")
+    assert parsed["main_topic"].lower() == "photosynthesis"
+    assert confidence > 0